@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+End-to-end Load Benchmark
+Drives the real handlers (process_all_numbers_with_country, send_number, start_otp_monitoring,
+show_sms) through the hand-out -> OTP -> delete lifecycle with a fake Telegram bot, MongoDB
+(or mongomock-motor) and the local SMS panel simulator, and reports time-to-OTP percentiles,
+panel requests per session, MongoDB operations per hand-out, event-loop lag and memory.
+
+    python3 benchmark.py --numbers 5000 --users 500 --rate 20
+    python3 benchmark.py --mongo-uri mongodb://localhost:27017 --json results.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from io import BytesIO
+from types import SimpleNamespace
+
+import bot
+from sms_panel_simulator import PanelSimulator, start_simulator
+
+ADMIN_USER_ID = 1
+FIRST_USER_ID = 100000
+
+# Collection methods counted as one MongoDB operation each
+MONGO_OPERATIONS = {
+    "find", "find_one", "aggregate", "count_documents", "estimated_document_count", "distinct",
+    "insert_one", "insert_many", "update_one", "update_many", "replace_one", "delete_one",
+    "delete_many", "bulk_write", "find_one_and_update", "find_one_and_delete", "create_index",
+}
+
+
+# === MONGODB OPERATION COUNTING ===
+class CountingCollection:
+    """Collection proxy counting every operation started through it"""
+
+    def __init__(self, collection, counts):
+        self._collection = collection
+        self._counts = counts
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in MONGO_OPERATIONS:
+            return attr
+
+        def counted(*args, **kwargs):
+            self._counts[name] = self._counts.get(name, 0) + 1
+            return attr(*args, **kwargs)
+        return counted
+
+
+class CountingDatabase:
+    """Database proxy handing out CountingCollections"""
+
+    def __init__(self, db):
+        self._db = db
+        self.counts = {}
+
+    def __getitem__(self, name):
+        return CountingCollection(self._db[name], self.counts)
+
+    def get_collection(self, name, *args, **kwargs):
+        return CountingCollection(self._db.get_collection(name, *args, **kwargs), self.counts)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def __bool__(self):
+        return True
+
+    def total(self):
+        return sum(self.counts.values())
+
+
+def open_database(args):
+    if args.mongo_uri:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        client = AsyncIOMotorClient(args.mongo_uri)
+        return client[args.db_name], client
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        sys.exit("❌ Install mongomock-motor (pip3 install mongomock-motor) or pass --mongo-uri")
+    client = AsyncMongoMockClient()
+    return client[args.db_name], client
+
+
+# === FAKE TELEGRAM ===
+class FakeBot:
+    """Bot stand-in recording sent and edited messages"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.next_message_id = 1
+        self.calls = {}
+        self.otp_shown_at = {}  # (chat_id, message_id) -> time the OTP was first shown
+
+    async def _call(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call("send_message")
+        self.next_message_id += 1
+        return SimpleNamespace(chat_id=chat_id, message_id=self.next_message_id, text=text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await self._call("edit_message_text")
+        if "🔐" in text:
+            self.otp_shown_at.setdefault((chat_id, message_id), time.monotonic())
+        return SimpleNamespace(chat_id=chat_id, message_id=message_id, text=text)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        await self._call("send_document")
+        self.next_message_id += 1
+        return SimpleNamespace(chat_id=chat_id, message_id=self.next_message_id)
+
+    async def answer_callback_query(self, *args, **kwargs):
+        await self._call("answer_callback_query")
+        return True
+
+
+class FakeCallbackQuery:
+    def __init__(self, fake_bot, user_id, data, message_id):
+        self.bot = fake_bot
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = SimpleNamespace(chat_id=user_id, message_id=message_id)
+
+    async def answer(self, *args, **kwargs):
+        return await self.bot.answer_callback_query()
+
+    async def edit_message_text(self, text, **kwargs):
+        return await self.bot.edit_message_text(text, chat_id=self.message.chat_id, message_id=self.message.message_id, **kwargs)
+
+
+class FakeMessage:
+    def __init__(self, fake_bot, chat_id):
+        self.bot = fake_bot
+        self.chat_id = chat_id
+
+    async def reply_text(self, text, **kwargs):
+        return await self.bot.send_message(self.chat_id, text, **kwargs)
+
+    async def reply_document(self, document, **kwargs):
+        return await self.bot.send_document(self.chat_id, document, **kwargs)
+
+
+def callback_update(fake_bot, user_id, data):
+    fake_bot.next_message_id += 1
+    query = FakeCallbackQuery(fake_bot, user_id, data, fake_bot.next_message_id)
+    return SimpleNamespace(callback_query=query, effective_user=query.from_user, message=None)
+
+
+# === MEASUREMENTS ===
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def describe(values, unit="s"):
+    if not values:
+        return "n/a"
+    return (f"p50 {percentile(values, 50):.3f}{unit}, p90 {percentile(values, 90):.3f}{unit}, "
+            f"p99 {percentile(values, 99):.3f}{unit}, max {max(values):.3f}{unit} (n={len(values)})")
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+async def sample_loop_lag(samples, interval=0.05):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - started - interval)
+
+
+# === BENCHMARK ===
+def synthetic_numbers(count, prefix):
+    width = 13 - len(prefix)
+    return [f"{prefix}{index:0{width}d}" for index in range(1, count + 1)]
+
+
+async def seed_numbers(numbers, context, fake_bot, country_name):
+    """Upload the numbers through the admin CSV flow"""
+    rows = ["Number,Range"] + [f"{number},Benchmark-Range" for number in numbers]
+    bot.uploaded_csvs[ADMIN_USER_ID] = BytesIO("\n".join(rows).encode("utf-8"))
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=ADMIN_USER_ID), message=FakeMessage(fake_bot, ADMIN_USER_ID))
+    job = {'id': "benchmark", 'bot': fake_bot, 'chat_id': ADMIN_USER_ID, 'message_id': None,
+           'progress': None, 'result': None, 'last_report': 0}
+    started = time.monotonic()
+    await bot.process_all_numbers_with_country(update, context, country_name, job)
+    return time.monotonic() - started, job['result']
+
+
+async def run_user(index, args, context, fake_bot, simulator, country_code, results):
+    """One user: get a number, maybe tap "show SMS", and receive an OTP some time later"""
+    user_id = FIRST_USER_ID + index
+    update = callback_update(fake_bot, user_id, f"country_{country_code}")
+    message = update.callback_query.message
+    handed_out_at = time.monotonic()
+    await bot.send_number(update, context)
+    results['handout_latency'].append(time.monotonic() - handed_out_at)
+    number = bot.current_user_numbers.get(user_id)
+    if number is None:
+        results['no_number'] += 1
+        return
+
+    if random.random() < args.otp_share:
+        await asyncio.sleep(random.uniform(*args.otp_after))
+        delivered_at = time.monotonic()
+        row = simulator.add_sms(number)
+        if bot.extract_otp_from_message(row[5]) is None:
+            # The bot cannot read a code from this message, it is counted separately
+            results['unreadable'] += 1
+        else:
+            results['delivered'].append(((message.chat_id, message.message_id), handed_out_at, delivered_at))
+    if random.random() < args.show_sms_share:
+        started = time.monotonic()
+        await bot.show_sms(callback_update(fake_bot, user_id, f"sms_{number}"), context)
+        results['show_sms_latency'].append(time.monotonic() - started)
+
+
+async def run_benchmark(args):
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="bot-benchmark-")
+    bot.USER_CACHE_DIR = workdir
+    bot.USER_STORE_FILE = os.path.join(workdir, "verified_users.db")
+    bot.OTP_CHECK_INTERVAL = args.check_interval
+    bot.MORNING_CALL_TIMEOUT = args.timeout
+
+    simulator = PanelSimulator(
+        timezone_name=bot.TIMEZONE_NAME, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, session_ttl=args.session_ttl, seed=args.seed,
+    )
+    numbers = synthetic_numbers(args.numbers, args.prefix)
+    for number in numbers:
+        simulator.add_number(number, "Benchmark-Range")
+    runner = await start_simulator(simulator, "127.0.0.1", args.port)
+    bot.SMS_PANELS = [{
+        "name": "simulator",
+        "type": "ints_agent",
+        "endpoint": bot.SMS_API_ENDPOINT,
+        "mirrors": [{"base_url": f"http://127.0.0.1:{args.port}", "cookie": None,
+                     "username": simulator.username, "password": simulator.password}],
+    }]
+
+    raw_db, client = open_database(args)
+    db = CountingDatabase(raw_db)
+    fake_bot = FakeBot(args.telegram_latency)
+    app = SimpleNamespace(bot=fake_bot, bot_data={"db": db})
+    context = SimpleNamespace(bot=fake_bot, bot_data=app.bot_data, user_data={}, chat_data={})
+
+    await bot.init_user_store()
+    bot.init_sms_panels(db)
+    await bot.init_session_store(db)
+    tasks = [asyncio.create_task(bot.outbound_dispatcher_task(app))]
+    lag_samples = []
+    tasks.append(asyncio.create_task(sample_loop_lag(lag_samples)))
+
+    print(f"🧪 Seeding {len(numbers)} numbers ({'mongodb' if args.mongo_uri else 'mongomock'})...")
+    seed_seconds, seed_result = await seed_numbers(numbers, context, fake_bot, args.country)
+    seed_ops = db.total()
+    print(f"✅ {seed_result} in {seed_seconds:.2f}s ({seed_ops} MongoDB operations)")
+
+    results = {'handout_latency': [], 'show_sms_latency': [], 'delivered': [], 'no_number': 0, 'unreadable': 0}
+    country_code = args.country.lower().replace(" ", "_")
+    db.counts.clear()
+    lag_samples.clear()
+    panel_requests_before = simulator.stats['report_requests']
+    rss_before = peak_rss_mb()
+    started = time.monotonic()
+
+    print(f"🚀 {args.users} users at {args.rate}/s, OTP after {args.otp_after[0]:g}-{args.otp_after[1]:g}s...")
+    users = []
+    for index in range(args.users):
+        users.append(asyncio.create_task(run_user(index, args, context, fake_bot, simulator, country_code, results)))
+        await asyncio.sleep(1 / args.rate)
+    await asyncio.gather(*users)
+    # Let the morning calls still running find their OTP or time out
+    while bot.active_number_monitors and time.monotonic() - started < args.users / args.rate + args.timeout + 30:
+        await asyncio.sleep(0.5)
+    elapsed = time.monotonic() - started
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await bot.close_sms_http_session()
+    await bot.close_user_store()
+    await runner.cleanup()
+    client.close()
+
+    detection, time_to_otp, missed = [], [], 0
+    for key, handed_out_at, delivered_at in results['delivered']:
+        shown_at = fake_bot.otp_shown_at.get(key)
+        if shown_at is None:
+            missed += 1
+            continue
+        detection.append(shown_at - delivered_at)
+        time_to_otp.append(shown_at - handed_out_at)
+    handouts = len(results['handout_latency']) - results['no_number']
+    panel_requests = simulator.stats['report_requests'] - panel_requests_before
+    mongo_ops = db.total()
+
+    summary = {
+        'numbers': len(numbers),
+        'users': args.users,
+        'handouts': handouts,
+        'seed_seconds': round(seed_seconds, 3),
+        'elapsed_seconds': round(elapsed, 3),
+        'handout_latency_p50': percentile(results['handout_latency'], 50),
+        'handout_latency_p99': percentile(results['handout_latency'], 99),
+        'otp_detection_p50': percentile(detection, 50),
+        'otp_detection_p90': percentile(detection, 90),
+        'otp_detection_p99': percentile(detection, 99),
+        'time_to_otp_p50': percentile(time_to_otp, 50),
+        'time_to_otp_p99': percentile(time_to_otp, 99),
+        'otps_delivered': len(results['delivered']),
+        'otps_missed': missed,
+        'otps_unreadable': results['unreadable'],
+        'panel_requests': panel_requests,
+        'panel_requests_per_session': round(panel_requests / handouts, 2) if handouts else None,
+        'panel_logins': simulator.stats['logins'],
+        'mongo_operations': mongo_ops,
+        'mongo_operations_per_handout': round(mongo_ops / handouts, 2) if handouts else None,
+        'mongo_operations_by_type': dict(sorted(db.counts.items())),
+        'telegram_calls': fake_bot.calls,
+        'loop_lag_p50': percentile(lag_samples, 50),
+        'loop_lag_p99': percentile(lag_samples, 99),
+        'loop_lag_max': max(lag_samples) if lag_samples else None,
+        'peak_rss_mb_before': round(rss_before, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+    print("")
+    print("📊 Benchmark Results")
+    print("=" * 50)
+    print(f"Hand-outs: {handouts}/{args.users} in {elapsed:.1f}s ({results['no_number']} without a number)")
+    print(f"Hand-out latency: {describe(results['handout_latency'])}")
+    print(f"Show SMS latency: {describe(results['show_sms_latency'])}")
+    print(f"OTP detection (SMS at panel -> shown): {describe(detection)}")
+    print(f"Time to OTP (hand-out -> shown): {describe(time_to_otp)}")
+    print(f"OTPs missed: {missed}/{len(results['delivered'])} ({results['unreadable']} more without a code the bot can read)")
+    print(f"Panel requests: {panel_requests} ({summary['panel_requests_per_session']} per session, {simulator.stats['logins']} logins)")
+    print(f"MongoDB operations: {mongo_ops} ({summary['mongo_operations_per_handout']} per hand-out) {summary['mongo_operations_by_type']}")
+    print(f"Telegram calls: {fake_bot.calls}")
+    print(f"Event-loop lag: {describe(lag_samples)}")
+    print(f"Peak RSS: {summary['peak_rss_mb']:.1f} MB (after seeding {rss_before:.1f} MB)")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"💾 Results written to {args.json}")
+    return summary
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end load benchmark for the bot")
+    parser.add_argument("--numbers", type=int, default=2000, help="Numbers to upload")
+    parser.add_argument("--users", type=int, default=200, help="Users asking for a number")
+    parser.add_argument("--rate", type=float, default=20.0, help="New users per second")
+    parser.add_argument("--prefix", default="225", help="Country prefix of the generated numbers")
+    parser.add_argument("--country", default="Benchmark", help="Custom country name for the upload")
+    parser.add_argument("--otp-after", type=float, nargs=2, default=(3.0, 15.0), metavar=("MIN", "MAX"),
+                        help="Seconds after the hand-out before the OTP reaches the panel")
+    parser.add_argument("--otp-share", type=float, default=0.9, help="Fraction of numbers that get an OTP")
+    parser.add_argument("--show-sms-share", type=float, default=0.2, help="Fraction of users tapping show SMS")
+    parser.add_argument("--check-interval", type=float, default=bot.OTP_CHECK_INTERVAL, help="Morning call check interval")
+    parser.add_argument("--timeout", type=float, default=bot.MORNING_CALL_TIMEOUT, help="Morning call timeout")
+    parser.add_argument("--latency", type=float, default=0.1, help="Mean panel latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Panel latency standard deviation")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of panel requests failing")
+    parser.add_argument("--session-ttl", type=float, default=3600, help="Panel login lifetime in seconds")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="Fake Bot API call latency")
+    parser.add_argument("--port", type=int, default=8090, help="Port for the panel simulator")
+    parser.add_argument("--mongo-uri", help="Use a real MongoDB (default: mongomock-motor)")
+    parser.add_argument("--db-name", default="BotBenchmark")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.getLogger().setLevel(args.log_level.upper())
+    try:
+        asyncio.run(run_benchmark(args))
+    except KeyboardInterrupt:
+        print("\n🛑 Benchmark stopped")
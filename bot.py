@@ -1,17 +1,40 @@
 import logging
 import os
+import sys
+import traceback
 import asyncio
-from io import BytesIO, StringIO
+from io import BytesIO, StringIO, TextIOWrapper
 from datetime import datetime, timedelta
 import csv
 import time
 import re
 import json
+import itertools
+import hashlib
+import sqlite3
+import socket
+import uuid
+import functools
+import contextlib
+import contextvars
+import random
+import multiprocessing
+import tempfile
+import gzip
+import shutil
+import zipfile
+import threading
+from bisect import bisect_left
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
@@ -19,9 +42,12 @@ from telegram.ext import (
     ContextTypes,
 )
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import pytz
 import pycountry
 import aiohttp
+from aiohttp import web
 
 # Import all configurations from config.py
 from config import *
@@ -32,18 +58,20 @@ logging.basicConfig(level=getattr(logging, LOGGING_LEVEL))
 
 # Session management - initialize from config
 CURRENT_SMS_API_COOKIE = SMS_API_COOKIE
+CONFIG_SMS_API_COOKIE = SMS_API_COOKIE  # Session last read from config.py (/updatesms does not rewrite the file)
 logging.info(f"🔑 Initialized SMS API session from config: {CURRENT_SMS_API_COOKIE[:20]}...{CURRENT_SMS_API_COOKIE[-10:]}")
 
 # Admin notification rate limiting
 last_api_failure_notification = {}  # Track last notification time for each failure type
 
 # Bot state variables
-uploaded_csv = None
+uploaded_csvs = {}  # Store the pending CSV upload for each admin
 user_states = {}  # Store user states for country input
 manual_numbers = {}  # Store manual numbers for each user
 current_user_numbers = {}  # Track current number for each user
 user_monitoring_sessions = {}  # Track multiple monitoring sessions per user
 active_number_monitors = {}  # Store active monitors for each number
+released_session_ids = deque(maxlen=1000)  # Sessions this process stopped - never claimed again
 
 # PERFORMANCE OPTIMIZATION: Cache for country data to avoid repeated DB queries
 countries_cache = None
@@ -56,15 +84,411 @@ def clear_countries_cache():
     countries_cache_time = None
     logging.info("Countries cache cleared")
 
+# === METRICS ===
+# Counters and histograms served on /metrics in the Prometheus text format, next to the gauges from
+# collect_metrics(). A metric is declared once with its label names; each label combination gets
+# its own series on first use. MongoDB commands are timed on motor's threads, hence the lock.
+metrics_registry = {}  # name -> {'type', 'help', 'labels', 'buckets', 'series': {label values: value}}
+metrics_lock = threading.Lock()
+
+def define_metric(name, metric_type, help_text, labels=(), buckets=METRICS_LATENCY_BUCKETS):
+    """Declare a "counter" or "histogram" metric"""
+    metrics_registry[name] = {
+        'type': metric_type,
+        'help': help_text,
+        'labels': tuple(labels),
+        'buckets': tuple(buckets) if metric_type == "histogram" else (),
+        'series': {},
+    }
+
+def _metric_key(metric, labels):
+    return tuple(str(labels.get(label, "")) for label in metric['labels'])
+
+def metric_inc(name, amount=1, **labels):
+    """Add to a counter"""
+    metric = metrics_registry[name]
+    key = _metric_key(metric, labels)
+    with metrics_lock:
+        metric['series'][key] = metric['series'].get(key, 0) + amount
+
+def metric_observe(name, value, **labels):
+    """Record one value in a histogram"""
+    metric = metrics_registry[name]
+    key = _metric_key(metric, labels)
+    with metrics_lock:
+        series = metric['series'].get(key)
+        if series is None:
+            # One count per bucket plus +Inf, then the sum of all values
+            series = metric['series'][key] = [0] * (len(metric['buckets']) + 1) + [0.0]
+        series[bisect_left(metric['buckets'], value)] += 1
+        series[-1] += value
+
+def _metric_labels(names, values, extra=None):
+    """Label set text such as {panel="msi",outcome="ok"}"""
+    pairs = []
+    for name, value in zip(names, values):
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+        pairs.append(f'{name}="{value}"')
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def render_metrics():
+    """Counters and histograms in the Prometheus text format"""
+    lines = []
+    with metrics_lock:
+        for name, metric in metrics_registry.items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for key, value in sorted(metric['series'].items()):
+                if metric['type'] == "counter":
+                    lines.append(f"{name}{_metric_labels(metric['labels'], key)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric['buckets'] + ("+Inf",), value):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    lines.append(f"{name}_bucket{_metric_labels(metric['labels'], key, le)} {cumulative}")
+                lines.append(f"{name}_sum{_metric_labels(metric['labels'], key)} {round(value[-1], 6)}")
+                lines.append(f"{name}_count{_metric_labels(metric['labels'], key)} {cumulative}")
+    return lines
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """pymongo listener timing every MongoDB command"""
+    
+    def started(self, event):
+        pass
+    
+    def succeeded(self, event):
+        metric_observe("bot_mongo_command_seconds", event.duration_micros / 1e6, command=event.command_name)
+    
+    def failed(self, event):
+        metric_observe("bot_mongo_command_seconds", event.duration_micros / 1e6, command=event.command_name)
+        metric_inc("bot_mongo_command_failures_total", command=event.command_name)
+
+define_metric("bot_panel_requests_total", "counter", "SMS panel report requests by mirror and outcome", ("panel", "mirror", "outcome"))
+define_metric("bot_panel_request_seconds", "histogram", "Duration of successful SMS panel report requests", ("panel", "mirror"))
+define_metric("bot_panel_hedges_total", "counter", "Slow panel requests raced against another mirror", ("panel",))
+define_metric("bot_panel_logins_total", "counter", "Logins to SMS panels by outcome", ("panel", "outcome"))
+define_metric("bot_sms_checks_total", "counter", "SMS checks for a number by outcome", ("panel", "outcome"))
+define_metric("bot_sms_check_seconds", "histogram", "Duration of SMS checks including failover and hedging", ("panel",))
+define_metric("bot_number_handouts_total", "counter", "Numbers requested by users by outcome", ("outcome",))
+define_metric("bot_number_handout_seconds", "histogram", "Time from a number request until the number is shown")
+define_metric("bot_morning_call_checks_total", "counter", "OTP checks made by morning call monitors")
+define_metric("bot_morning_calls_total", "counter", "Finished morning calls by outcome", ("outcome",))
+define_metric("bot_otp_detection_seconds", "histogram", "Time from the SMS reaching the panel until its OTP is shown",
+              buckets=METRICS_OTP_BUCKETS)
+define_metric("bot_time_to_otp_seconds", "histogram", "Time from the number hand-out until its OTP is shown",
+              buckets=METRICS_OTP_BUCKETS)
+define_metric("bot_upload_numbers_total", "counter", "Uploaded numbers by outcome", ("outcome",))
+define_metric("bot_admin_job_seconds", "histogram", "Duration of admin jobs (uploads, cleanups, deletions)", ("kind", "status"),
+              buckets=METRICS_LATENCY_BUCKETS + (60, 300, 900))
+define_metric("bot_mongo_command_seconds", "histogram", "Duration of MongoDB commands", ("command",))
+define_metric("bot_mongo_command_failures_total", "counter", "Failed MongoDB commands", ("command",))
+define_metric("bot_database_health_checks_total", "counter", "Database health checks by status", ("status",))
+define_metric("bot_database_ping_seconds", "histogram", "Database ping time measured by the health check")
+define_metric("bot_telegram_calls_total", "counter", "Queued Bot API calls by method and outcome", ("method", "outcome"))
+define_metric("bot_event_loop_lag_seconds", "histogram", "Delay of the event-loop lag probe beyond its sleep")
+define_metric("bot_event_loop_stalls_total", "counter", "Times the watchdog found the event loop blocked")
+define_metric("bot_handler_seconds", "histogram", "Duration of Telegram update handlers", ("handler",))
+
+# === PROFILER ===
+# A probe task measures how late the event loop wakes it up; a watchdog thread watches the probe's
+# heartbeat and, when the loop is blocked longer than LOOP_STALL_THRESHOLD, captures the stack of
+# the loop thread, i.e. the code that is blocking it. Every update handler is timed as well.
+# /perf shows the results.
+loop_lag_samples = deque(maxlen=int(300 / LOOP_LAG_INTERVAL))  # Last 5 minutes of lag probes
+loop_stalls = deque(maxlen=PERF_STALLS_KEPT)  # {'at', 'blocked', 'stack'} captured by the watchdog
+handler_timings = {}  # handler name -> {'count', 'total', 'max', 'slow'}
+loop_heartbeat = {'at': time.monotonic(), 'stall_reported': False}
+
+def _loop_watchdog(loop_thread_id, stop_event):
+    """Watchdog thread: capture the loop thread's stack while the lag probe is overdue"""
+    check_interval = min(LOOP_LAG_INTERVAL, LOOP_STALL_THRESHOLD) / 2
+    while not stop_event.wait(check_interval):
+        blocked = time.monotonic() - loop_heartbeat['at'] - LOOP_LAG_INTERVAL
+        if blocked < LOOP_STALL_THRESHOLD or loop_heartbeat['stall_reported']:
+            continue
+        loop_heartbeat['stall_reported'] = True
+        frame = sys._current_frames().get(loop_thread_id)
+        stack = "".join(traceback.format_stack(frame)[-8:]) if frame is not None else "(no frame)"
+        loop_stalls.append({'at': datetime.now(TIMEZONE), 'blocked': blocked, 'stack': stack})
+        metric_inc("bot_event_loop_stalls_total")
+        logging.warning(f"🐢 Event loop blocked for {blocked:.2f}s, loop thread stack:\n{stack}")
+
+async def loop_lag_monitor_task(app):
+    """Background task probing event-loop lag, with the stall watchdog thread"""
+    loop = asyncio.get_running_loop()
+    stop_event = threading.Event()
+    loop_heartbeat['at'] = time.monotonic()
+    watchdog = threading.Thread(
+        target=_loop_watchdog, args=(threading.get_ident(), stop_event), name="loop-watchdog", daemon=True
+    )
+    watchdog.start()
+    logging.info("🩺 Event loop lag monitor started")
+    try:
+        while True:
+            loop_heartbeat['at'] = time.monotonic()
+            loop_heartbeat['stall_reported'] = False
+            started = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+            loop_lag_samples.append(lag)
+            metric_observe("bot_event_loop_lag_seconds", lag)
+            if lag > LOOP_LAG_WARNING:
+                logging.warning(f"🐢 Event loop lag {lag * 1000:.0f}ms")
+    except asyncio.CancelledError:
+        logging.info("🛑 Event loop lag monitor cancelled")
+    finally:
+        stop_event.set()
+
+def record_handler_time(name, duration):
+    timing = handler_timings.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0, 'slow': 0})
+    timing['count'] += 1
+    timing['total'] += duration
+    timing['max'] = max(timing['max'], duration)
+    metric_observe("bot_handler_seconds", duration, handler=name)
+    if duration > SLOW_HANDLER_THRESHOLD:
+        timing['slow'] += 1
+        logging.warning(f"🐢 Slow handler {name}: {duration:.2f}s")
+
+def timed_handler(callback):
+    """Wrap an update handler callback so its duration is recorded (and traced)"""
+    name = getattr(callback, "__name__", repr(callback))
+    
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.monotonic()
+        user = getattr(update, "effective_user", None)
+        try:
+            with trace_span(f"handler {name}", new_trace=True, user_id=user.id if user else ""):
+                return await callback(update, context)
+        finally:
+            record_handler_time(name, time.monotonic() - started)
+    return wrapper
+
+def instrument_handlers(app):
+    """Time every handler registered on the application"""
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = timed_handler(handler.callback)
+
+def _percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] if ordered else 0.0
+
+def perf_report_lines():
+    """Loop lag, captured stalls and the slowest handlers, for /perf"""
+    lines = ["🩺 **Performance**", ""]
+    if loop_lag_samples:
+        samples = list(loop_lag_samples)
+        lines.append(
+            f"⏱️ Loop lag (last {len(samples) * LOOP_LAG_INTERVAL:.0f}s): "
+            f"p50 {_percentile(samples, 50) * 1000:.0f}ms, p99 {_percentile(samples, 99) * 1000:.0f}ms, "
+            f"max {max(samples) * 1000:.0f}ms"
+        )
+    else:
+        lines.append("⏱️ Loop lag: no samples yet")
+    
+    lines.extend(["", f"🐢 Loop stalls over {LOOP_STALL_THRESHOLD:g}s: {len(loop_stalls)}"])
+    for stall in sorted(loop_stalls, key=lambda stall: stall['blocked'], reverse=True)[:5]:
+        # The innermost frame is the line that was running when the watchdog looked
+        innermost = stall['stack'].strip().splitlines()[-2:] if stall['stack'] else []
+        lines.append(f"• {stall['at'].strftime('%H:%M:%S')} blocked {stall['blocked']:.1f}s+")
+        lines.extend(f"  `{line.strip()[:80]}`" for line in innermost)
+    
+    lines.extend(["", "🐌 Slowest handlers (total time):"])
+    ranked = sorted(handler_timings.items(), key=lambda item: item[1]['total'], reverse=True)[:10]
+    if not ranked:
+        lines.append("• none yet")
+    for name, timing in ranked:
+        lines.append(
+            f"• `{name}` {timing['count']}x, avg {timing['total'] / timing['count']:.2f}s, "
+            f"max {timing['max']:.2f}s, {timing['slow']} slow"
+        )
+    return lines
+
+# === TRACING ===
+# Spans are dicts; the span currently open is kept in a context variable, so spans opened in
+# tasks created inside it (the morning-call monitor, hedged panel requests) become its children.
+# trace_span() only records inside a trace: update handlers and morning calls start one. Finished
+# spans are buffered and handed to the configured exporter every TRACE_EXPORT_INTERVAL seconds.
+TRACE_EXPORTER = (os.environ.get("BOT_TRACE_EXPORTER", TRACE_EXPORTER or "") or "").lower() or None
+current_span = contextvars.ContextVar("current_span", default=None)
+finished_spans = deque(maxlen=TRACE_BUFFER_SIZE)
+trace_http_session = None
+
+@contextlib.contextmanager
+def trace_span(name, new_trace=False, **attributes):
+    """Record a span around the block; with new_trace it starts a trace when none is open"""
+    parent = current_span.get()
+    if TRACE_EXPORTER is None or (parent is None and (not new_trace or random.random() >= TRACE_SAMPLE_RATE)):
+        yield None
+        return
+    span = _new_span(name, parent, attributes)
+    token = current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        set_span_error(span, e)
+        raise
+    finally:
+        current_span.reset(token)
+        finish_span(span)
+
+def _new_span(name, parent, attributes):
+    return {
+        'trace_id': parent['trace_id'] if parent else os.urandom(16).hex(),
+        'span_id': os.urandom(8).hex(),
+        'parent_id': parent['span_id'] if parent else None,
+        'name': name,
+        'start': time.time_ns(),
+        'end': None,
+        'attributes': attributes,
+        'error': None,
+    }
+
+def finish_span(span):
+    span['end'] = time.time_ns()
+    finished_spans.append(span)
+
+def set_span_error(span, error):
+    if span is not None:
+        span['error'] = "cancelled" if isinstance(error, asyncio.CancelledError) else str(error) or type(error).__name__
+
+def annotate_span(**attributes):
+    """Add attributes to the span currently open (if any)"""
+    span = current_span.get()
+    if span is not None:
+        span['attributes'].update(attributes)
+
+def trace_future(name, future, **attributes):
+    """Record a span that ends when a future (e.g. from queue_bot_call) is resolved"""
+    parent = current_span.get()
+    if parent is None or TRACE_EXPORTER is None:
+        return future
+    span = _new_span(name, parent, attributes)
+    
+    def done(future):
+        if future.cancelled() or future.exception() is not None:
+            set_span_error(span, future.exception() if not future.cancelled() else asyncio.CancelledError())
+        finish_span(span)
+    future.add_done_callback(done)
+    return future
+
+def _span_record(span):
+    return {
+        'trace_id': span['trace_id'],
+        'span_id': span['span_id'],
+        'parent_id': span['parent_id'],
+        'name': span['name'],
+        'start': datetime.fromtimestamp(span['start'] / 1e9, TIMEZONE).isoformat(),
+        'duration_ms': round((span['end'] - span['start']) / 1e6, 3),
+        'attributes': span['attributes'],
+        'error': span['error'],
+    }
+
+def _append_json_lines(path, records):
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, default=str) + "\n")
+
+async def export_spans_stdout(spans):
+    for span in spans:
+        record = _span_record(span)
+        status = f" ❌ {record['error']}" if record['error'] else ""
+        logging.info(f"🧵 {record['trace_id'][:8]} {record['name']} {record['duration_ms']:.1f}ms {record['attributes']}{status}")
+
+async def export_spans_json(spans):
+    await asyncio.to_thread(_append_json_lines, TRACE_FILE, [_span_record(span) for span in spans])
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+async def export_spans_otlp(spans):
+    """Send spans to an OTLP/HTTP endpoint in the JSON encoding"""
+    global trace_http_session
+    if trace_http_session is None or trace_http_session.closed:
+        trace_http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+    payload = {"resourceSpans": [{
+        "resource": {"attributes": [
+            {"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}},
+            {"key": "service.instance.id", "value": {"stringValue": WORKER_ID}},
+        ]},
+        "scopeSpans": [{"scope": {"name": "bot"}, "spans": [{
+            "traceId": span['trace_id'],
+            "spanId": span['span_id'],
+            "parentSpanId": span['parent_id'] or "",
+            "name": span['name'],
+            "kind": 1,
+            "startTimeUnixNano": str(span['start']),
+            "endTimeUnixNano": str(span['end']),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span['attributes'].items()],
+            "status": {"code": 2, "message": span['error']} if span['error'] else {"code": 1},
+        } for span in spans]}],
+    }]}
+    async with trace_http_session.post(TRACE_OTLP_ENDPOINT, json=payload) as response:
+        if response.status >= 400:
+            raise RuntimeError(f"OTLP endpoint answered {response.status}: {(await response.text())[:200]}")
+
+TRACE_EXPORTERS = {
+    "stdout": export_spans_stdout,
+    "json": export_spans_json,
+    "otlp": export_spans_otlp,
+}
+
+def register_trace_exporter(name, exporter):
+    """Add an exporter: an async function taking a list of finished span dicts"""
+    TRACE_EXPORTERS[name] = exporter
+
+async def flush_spans():
+    spans = list(finished_spans)
+    finished_spans.clear()
+    if not spans:
+        return
+    try:
+        await TRACE_EXPORTERS[TRACE_EXPORTER](spans)
+    except Exception as e:
+        logging.warning(f"⚠️ Could not export {len(spans)} span(s) with the {TRACE_EXPORTER} exporter: {e}")
+
+async def trace_export_task(app):
+    """Background task handing finished spans to the exporter"""
+    global TRACE_EXPORTER
+    if TRACE_EXPORTER not in TRACE_EXPORTERS:
+        logging.error(f"❌ Unknown trace exporter {TRACE_EXPORTER!r}, tracing disabled (choose from {', '.join(TRACE_EXPORTERS)})")
+        TRACE_EXPORTER = None
+        return
+    logging.info(f"🧵 Tracing with the {TRACE_EXPORTER} exporter")
+    try:
+        while True:
+            await asyncio.sleep(TRACE_EXPORT_INTERVAL)
+            await flush_spans()
+    except asyncio.CancelledError:
+        await flush_spans()
+        logging.info("🛑 Trace exporter cancelled")
+    finally:
+        if trace_http_session is not None:
+            await trace_http_session.close()
+
 # === SESSION MANAGEMENT FUNCTIONS ===
 def reload_config_session():
-    """Reload SMS API session from config file"""
-    global CURRENT_SMS_API_COOKIE
+    """Reload SMS API session from config file (only applied when config.py has a new session)"""
+    global CURRENT_SMS_API_COOKIE, CONFIG_SMS_API_COOKIE
     try:
         import importlib
         import config
         importlib.reload(config)
         
+        if config.SMS_API_COOKIE == CONFIG_SMS_API_COOKIE:
+            return False
+        CONFIG_SMS_API_COOKIE = config.SMS_API_COOKIE
+        
         old_session = CURRENT_SMS_API_COOKIE
         CURRENT_SMS_API_COOKIE = config.SMS_API_COOKIE
         
@@ -78,6 +502,30 @@ def reload_config_session():
         logging.error(f"❌ Failed to reload config session: {e}")
         return False
 
+# === SMS API CLIENT ===
+# All panel requests share one connection pool, and every panel has its own limiter, so bulk work
+# such as /cleanup cannot open unbounded connections and a slow panel cannot hold up the others.
+sms_http_session = None
+
+def get_sms_http_session():
+    """Shared aiohttp session for SMS panel requests (keeps connections alive between checks)"""
+    global sms_http_session
+    if sms_http_session is None or sms_http_session.closed:
+        sms_http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=30),
+            connector=aiohttp.TCPConnector(
+                limit=SMS_API_MAX_CONCURRENCY * max(1, len(SMS_PANELS)),
+                limit_per_host=SMS_API_MAX_CONCURRENCY,
+                keepalive_timeout=30
+            )
+        )
+    return sms_http_session
+
+async def close_sms_http_session():
+    """Close the shared SMS panel session on shutdown"""
+    if sms_http_session is not None and not sms_http_session.closed:
+        await sms_http_session.close()
+
 def get_current_sms_cookie():
     """Get the current active SMS API cookie"""
     return CURRENT_SMS_API_COOKIE
@@ -91,150 +539,973 @@ def update_runtime_session(new_cookie):
     logging.info(f"🔑 Old: {old_session[:20]}...{old_session[-10:]}")
     logging.info(f"🔑 New: {CURRENT_SMS_API_COOKIE[:20]}...{CURRENT_SMS_API_COOKIE[-10:]}")
 
-def update_config_file_session(new_cookie):
-    """Update the session in config.py file"""
+# === SMS PANELS ===
+# Each configured panel (SMS_PANELS) is an SmsPanel with one or more mirrors. A check goes to the
+# healthiest mirror first; if it has not answered SMS_PANEL_HEDGE_DELAY seconds after it was sent
+# (time queued on the panel's limiter does not count) the next mirror is raced against it, unless
+# the limiter is saturated, and failures fail over to the remaining mirrors. Mirrors with
+# SMS_PANEL_FAILURE_THRESHOLD consecutive failures are only tried last for SMS_PANEL_COOLDOWN.
+class PanelError(Exception):
+    """A panel request failed; failure_type is what notify_admins_api_failure reports"""
+    def __init__(self, failure_type, base_url=None):
+        super().__init__(failure_type)
+        self.failure_type = failure_type
+        self.base_url = base_url
+
+class SmsPanel:
+    """An SMS panel and its mirrors - subclasses implement fetch() for the panel's API"""
+    
+    def __init__(self, panel_config):
+        self.name = panel_config["name"]
+        self.config = panel_config
+        self.ranges = [keyword.lower() for keyword in panel_config.get("ranges", [])]
+        self.prefixes = list(panel_config.get("prefixes", []))
+        self.limiter = asyncio.Semaphore(panel_config.get("max_concurrency", SMS_API_MAX_CONCURRENCY))
+        self.mirrors = []
+        seen = set()
+        for mirror_config in panel_config["mirrors"]:
+            # Mirrors that are the same server with the same session would only double the load
+            key = (mirror_config["base_url"], mirror_config.get("cookie") or SMS_API_COOKIE)
+            if key in seen:
+                continue
+            seen.add(key)
+            base_url = mirror_config["base_url"].rstrip("/")
+            self.mirrors.append({
+                'key': f"{self.name} {base_url}",  # Name of the mirror in the session store
+                'base_url': base_url,
+                'cookie': mirror_config.get("cookie"),  # None: use the runtime session
+                'username': mirror_config.get("username") or panel_config.get("username"),
+                'password': mirror_config.get("password") or panel_config.get("password"),
+                'sessions': [],  # Logged-in sessions: {'cookie', 'created_at'}, oldest first
+                'next_session': 0,
+                'login_task': None,
+                'login_failed_at': float("-inf"),  # No failed login yet (monotonic time can be small at boot)
+                'latency': None,  # Moving average of successful response times
+                'failures': 0,  # Consecutive failures
+                'down_until': 0,
+                'requests': 0,
+                'errors': 0,
+            })
+    
+    def cookie_for(self, mirror):
+        """Session cookie for the next request: the login pool in rotation, else the configured one"""
+        sessions = mirror['sessions']
+        if sessions:
+            mirror['next_session'] = (mirror['next_session'] + 1) % len(sessions)
+            return sessions[mirror['next_session']]['cookie']
+        return mirror['cookie'] or get_current_sms_cookie()
+    
+    def can_login(self, mirror):
+        return bool(mirror['username'] and mirror['password'])
+    
+    def add_session(self, mirror, cookie, created_at):
+        """Add a logged-in session to the mirror's pool, returns the sessions that were pushed out"""
+        sessions = mirror['sessions']
+        sessions.append({'cookie': cookie, 'created_at': created_at})
+        sessions.sort(key=lambda session: session['created_at'])
+        dropped = sessions[:-SMS_SESSION_POOL_SIZE] if len(sessions) > SMS_SESSION_POOL_SIZE else []
+        del sessions[:len(dropped)]
+        return dropped
+    
+    def session_since(self, mirror, since):
+        """Cookie of the newest pooled session if it was logged in after `since` (time.time()), else None"""
+        sessions = mirror['sessions']
+        if sessions and sessions[-1]['created_at'] >= since:
+            return sessions[-1]['cookie']
+        return None
+    
+    def drop_session(self, mirror, cookie):
+        """Remove a session from the pool, returns True if it was in it"""
+        for session in mirror['sessions']:
+            if session['cookie'] == cookie:
+                mirror['sessions'].remove(session)
+                return True
+        return False
+    
+    async def refresh_session(self, mirror):
+        """Log in to a mirror once for all concurrent callers, returns the new cookie or None"""
+        task = mirror['login_task']
+        if task is None or task.done():
+            if time.monotonic() - mirror['login_failed_at'] < SMS_SESSION_REFRESH_INTERVAL:
+                return None  # Do not hammer the panel with logins that keep failing
+            task = mirror['login_task'] = asyncio.create_task(self._login_and_store(mirror))
+        return await asyncio.shield(task)
+    
+    async def _login_and_store(self, mirror):
+        try:
+            cookie = await self.login(mirror)
+        except Exception as e:
+            mirror['login_failed_at'] = time.monotonic()
+            metric_inc("bot_panel_logins_total", panel=self.name, outcome="failed")
+            logging.error(f"❌ Login to SMS panel {self.name} ({mirror['base_url']}) failed: {e}")
+            asyncio.create_task(notify_admins_api_failure(f"login_failed: {e}", self.name, mirror['base_url']))
+            return None
+        metric_inc("bot_panel_logins_total", panel=self.name, outcome="ok")
+        created_at = time.time()
+        for session in self.add_session(mirror, cookie, created_at):
+            await forget_panel_session(mirror, session['cookie'])
+        await save_panel_session(mirror, cookie, created_at)
+        logging.info(f"🔑 Logged in to SMS panel {self.name} ({mirror['base_url']}), {len(mirror['sessions'])} session(s) pooled")
+        return cookie
+    
+    async def login(self, mirror):
+        """Log in with the mirror's credentials and return the session cookie (raises on failure)"""
+        raise NotImplementedError
+    
+    def ranked_mirrors(self):
+        """Mirrors in the order to try them: healthy ones by latency and recent failures first"""
+        now = time.monotonic()
+        def score(mirror):
+            return (mirror['down_until'] > now, (mirror['latency'] or 1.0) * (1 + mirror['failures']))
+        return sorted(self.mirrors, key=score)
+    
+    def _record(self, mirror, latency=None, error=None):
+        mirror['requests'] += 1
+        outcome = "ok" if error is None else error.failure_type.split(":")[0]
+        metric_inc("bot_panel_requests_total", panel=self.name, mirror=mirror['base_url'], outcome=outcome)
+        if error is None:
+            metric_observe("bot_panel_request_seconds", latency, panel=self.name, mirror=mirror['base_url'])
+            mirror['failures'] = 0
+            mirror['down_until'] = 0
+            mirror['latency'] = latency if mirror['latency'] is None else 0.8 * mirror['latency'] + 0.2 * latency
+            return
+        mirror['errors'] += 1
+        mirror['failures'] += 1
+        if mirror['failures'] >= SMS_PANEL_FAILURE_THRESHOLD:
+            mirror['down_until'] = time.monotonic() + SMS_PANEL_COOLDOWN
+            logging.warning(f"⚠️ SMS panel {self.name} mirror {mirror['base_url']} failing ({error.failure_type}), cooling down")
+    
+    async def _fetch_from(self, mirror, phone_number, date_str, request):
+        with trace_span("panel.request", mirror=mirror['base_url']):
+            return await self._fetch_limited(mirror, phone_number, date_str, request)
+    
+    async def _fetch_limited(self, mirror, phone_number, date_str, request):
+        async with self.limiter:
+            started = time.monotonic()
+            # The hedge clock of check_sms starts now that the request is actually sent
+            request['sent_at'] = started
+            request['sent'].set()
+            try:
+                result = await self.fetch(mirror, phone_number, date_str)
+            except PanelError as e:
+                self._record(mirror, error=e)
+                raise
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                error = PanelError("connection_timeout", mirror['base_url'])
+                self._record(mirror, error=error)
+                raise error
+            except Exception as e:
+                logging.error(f"Error checking SMS on {mirror['base_url']}: {e}")
+                error = PanelError(f"connection_error: {str(e)}", mirror['base_url'])
+                self._record(mirror, error=error)
+                raise error
+            self._record(mirror, latency=time.monotonic() - started)
+            return result
+    
+    async def check_sms(self, phone_number, date_str):
+        """Fetch the SMS data for a number, hedging slow mirrors and failing over on errors"""
+        mirrors = self.ranked_mirrors()
+        pending = {}  # task -> mirror
+        next_mirror = 0
+        last_error = None
+        
+        def launch():
+            nonlocal next_mirror
+            mirror = mirrors[next_mirror]
+            next_mirror += 1
+            request = {'sent': asyncio.Event(), 'sent_at': None}
+            pending[asyncio.create_task(self._fetch_from(mirror, phone_number, date_str, request))] = mirror
+            return request
+        
+        hedged_request = launch()  # The request a hedge would race, None once hedging is given up
+        try:
+            while pending:
+                waiting = set(pending)
+                sent_waiter = None
+                timeout = None
+                if hedged_request is not None and next_mirror < len(mirrors):
+                    if hedged_request['sent_at'] is None:
+                        # Still queued on the limiter - the mirror is not slow, the panel is busy
+                        sent_waiter = asyncio.create_task(hedged_request['sent'].wait())
+                        waiting.add(sent_waiter)
+                    else:
+                        timeout = max(0, hedged_request['sent_at'] + SMS_PANEL_HEDGE_DELAY - time.monotonic())
+                try:
+                    done, _ = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    if sent_waiter is not None:
+                        sent_waiter.cancel()
+                done.discard(sent_waiter)
+                if not done:
+                    if timeout is None:
+                        continue  # Sent now, start the hedge clock
+                    if self.limiter.locked():
+                        # A hedge would only queue behind the other requests on the panel
+                        logging.info(f"🏁 SMS panel {self.name} slow, but at its concurrency limit - not hedging")
+                        hedged_request = None
+                        continue
+                    logging.info(f"🏁 SMS panel {self.name} slow, hedging with {mirrors[next_mirror]['base_url']}")
+                    metric_inc("bot_panel_hedges_total", panel=self.name)
+                    hedged_request = launch()
+                    continue
+                for task in done:
+                    pending.pop(task)
+                    try:
+                        return task.result()
+                    except PanelError as e:
+                        last_error = e
+                if not pending and next_mirror < len(mirrors):
+                    hedged_request = launch()  # Fail over to the next mirror
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def fetch(self, mirror, phone_number, date_str):
+        """Request the SMS data for a number from one mirror, raising PanelError on failure"""
+        raise NotImplementedError
+
+class IntsAgentPanel(SmsPanel):
+    """Panels running the "ints/agent" SMS CDR reports (MSI SMS, Seven1Tel, Sniper SMS)"""
+    
+    LOGIN_PATH = "/ints/login"
+    SIGNIN_PATH = "/ints/signin"
+    
+    async def login(self, mirror):
+        """Sign in through the panel's login form (username, password and math captcha)"""
+        login_url = f"{mirror['base_url']}{self.config.get('login_path', self.LOGIN_PATH)}"
+        signin_url = f"{mirror['base_url']}{self.config.get('signin_path', self.SIGNIN_PATH)}"
+        headers = {'User-Agent': SMS_API_HEADERS['User-Agent'], 'Referer': login_url}
+        
+        # A separate cookie jar, so the login gets a session id of its own
+        async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=20), cookie_jar=aiohttp.CookieJar(unsafe=True)
+        ) as session:
+            async with session.get(login_url, headers=headers) as response:
+                login_page = await response.text()
+            
+            form = {'username': mirror['username'], 'password': mirror['password']}
+            answer = solve_math_captcha(login_page)
+            if answer is not None:
+                form['capt'] = answer
+            
+            async with session.post(signin_url, data=form, headers=headers) as response:
+                page = await response.text()
+                final_url = str(response.url)
+            if response.status != 200 or 'type="password"' in page.lower() or final_url.rstrip("/").endswith("login"):
+                raise PanelError("login_rejected", mirror['base_url'])
+            
+            cookies = session.cookie_jar.filter_cookies(response.url)
+            if not cookies:
+                raise PanelError("login_without_session", mirror['base_url'])
+            return "; ".join(f"{name}={morsel.value}" for name, morsel in cookies.items())
+    
+    def build_params(self, phone_number, date_str):
+        params = dict(SMS_API_PARAMS_TEMPLATE)
+        params.update({
+            'fdate1': f"{date_str} 00:00:00",
+            'fdate2': f"{datetime.now(TIMEZONE).strftime('%Y-%m-%d %H:%M:%S')}",  # Current time
+            'fnum': phone_number,  # Filter by phone number
+            '_': str(int(datetime.now().timestamp() * 1000))
+        })
+        return params
+    
+    async def fetch(self, mirror, phone_number, date_str):
+        params = self.build_params(phone_number, date_str)
+        url = f"{mirror['base_url']}{self.config.get('endpoint', SMS_API_ENDPOINT)}"
+        
+        # One retry when the session was expired but a new one could be logged in or loaded from config.py
+        fresh_cookie = None
+        for attempt in range(2):
+            cookie = fresh_cookie or self.cookie_for(mirror)
+            requested_at = time.time()
+            headers = dict(SMS_API_HEADERS)
+            headers['Referer'] = f"{mirror['base_url']}/ints/agent/SMSCDRReports"
+            headers['Cookie'] = cookie
+            
+            logging.info(f"Making API request to: {url}")
+            logging.info(f"With params: {params}")
+            async with get_sms_http_session().get(url, params=params, headers=headers) as response:
+                logging.info(f"API response status: {response.status}")
+                response_text = await response.text()
+            
+            if response.status != 200:
+                logging.error(f"SMS API error: {response.status}, Response: {response_text}")
+                # Check if it's an access blocked error
+                if 'direct script access not allowed' in response_text.lower():
+                    raise PanelError("access_blocked", mirror['base_url'])
+                raise PanelError(f"HTTP {response.status}", mirror['base_url'])
+            
+            # Always try to parse as JSON regardless of content type
+            try:
+                data = json.loads(response_text)
+                logging.info(f"API response data: {data}")
+                return data
+            except ValueError as json_error:
+                logging.error(f"JSON parsing failed: {json_error}")
+                logging.info(f"Response text: {response_text[:500]}...")  # Log first 500 chars
+            
+            # Try to extract JSON from HTML response
+            if 'aaData' in response_text:
+                try:
+                    # Find JSON part in the response
+                    start = response_text.find('{')
+                    end = response_text.rfind('}') + 1
+                    if start != -1 and end != 0:
+                        data = json.loads(response_text[start:end])
+                        logging.info(f"Extracted JSON data: {data}")
+                        return data
+                except Exception as extract_error:
+                    logging.error(f"Failed to extract JSON: {extract_error}")
+                return None
+            
+            # Check if we got redirected to login page
+            if 'login' not in response_text.lower():
+                return None
+            logging.error(f"❌ SMS API session expired on {mirror['base_url']} - redirected to login page")
+            logging.error(f"🔑 Current session: {cookie[:20]}...{cookie[-10:]}")
+            
+            if self.drop_session(mirror, cookie):
+                await forget_panel_session(mirror, cookie)
+            
+            # Log in again when the mirror has credentials
+            if self.can_login(mirror):
+                fresh_cookie = None
+                if attempt == 0:
+                    # A check that was answered late reuses the login another check already made
+                    fresh_cookie = self.session_since(mirror, requested_at) or await self.refresh_session(mirror)
+                if fresh_cookie:
+                    logging.info(f"✅ Logged in again, retrying API call...")
+                    asyncio.create_task(notify_admins_api_recovery(
+                        f"Session of {self.name} ({mirror['base_url']}) expired - logged in again automatically"
+                    ))
+                    continue
+                raise PanelError("session_expired", mirror['base_url'])
+            
+            # Try to reload session from config file (only helps mirrors using the runtime session)
+            if attempt == 0 and mirror['cookie'] is None and reload_config_session():
+                logging.info(f"✅ Session reloaded, retrying API call...")
+                # Notify admins of successful auto-recovery
+                asyncio.create_task(notify_admins_api_recovery())
+                continue
+            logging.error(f"❌ Config reload failed - need manual session update")
+            raise PanelError("session_expired", mirror['base_url'])
+
+INTS_CAPTCHA_PATTERN = re.compile(r"what\s+is\s+(\d+)\s*([-+*xX×])\s*(\d+)", re.IGNORECASE)
+
+def solve_math_captcha(html):
+    """Answer the "What is 4 + 7 = ?" captcha of a panel login page, or None if there is none"""
+    match = INTS_CAPTCHA_PATTERN.search(html)
+    if not match:
+        return None
+    left, operator, right = int(match.group(1)), match.group(2), int(match.group(3))
+    if operator == "+":
+        return str(left + right)
+    if operator == "-":
+        return str(left - right)
+    return str(left * right)
+
+# Panel implementations by SMS_PANELS "type"; MSI SMS, Seven1Tel and Sniper SMS all serve the
+# same ints/agent reports, so their names are aliases of one implementation
+PANEL_TYPES = {
+    "ints_agent": IntsAgentPanel,
+    "msi": IntsAgentPanel,
+    "seven1tel": IntsAgentPanel,
+    "sniper": IntsAgentPanel,
+}
+
+sms_panels = {}  # name -> SmsPanel, in SMS_PANELS order
+panel_route_cache = {}  # number -> panel name, least recently used first
+panel_route_db = None
+
+def init_sms_panels(db=None):
+    """Create the configured panels (db is used to look up the range of a number for routing)"""
+    global panel_route_db
+    panel_route_db = db
+    sms_panels.clear()
+    panel_route_cache.clear()
+    for panel_config in SMS_PANELS:
+        sms_panels[panel_config["name"]] = PANEL_TYPES[panel_config.get("type", "ints_agent")](panel_config)
+    logging.info(f"📡 SMS panels: {', '.join(f'{name} ({len(panel.mirrors)} mirror(s))' for name, panel in sms_panels.items())}")
+
+def panel_health_lines():
+    """One line per panel mirror with its health, for /checkapi"""
+    if not sms_panels:
+        init_sms_panels(panel_route_db)
+    now = time.monotonic()
+    lines = []
+    for name, panel in sms_panels.items():
+        for mirror in panel.mirrors:
+            status = "🔴 cooling down" if mirror['down_until'] > now else "🟡 failing" if mirror['failures'] else "🟢"
+            latency = f"{mirror['latency'] * 1000:.0f}ms" if mirror['latency'] is not None else "n/a"
+            sessions = f", {len(mirror['sessions'])} login session(s)" if panel.can_login(mirror) else ""
+            lines.append(
+                f"{status} {name} `{mirror['base_url']}` - {latency}, {mirror['errors']}/{mirror['requests']} errors{sessions}"
+            )
+    return lines
+
+def route_panel(number, range_val=""):
+    """Name of the panel owning a number: by range keyword, then longest number prefix, else the first panel"""
+    range_val = (range_val or "").lower()
+    if range_val:
+        for name, panel in sms_panels.items():
+            if any(keyword in range_val for keyword in panel.ranges):
+                return name
+    best_name, best_length = None, 0
+    for name, panel in sms_panels.items():
+        for prefix in panel.prefixes:
+            if len(prefix) > best_length and number.lstrip("+").startswith(prefix):
+                best_name, best_length = name, len(prefix)
+    return best_name or next(iter(sms_panels))
+
+async def panel_for_number(phone_number):
+    """SmsPanel to check a number on (routes are cached; the number's range is read from MongoDB once)"""
+    if not sms_panels:
+        init_sms_panels(panel_route_db)
+    if len(sms_panels) == 1:
+        return next(iter(sms_panels.values()))
+    
+    name = panel_route_cache.pop(phone_number, None)
+    if name is None:
+        range_val = ""
+        if panel_route_db is not None:
+            try:
+                doc = await panel_route_db[COLLECTION_NAME].find_one({"number": phone_number}, {"range": 1, "_id": 0})
+                range_val = (doc or {}).get("range", "")
+            except Exception as e:
+                logging.warning(f"⚠️ Could not look up the range of {phone_number}: {e}")
+        name = route_panel(phone_number, range_val)
+    panel_route_cache[phone_number] = name
+    while len(panel_route_cache) > PANEL_ROUTE_CACHE_SIZE:
+        del panel_route_cache[next(iter(panel_route_cache))]
+    return sms_panels[name]
+
+# === PANEL SESSIONS ===
+# Logged-in panel sessions are kept in the local user store (panel_sessions table) so a restart
+# does not need a new login, and the session set with /updatesms survives restarts without
+# rewriting config.py. The refresh task keeps every mirror with credentials at
+# SMS_SESSION_POOL_SIZE sessions and replaces sessions before they reach SMS_SESSION_MAX_AGE.
+RUNTIME_SESSION_KEY = "runtime"  # Store entry for the /updatesms session
+
+async def save_panel_session(mirror, cookie, created_at):
     try:
-        with open('config.py', 'r') as f:
-            config_content = f.read()
-        
-        # Replace the SMS_API_COOKIE line
-        import re
-        config_content = re.sub(
-            r'SMS_API_COOKIE = "[^"]*"',
-            f'SMS_API_COOKIE = "{new_cookie}"',
-            config_content
-        )
-        
-        with open('config.py', 'w') as f:
-            f.write(config_content)
-        
-        logging.info(f"✅ Config file updated with new session")
+        await run_in_user_store(_panel_session_put, mirror['key'], cookie, created_at)
+    except Exception as e:
+        logging.error(f"❌ Failed to save panel session: {e}")
+
+async def forget_panel_session(mirror, cookie):
+    try:
+        await run_in_user_store(_panel_session_delete, mirror['key'], cookie)
+    except Exception as e:
+        logging.error(f"❌ Failed to forget panel session: {e}")
+
+async def save_runtime_session(cookie):
+    """Keep the /updatesms session across restarts, tied to the config.py session it replaced"""
+    try:
+        await run_in_user_store(_panel_session_delete, RUNTIME_SESSION_KEY)
+        await run_in_user_store(_panel_session_put, RUNTIME_SESSION_KEY, json.dumps([CONFIG_SMS_API_COOKIE, cookie]), time.time())
         return True
     except Exception as e:
-        logging.error(f"❌ Failed to update config file: {e}")
+        logging.error(f"❌ Failed to save runtime session: {e}")
         return False
 
+async def restore_panel_sessions():
+    """Load saved sessions into the panel pools and restore the /updatesms session"""
+    try:
+        rows = await run_in_user_store(_panel_sessions_load)
+    except Exception as e:
+        logging.error(f"❌ Failed to load panel sessions: {e}")
+        return
+    
+    mirrors = {mirror['key']: (panel, mirror) for panel in sms_panels.values() for mirror in panel.mirrors}
+    now = time.time()
+    restored = 0
+    for key, cookie, created_at in rows:
+        if key == RUNTIME_SESSION_KEY:
+            config_cookie, runtime_cookie = json.loads(cookie)
+            # Only while config.py still has the session /updatesms replaced
+            if config_cookie == CONFIG_SMS_API_COOKIE and runtime_cookie != get_current_sms_cookie():
+                update_runtime_session(runtime_cookie)
+                logging.info("🔑 Restored the SMS session set with /updatesms")
+            continue
+        entry = mirrors.get(key)
+        if entry is None or now - created_at >= SMS_SESSION_MAX_AGE:
+            await run_in_user_store(_panel_session_delete, key, cookie)
+            continue
+        entry[0].add_session(entry[1], cookie, created_at)
+        restored += 1
+    if restored:
+        logging.info(f"🔑 Restored {restored} saved SMS panel session(s)")
+
+async def refresh_panel_sessions():
+    """Top up every login pool and replace sessions that are about to expire"""
+    now = time.time()
+    for panel in sms_panels.values():
+        for mirror in panel.mirrors:
+            if not panel.can_login(mirror):
+                continue
+            fresh = [session for session in mirror['sessions'] if now - session['created_at'] < SMS_SESSION_MAX_AGE]
+            # Log in the replacements first so the pool never runs empty
+            for _ in range(SMS_SESSION_POOL_SIZE - len(fresh)):
+                if await panel.refresh_session(mirror) is None:
+                    break
+
+async def panel_session_task(app):
+    """Background task that keeps the panel login pools filled and fresh"""
+    logging.info("🔑 Panel session task started")
+    try:
+        while True:
+            try:
+                await refresh_panel_sessions()
+            except Exception as e:
+                logging.error(f"❌ Panel session refresh failed: {e}")
+            await asyncio.sleep(SMS_SESSION_REFRESH_INTERVAL)
+    except asyncio.CancelledError:
+        logging.info("🛑 Panel session task cancelled")
+
+# === OUTBOUND MESSAGE DISPATCHER ===
+# Every Bot API send/edit that is not a direct reply goes through one priority queue so OTP
+# deliveries overtake user notices and admin alerts, and bursts stay under Telegram's limits
+# (TELEGRAM_GLOBAL_RATE overall, TELEGRAM_PER_CHAT_RATE per chat). Pending edits to the same
+# message are coalesced: only the newest text is sent.
+PRIORITY_OTP = 0  # OTP deliveries and OTP message edits
+PRIORITY_USER = 1  # Other messages to users (timeouts, notices)
+PRIORITY_ADMIN = 2  # Admin alerts and reports
+
+outbound_queue = None  # asyncio.PriorityQueue of (priority, seq, item), created by the dispatcher task
+outbound_seq = itertools.count()  # FIFO order within a priority
+outbound_pending_edits = {}  # (chat_id, message_id) -> queued edit item
+outbound_chat_buckets = {}  # chat_id -> token bucket
+outbound_parked = {}  # seq -> (timer handle, queue entry) of items waiting to be requeued
+outbound_deliveries = {}  # in-flight delivery task -> its item (the loop only keeps weak references to tasks)
+outbound_global_bucket = None
+
+def _new_token_bucket(rate, capacity, now):
+    """Create a token bucket dict refilling at `rate` tokens per second"""
+    return {'rate': rate, 'capacity': capacity, 'tokens': capacity, 'updated': now}
+
+def _token_bucket_wait(bucket, now):
+    """Refill the bucket and return seconds until one token is available"""
+    bucket['tokens'] = min(bucket['capacity'], bucket['tokens'] + (now - bucket['updated']) * bucket['rate'])
+    bucket['updated'] = now
+    if bucket['tokens'] >= 1:
+        return 0
+    return (1 - bucket['tokens']) / bucket['rate']
+
+def _chat_bucket(chat_id, now):
+    """Get (or create) the token bucket for a chat"""
+    bucket = outbound_chat_buckets.get(chat_id)
+    if bucket is None:
+        bucket = _new_token_bucket(TELEGRAM_PER_CHAT_RATE, TELEGRAM_PER_CHAT_BURST, now)
+        outbound_chat_buckets[chat_id] = bucket
+    return bucket
+
+def _prune_chat_buckets(now):
+    """Drop buckets of chats that have been idle long enough to be full again"""
+    idle_after = TELEGRAM_PER_CHAT_BURST / TELEGRAM_PER_CHAT_RATE
+    for chat_id in [c for c, b in outbound_chat_buckets.items() if now - b['updated'] > idle_after]:
+        del outbound_chat_buckets[chat_id]
+
+def _retrieve_outbound_exception(future):
+    """Mark a fire-and-forget future's exception as retrieved (the dispatcher already logged it)"""
+    if not future.cancelled():
+        future.exception()
+
+# === MESSAGE RENDER CACHE ===
+# Hash of the text + keyboard last shown in each message we edit. Edits that would render the
+# same content are dropped before reaching Telegram ("message is not modified" still counts
+# against limits), and edits the dispatcher sends to one message are spaced at least
+# EDIT_MIN_INTERVAL seconds apart (OTP edits are never held back).
+message_render_cache = {}  # (chat_id, message_id) -> {'hash': str, 'sent_at': loop time of the last dispatched edit}
+
+def _render_hash(text, reply_markup=None, parse_mode=None):
+    """Hash what a message would look like after an edit"""
+    markup_json = reply_markup.to_json() if reply_markup is not None else ""
+    return hashlib.sha1(f"{parse_mode}\x00{text}\x00{markup_json}".encode('utf-8')).hexdigest()
+
+def remember_message_render(chat_id, message_id, text, reply_markup=None, parse_mode=None, dispatched=False):
+    """Record what a message currently shows; dispatched marks an edit the dispatcher just sent"""
+    key = (chat_id, message_id)
+    # Re-insert so the dict stays in least-recently-rendered order
+    previous = message_render_cache.pop(key, None)
+    message_render_cache[key] = {
+        'hash': _render_hash(text, reply_markup, parse_mode),
+        'sent_at': asyncio.get_running_loop().time() if dispatched else (previous or {}).get('sent_at'),
+    }
+    while len(message_render_cache) > RENDER_CACHE_SIZE:
+        del message_render_cache[next(iter(message_render_cache))]
+
+def _is_noop_edit(kwargs):
+    """True if an edit would not change what the message already shows"""
+    rendered = message_render_cache.get((kwargs.get("chat_id"), kwargs.get("message_id")))
+    return rendered is not None and rendered['hash'] == _render_hash(
+        kwargs.get("text"), kwargs.get("reply_markup"), kwargs.get("parse_mode")
+    )
+
+def _completed_future(result=None):
+    """Return a future that is already resolved"""
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(result)
+    return future
+
+def queue_bot_call(bot, method, priority=PRIORITY_USER, **kwargs):
+    """Queue a Bot API call (send_message / edit_message_text) and return a future for its result.
+    
+    Await the future when the result matters; otherwise it can be left alone - failures are logged
+    by the dispatcher. Falls back to a direct call when the dispatcher is not running.
+    """
+    loop = asyncio.get_running_loop()
+    
+    edit_key = None
+    if method == "edit_message_text":
+        edit_key = (kwargs.get("chat_id"), kwargs.get("message_id"))
+        pending = outbound_pending_edits.get(edit_key)
+        if pending is not None:
+            # Not sent yet - just replace what will be sent
+            pending['kwargs'] = kwargs
+            return pending['future']
+        if _is_noop_edit(kwargs):
+            return _completed_future()
+    
+    if outbound_queue is None:
+        future = asyncio.ensure_future(_call_bot_direct(bot, method, kwargs))
+        future.add_done_callback(_retrieve_outbound_exception)
+        return future
+    
+    future = loop.create_future()
+    future.add_done_callback(_retrieve_outbound_exception)
+    item = {
+        'bot': bot,
+        'method': method,
+        'kwargs': kwargs,
+        'chat_id': kwargs.get("chat_id"),
+        'edit_key': edit_key,
+        'future': future,
+        'attempts': 0,
+        'not_before': 0,
+    }
+    if edit_key:
+        outbound_pending_edits[edit_key] = item
+    outbound_queue.put_nowait((priority, next(outbound_seq), item))
+    return future
+
+async def _call_bot_direct(bot, method, kwargs):
+    """Call the Bot API without the dispatcher, keeping the render cache up to date"""
+    result = await getattr(bot, method)(**kwargs)
+    if method == "edit_message_text":
+        remember_message_render(kwargs.get("chat_id"), kwargs.get("message_id"),
+                                kwargs.get("text"), kwargs.get("reply_markup"), kwargs.get("parse_mode"))
+    return result
+
+def _requeue_outbound(priority, seq, item, delay):
+    """Put an item back on the queue after `delay` seconds"""
+    loop = asyncio.get_running_loop()
+    handle = loop.call_later(delay, _unpark_outbound, seq)
+    outbound_parked[seq] = (handle, (priority, seq, item))
+
+def _unpark_outbound(seq):
+    _, entry = outbound_parked.pop(seq)
+    if outbound_queue is None:
+        _give_up_outbound(entry[2], RuntimeError("outbound dispatcher stopped"))
+        return
+    outbound_queue.put_nowait(entry)
+
+def _give_up_outbound(item, error):
+    """Log an undeliverable item and fail its future"""
+    logging.error(f"❌ Giving up on {item['method']} to chat {item['chat_id']} after {item['attempts']} attempt(s): {error}")
+    if not item['future'].done():
+        item['future'].set_exception(error)
+
+async def _deliver_outbound(priority, seq, item, final=False):
+    """Perform one queued Bot API call, retrying 429s and network errors (final: no retry, at shutdown)"""
+    method = item['method']
+    chat_id = item['chat_id']
+    item['attempts'] += 1
+    
+    kwargs = item['kwargs']
+    try:
+        if item['edit_key'] and _is_noop_edit(kwargs):
+            # Became identical to what is shown while it waited in the queue
+            result, sent = None, False
+        else:
+            result, sent = await getattr(item['bot'], method)(**kwargs), True
+            metric_inc("bot_telegram_calls_total", method=method, outcome="ok")
+        if item['edit_key']:
+            remember_message_render(item['chat_id'], kwargs.get("message_id"), kwargs.get("text"),
+                                    kwargs.get("reply_markup"), kwargs.get("parse_mode"), dispatched=sent)
+        if not item['future'].done():
+            item['future'].set_result(result)
+        return
+    except RetryAfter as e:
+        retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+        metric_inc("bot_telegram_calls_total", method=method, outcome="retry_after")
+        logging.warning(f"⏳ Telegram flood limit for chat {chat_id}, retrying {method} in {retry_after}s")
+        # Hold back everything else for this chat too
+        now = asyncio.get_running_loop().time()
+        bucket = _chat_bucket(chat_id, now)
+        bucket['tokens'] = min(bucket['tokens'], 1 - retry_after * bucket['rate'])
+        error = e
+        delay = retry_after
+    except BadRequest as e:
+        if "message is not modified" in str(e).lower():
+            # Same content is already shown - nothing to do
+            metric_inc("bot_telegram_calls_total", method=method, outcome="not_modified")
+            remember_message_render(item['chat_id'], kwargs.get("message_id"),
+                                    kwargs.get("text"), kwargs.get("reply_markup"), kwargs.get("parse_mode"))
+            if not item['future'].done():
+                item['future'].set_result(None)
+            return
+        logging.error(f"❌ Failed to deliver {method} to chat {chat_id}: {e}")
+        metric_inc("bot_telegram_calls_total", method=method, outcome="bad_request")
+        if not item['future'].done():
+            item['future'].set_exception(e)
+        return
+    except (TimedOut, NetworkError) as e:
+        logging.warning(f"⚠️ Network error delivering {method} to chat {chat_id} (attempt {item['attempts']}): {e}")
+        metric_inc("bot_telegram_calls_total", method=method, outcome="network_error")
+        error = e
+        delay = 2 ** item['attempts']
+    except Exception as e:
+        logging.error(f"❌ Failed to deliver {method} to chat {chat_id}: {e}")
+        metric_inc("bot_telegram_calls_total", method=method, outcome="error")
+        if not item['future'].done():
+            item['future'].set_exception(e)
+        return
+    
+    if final or outbound_queue is None or item['attempts'] >= OUTBOUND_MAX_RETRIES:
+        # No retries once the dispatcher has stopped
+        _give_up_outbound(item, error)
+        return
+    
+    edit_key = item['edit_key']
+    if edit_key:
+        newer = outbound_pending_edits.get(edit_key)
+        if newer is not None:
+            # A newer edit of this message is already queued - it supersedes this one
+            if not item['future'].done():
+                item['future'].set_result(None)
+            return
+        outbound_pending_edits[edit_key] = item
+    
+    item['not_before'] = asyncio.get_running_loop().time() + delay
+    _requeue_outbound(priority, seq, item, delay)
+
+async def outbound_dispatcher_task(app):
+    """Background task that paces queued Bot API calls by priority and rate limits"""
+    global outbound_queue, outbound_global_bucket
+    loop = asyncio.get_running_loop()
+    outbound_queue = asyncio.PriorityQueue()
+    outbound_global_bucket = _new_token_bucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE, loop.time())
+    delivered = 0
+    
+    logging.info("📤 Outbound message dispatcher started")
+    try:
+        while True:
+            priority, seq, item = await outbound_queue.get()
+            now = loop.time()
+            
+            # Respect retry-after, per-chat pacing and the per-message edit interval without
+            # blocking other chats; a deferred edit keeps absorbing newer edits of its message
+            wait = max(item['not_before'] - now, _token_bucket_wait(_chat_bucket(item['chat_id'], now), now))
+            last_edit = message_render_cache.get(item['edit_key'], {}).get('sent_at')
+            if priority != PRIORITY_OTP and last_edit is not None:
+                wait = max(wait, last_edit + EDIT_MIN_INTERVAL - now)
+            if wait > 0:
+                _requeue_outbound(priority, seq, item, wait)
+                continue
+            
+            global_wait = _token_bucket_wait(outbound_global_bucket, now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                now = loop.time()
+                _token_bucket_wait(outbound_global_bucket, now)
+            
+            outbound_global_bucket['tokens'] -= 1
+            _chat_bucket(item['chat_id'], now)['tokens'] -= 1
+            
+            # From here on a new edit of the same message must be queued separately
+            if item['edit_key'] and outbound_pending_edits.get(item['edit_key']) is item:
+                del outbound_pending_edits[item['edit_key']]
+            
+            delivery = asyncio.create_task(_deliver_outbound(priority, seq, item))
+            outbound_deliveries[delivery] = item
+            delivery.add_done_callback(lambda task: outbound_deliveries.pop(task, None))
+            
+            delivered += 1
+            if delivered % 1000 == 0:
+                _prune_chat_buckets(now)
+    except asyncio.CancelledError:
+        logging.info("🛑 Outbound message dispatcher cancelled")
+        # Shutting down - make one quick attempt (without retries) at whatever is still queued
+        # or waiting to be requeued; new calls go straight to the Bot API from here on
+        remaining = []
+        while not outbound_queue.empty():
+            remaining.append(outbound_queue.get_nowait())
+        for handle, entry in outbound_parked.values():
+            handle.cancel()
+            remaining.append(entry)
+        outbound_parked.clear()
+        outbound_pending_edits.clear()
+        outbound_queue = None
+        in_flight = dict(outbound_deliveries)
+        if remaining or in_flight:
+            logging.info(f"📤 Flushing {len(remaining)} queued and {len(in_flight)} in-flight message(s) before shutdown")
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*in_flight, *[_deliver_outbound(*entry, final=True) for entry in remaining],
+                                   return_exceptions=True),
+                    timeout=5
+                )
+            except asyncio.TimeoutError:
+                for item in [*in_flight.values(), *(entry[2] for entry in remaining)]:
+                    if not item['future'].done():
+                        _give_up_outbound(item, TimedOut("not delivered before shutdown"))
+        raise
+    finally:
+        outbound_queue = None
+
+# === ADMIN EVENT DIGEST ===
+# Admin-facing events (expired morning calls, SMS API failures/recoveries, cleanup results) are
+# buffered and sent as one digest per admin every ADMIN_DIGEST_INTERVAL seconds, or sooner when
+# ADMIN_DIGEST_MAX_EVENTS pile up or an urgent event arrives. Recording an event never waits.
+ADMIN_EVENT_TYPES = {
+    # kind: (digest heading, hint shown under the group)
+    'api_failure': ("🚨 SMS API failures", "🔧 Use /checkapi, then /updatesms PHPSESSID=new_session or /reloadsession"),
+    'api_recovery': ("✅ SMS API recoveries", None),
+    'expired': ("⏰ OTP monitoring expired (numbers returned to pool)", None),
+    'cleanup': ("🧹 Background cleanup", None),
+}
+ADMIN_DIGEST_SAMPLE_LINES = 10  # Lines listed per event type before "... and N more"
+
+admin_event_buffer = []  # (kind, time, text) waiting for the next digest
+admin_digest_wakeup = None  # asyncio.Event set by the digest task; wakes it early
+
+def record_admin_event(kind, text, urgent=False):
+    """Buffer an event for the next admin digest"""
+    admin_event_buffer.append((kind, datetime.now(TIMEZONE), text))
+    if admin_digest_wakeup is not None and (urgent or len(admin_event_buffer) >= ADMIN_DIGEST_MAX_EVENTS):
+        admin_digest_wakeup.set()
+
+def build_admin_digest(events):
+    """Build the digest text for a list of buffered events"""
+    grouped = {}
+    for kind, event_time, text in events:
+        grouped.setdefault(kind, []).append((event_time, text))
+    
+    first_time = events[0][1].strftime('%H:%M:%S')
+    last_time = events[-1][1].strftime('%H:%M:%S')
+    lines = [f"📋 Admin Digest - {len(events)} event(s), {first_time} → {last_time}"]
+    
+    for kind, kind_events in grouped.items():
+        heading, hint = ADMIN_EVENT_TYPES.get(kind, (f"ℹ️ {kind}", None))
+        lines.append("")
+        lines.append(f"{heading}: {len(kind_events)}")
+        for event_time, text in kind_events[:ADMIN_DIGEST_SAMPLE_LINES]:
+            lines.append(f"• {event_time.strftime('%H:%M:%S')} {text}")
+        if len(kind_events) > ADMIN_DIGEST_SAMPLE_LINES:
+            lines.append(f"• ... and {len(kind_events) - ADMIN_DIGEST_SAMPLE_LINES} more")
+        if hint:
+            lines.append(hint)
+    
+    digest = "\n".join(lines)
+    # Stay under Telegram's 4096 character message limit
+    if len(digest) > 4000:
+        digest = digest[:3990] + "\n..."
+    return digest
+
+def flush_admin_digest(bot):
+    """Send everything buffered so far as one digest per admin"""
+    if not admin_event_buffer:
+        return
+    
+    events = admin_event_buffer[:]
+    admin_event_buffer.clear()
+    digest = build_admin_digest(events)
+    
+    for admin_id in ADMIN_IDS:
+        queue_bot_call(
+            bot,
+            "send_message",
+            priority=PRIORITY_ADMIN,
+            chat_id=admin_id,
+            text=digest
+        )
+    logging.info(f"📢 Admin digest with {len(events)} event(s) queued for {len(ADMIN_IDS)} admin(s)")
+
+async def admin_digest_task(app):
+    """Background task that flushes the admin event buffer on an interval or when woken"""
+    global admin_digest_wakeup
+    admin_digest_wakeup = asyncio.Event()
+    logging.info("📋 Admin digest task started")
+    
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(admin_digest_wakeup.wait(), timeout=ADMIN_DIGEST_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            admin_digest_wakeup.clear()
+            
+            try:
+                flush_admin_digest(app.bot)
+            except Exception as e:
+                logging.error(f"❌ Failed to send admin digest: {e}")
+    except asyncio.CancelledError:
+        logging.info("🛑 Admin digest task cancelled")
+        # Do not lose what is already buffered
+        flush_admin_digest(app.bot)
+        raise
+    finally:
+        admin_digest_wakeup = None
+
 # === ADMIN NOTIFICATION FUNCTIONS ===
-async def notify_admins_api_failure(failure_type):
+async def notify_admins_api_failure(failure_type, panel_name=None, base_url=None):
     """Notify all admins about SMS API failure with rate limiting"""
     try:
-        # Rate limiting - only send notification once per 10 minutes for same failure type
+        # Rate limiting - only report once per 10 minutes for same failure type
         current_time = datetime.now(TIMEZONE)
-        if failure_type in last_api_failure_notification:
-            time_diff = (current_time - last_api_failure_notification[failure_type]).total_seconds()
+        rate_key = (failure_type, panel_name)
+        if rate_key in last_api_failure_notification:
+            time_diff = (current_time - last_api_failure_notification[rate_key]).total_seconds()
             if time_diff < 600:  # 10 minutes
                 logging.info(f"🔇 API failure notification rate limited for {failure_type}")
                 return
         
-        last_api_failure_notification[failure_type] = current_time
-        
-        from telegram import Bot
-        bot = Bot(token=TOKEN)
+        last_api_failure_notification[rate_key] = current_time
         
-        current_time_str = current_time.strftime('%Y-%m-%d %H:%M:%S')
         current_session = get_current_sms_cookie()
+        base_url = base_url or SMS_API_BASE_URL
         
         if failure_type == "session_expired":
-            message = (
-                f"🚨 **SMS API Session Expired**\n\n"
-                f"⏰ **Time**: {current_time_str}\n"
-                f"🔑 **Current Session**: `{current_session[:20]}...{current_session[-10:]}`\n"
-                f"📡 **Endpoint**: {SMS_API_BASE_URL}\n\n"
-                f"❌ **Issue**: Session expired - redirected to login\n"
-                f"🔄 **Auto Recovery**: Failed (config has same session)\n\n"
-                f"🔧 **Required Action**:\n"
-                f"• Get fresh session from SMS panel\n"
-                f"• Use `/updatesms PHPSESSID=new_session`\n"
-                f"• Or update config.py and use `/reloadsession`\n\n"
-                f"⚠️ **Impact**: OTP detection currently not working"
-            )
+            message = f"Session expired (redirected to login), auto-reload from config did not help - session {current_session[:20]}...{current_session[-10:]}"
         elif failure_type == "connection_error":
-            message = (
-                f"🚨 **SMS API Connection Failed**\n\n"
-                f"⏰ **Time**: {current_time_str}\n"
-                f"📡 **Endpoint**: {SMS_API_BASE_URL}\n\n"
-                f"❌ **Issue**: Cannot connect to SMS API server\n"
-                f"🔧 **Possible Causes**:\n"
-                f"• Server is down\n"
-                f"• Network connectivity issues\n"
-                f"• Firewall blocking requests\n\n"
-                f"💡 **Suggestions**:\n"
-                f"• Check server status\n"
-                f"• Use `/checkapi` to test connection\n"
-                f"• Verify network connectivity\n\n"
-                f"⚠️ **Impact**: OTP detection currently not working"
-            )
+            message = f"Cannot connect to {base_url} (server down, network or firewall)"
         elif failure_type == "access_blocked":
-            message = (
-                f"🚨 **SMS API Access Blocked**\n\n"
-                f"⏰ **Time**: {current_time_str}\n"
-                f"🔑 **Session**: `{current_session[:20]}...{current_session[-10:]}`\n"
-                f"📡 **Endpoint**: {SMS_API_BASE_URL}\n\n"
-                f"❌ **Issue**: Direct script access not allowed\n"
-                f"🔧 **Required Action**:\n"
-                f"• Login to SMS panel manually\n"
-                f"• Get fresh session cookie\n"
-                f"• Update using `/updatesms PHPSESSID=new_session`\n\n"
-                f"⚠️ **Impact**: OTP detection currently not working"
-            )
+            message = f"Direct script access not allowed - log in to the panel and refresh the session {current_session[:20]}...{current_session[-10:]}"
         else:
-            message = (
-                f"🚨 **SMS API Error**\n\n"
-                f"⏰ **Time**: {current_time_str}\n"
-                f"📡 **Endpoint**: {SMS_API_BASE_URL}\n"
-                f"❌ **Issue**: {failure_type}\n\n"
-                f"🔧 **Suggestion**: Use `/checkapi` to diagnose\n"
-                f"⚠️ **Impact**: OTP detection may not be working"
-            )
+            message = f"{failure_type} ({base_url})"
+        if panel_name and len(SMS_PANELS) > 1:
+            message = f"[{panel_name}] {message}"
         
-        # Send to all admins
-        for admin_id in ADMIN_IDS:
-            try:
-                await bot.send_message(
-                    chat_id=admin_id,
-                    text=message,
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                logging.info(f"📢 API failure notification sent to admin {admin_id}")
-            except Exception as e:
-                logging.error(f"❌ Failed to notify admin {admin_id}: {e}")
+        # API failures stop OTP detection - send the digest right away
+        record_admin_event('api_failure', message, urgent=True)
+        logging.info(f"📢 API failure reported to admin digest: {failure_type}")
                 
     except Exception as e:
         logging.error(f"❌ Failed to send admin notifications: {e}")
 
-async def notify_admins_api_recovery():
+async def notify_admins_api_recovery(message=None):
     """Notify all admins about successful API recovery"""
     try:
-        from telegram import Bot
-        bot = Bot(token=TOKEN)
-        
-        current_time = datetime.now(TIMEZONE).strftime('%Y-%m-%d %H:%M:%S')
         current_session = get_current_sms_cookie()
         
-        message = (
-            f"✅ **SMS API Auto-Recovery Successful**\n\n"
-            f"⏰ **Time**: {current_time}\n"
-            f"🔑 **New Session**: `{current_session[:20]}...{current_session[-10:]}`\n"
-            f"📡 **Endpoint**: {SMS_API_BASE_URL}\n\n"
-            f"🔄 **What Happened**:\n"
-            f"• Session expired and was detected\n"
-            f"• Auto-reloaded from config.py file\n"
-            f"• API connection restored\n\n"
-            f"✅ **Status**: OTP detection fully operational\n"
-            f"💡 **Tip**: Use `/checkapi` to verify health"
+        record_admin_event(
+            'api_recovery',
+            message or f"Session expired and was auto-reloaded from config.py - new session {current_session[:20]}...{current_session[-10:]}"
         )
-        
-        # Send to all admins
-        for admin_id in ADMIN_IDS:
-            try:
-                await bot.send_message(
-                    chat_id=admin_id,
-                    text=message,
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                logging.info(f"📢 API recovery notification sent to admin {admin_id}")
-            except Exception as e:
-                logging.error(f"❌ Failed to notify admin {admin_id}: {e}")
+        logging.info(f"📢 API recovery reported to admin digest")
                 
     except Exception as e:
         logging.error(f"❌ Failed to send recovery notifications: {e}")
@@ -402,8 +1673,9 @@ def clean_number(number):
         return str(int(number))
     return str(number).replace(" ", "").replace("-", "").replace(".", "")
 
+@functools.lru_cache(maxsize=4096)
 def extract_country_from_range(range_str):
-    """Extract country name from range string using intelligent parsing"""
+    """Extract country name from range string using intelligent parsing (cached - ranges repeat a lot)"""
     if not range_str:
         return None
     
@@ -446,6 +1718,291 @@ def detect_country_code(number, range_str=None):
     
     return None
 
+# === VERIFIED USER STORE ===
+# Verified users are kept in a single SQLite file (WAL mode) instead of one JSON file per user.
+# The store is only touched from one dedicated thread, so the event loop never blocks on disk
+# I/O and the sqlite connection is never shared between threads.
+user_store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="user-store")
+user_store_conn = None
+
+def _user_store_open():
+    """Open the user store, creating the file and schema if needed (store thread only)"""
+    global user_store_conn
+    if user_store_conn is None:
+        store_dir = os.path.dirname(USER_STORE_FILE)
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+        
+        conn = sqlite3.connect(USER_STORE_FILE, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS verified_users ("
+            "user_id INTEGER PRIMARY KEY, "
+            "username TEXT, "
+            "first_name TEXT, "
+            "last_name TEXT, "
+            "verified_at TEXT, "
+            "status TEXT)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS channel_membership ("
+            "user_id INTEGER PRIMARY KEY, "
+            "is_member INTEGER NOT NULL, "
+            "checked_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS panel_sessions ("
+            "mirror TEXT NOT NULL, "
+            "cookie TEXT NOT NULL, "
+            "created_at REAL NOT NULL, "
+            "PRIMARY KEY (mirror, cookie))"
+        )
+        conn.commit()
+        user_store_conn = conn
+    return user_store_conn
+
+def _user_store_put(cache_data):
+    """Insert or replace a verified user (store thread only)"""
+    conn = _user_store_open()
+    conn.execute(
+        "INSERT OR REPLACE INTO verified_users "
+        "(user_id, username, first_name, last_name, verified_at, status) VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            cache_data["user_id"],
+            cache_data.get("username"),
+            cache_data.get("first_name"),
+            cache_data.get("last_name"),
+            cache_data.get("verified_at"),
+            cache_data.get("status", "verified"),
+        )
+    )
+    conn.commit()
+
+def _user_store_get(user_id):
+    """Get a verified user as a dict, or None (store thread only)"""
+    conn = _user_store_open()
+    row = conn.execute(
+        "SELECT user_id, username, first_name, last_name, verified_at, status "
+        "FROM verified_users WHERE user_id = ?",
+        (user_id,)
+    ).fetchone()
+    if not row:
+        return None
+    return dict(zip(("user_id", "username", "first_name", "last_name", "verified_at", "status"), row))
+
+def _membership_store_put(user_id, is_member, checked_at):
+    """Record a channel membership check result (store thread only)"""
+    conn = _user_store_open()
+    conn.execute(
+        "INSERT OR REPLACE INTO channel_membership (user_id, is_member, checked_at) VALUES (?, ?, ?)",
+        (user_id, 1 if is_member else 0, checked_at)
+    )
+    conn.commit()
+
+def _membership_store_get(user_id):
+    """Get the last channel membership check result, or None (store thread only)"""
+    conn = _user_store_open()
+    row = conn.execute(
+        "SELECT is_member, checked_at FROM channel_membership WHERE user_id = ?",
+        (user_id,)
+    ).fetchone()
+    if not row:
+        return None
+    return {'is_member': bool(row[0]), 'checked_at': row[1]}
+
+def _panel_sessions_load():
+    """All saved panel sessions as (mirror, cookie, created_at) rows (store thread only)"""
+    conn = _user_store_open()
+    return conn.execute("SELECT mirror, cookie, created_at FROM panel_sessions").fetchall()
+
+def _panel_session_put(mirror, cookie, created_at):
+    """Save a panel session (store thread only)"""
+    conn = _user_store_open()
+    conn.execute(
+        "INSERT OR REPLACE INTO panel_sessions (mirror, cookie, created_at) VALUES (?, ?, ?)",
+        (mirror, cookie, created_at)
+    )
+    conn.commit()
+
+def _panel_session_delete(mirror, cookie=None):
+    """Forget one panel session, or all sessions of a mirror (store thread only)"""
+    conn = _user_store_open()
+    if cookie is None:
+        conn.execute("DELETE FROM panel_sessions WHERE mirror = ?", (mirror,))
+    else:
+        conn.execute("DELETE FROM panel_sessions WHERE mirror = ? AND cookie = ?", (mirror, cookie))
+    conn.commit()
+
+def _user_store_migrate_json_files():
+    """Import legacy user_<id>.json cache files into the store and remove them (store thread only)"""
+    if not os.path.isdir(USER_CACHE_DIR):
+        return 0
+    
+    rows = []
+    migrated_files = []
+    with os.scandir(USER_CACHE_DIR) as entries:
+        for entry in entries:
+            if not (entry.name.startswith("user_") and entry.name.endswith(".json")):
+                continue
+            try:
+                with open(entry.path, 'r') as f:
+                    cache_data = json.load(f)
+                rows.append((
+                    int(cache_data["user_id"]),
+                    cache_data.get("username"),
+                    cache_data.get("first_name"),
+                    cache_data.get("last_name"),
+                    cache_data.get("verified_at"),
+                    cache_data.get("status", "verified"),
+                ))
+                migrated_files.append(entry.path)
+            except Exception as e:
+                logging.error(f"Skipping unreadable user cache file {entry.name}: {e}")
+    
+    if not rows:
+        return 0
+    
+    conn = _user_store_open()
+    # Keep entries written since the files were created; legacy files only fill the gaps
+    conn.executemany(
+        "INSERT OR IGNORE INTO verified_users "
+        "(user_id, username, first_name, last_name, verified_at, status) VALUES (?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    conn.commit()
+    
+    # Only delete the files once their rows are committed
+    for path in migrated_files:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.warning(f"Could not remove migrated user cache file {path}: {e}")
+    
+    return len(rows)
+
+def _user_store_compact():
+    """Fold the WAL back into the main file and reclaim free pages (store thread only)"""
+    conn = _user_store_open()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("VACUUM")
+
+def _user_store_close():
+    """Close the store connection (store thread only)"""
+    global user_store_conn
+    if user_store_conn is not None:
+        user_store_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        user_store_conn.close()
+        user_store_conn = None
+
+async def run_in_user_store(func, *args):
+    """Run a user store function on the dedicated store thread"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(user_store_executor, func, *args)
+
+async def init_user_store():
+    """Open the user store and migrate any legacy per-user JSON cache files"""
+    try:
+        await run_in_user_store(_user_store_open)
+        migrated = await run_in_user_store(_user_store_migrate_json_files)
+        if migrated:
+            logging.info(f"📦 Migrated {migrated} legacy user cache files into {USER_STORE_FILE}")
+        logging.info(f"✅ User store ready: {USER_STORE_FILE}")
+    except Exception as e:
+        logging.error(f"❌ Failed to initialize user store: {e}")
+
+async def close_user_store():
+    """Close the user store and stop its thread"""
+    try:
+        await run_in_user_store(_user_store_close)
+    except Exception as e:
+        logging.error(f"❌ Failed to close user store: {e}")
+    user_store_executor.shutdown(wait=True)
+
+async def background_user_store_compaction_task(app):
+    """Background task that periodically compacts the user store"""
+    logging.info("📦 User store compaction task started")
+    try:
+        while True:
+            await asyncio.sleep(USER_STORE_COMPACT_INTERVAL)
+            try:
+                await run_in_user_store(_user_store_compact)
+                logging.info("📦 User store compacted")
+            except Exception as e:
+                logging.error(f"❌ User store compaction failed: {e}")
+    except asyncio.CancelledError:
+        logging.info("🛑 User store compaction task cancelled")
+
+# === CHANNEL MEMBERSHIP CACHE ===
+# Results of get_chat_member for CHANNEL_ID, kept in memory and persisted in the user store.
+# "Member" results are trusted for MEMBERSHIP_POSITIVE_TTL and refreshed in the background
+# once they are older than MEMBERSHIP_REVALIDATE_AFTER; "not a member" results expire after
+# MEMBERSHIP_NEGATIVE_TTL so users who just joined are not kept waiting. The in-memory cache
+# keeps the MEMBERSHIP_CACHE_SIZE most recently used results; older ones are read from the store.
+membership_cache = {}  # user_id -> {'is_member': bool, 'checked_at': epoch seconds}, least recently used first
+membership_lookups = {}  # user_id -> in-flight get_chat_member task (shared by concurrent callers)
+membership_revalidations = {}  # user_id -> background refresh task
+
+def _remember_membership(user_id, entry):
+    """Cache a membership result as the most recently used one"""
+    membership_cache.pop(user_id, None)
+    membership_cache[user_id] = entry
+    while len(membership_cache) > MEMBERSHIP_CACHE_SIZE:
+        del membership_cache[next(iter(membership_cache))]
+
+async def _lookup_channel_membership(user_id, bot):
+    """Ask Telegram whether the user is in the channel and cache the answer"""
+    chat_member = await bot.get_chat_member(CHANNEL_ID, user_id)
+    is_member = chat_member.status in ("member", "administrator", "creator")
+    
+    checked_at = time.time()
+    _remember_membership(user_id, {'is_member': is_member, 'checked_at': checked_at})
+    try:
+        await run_in_user_store(_membership_store_put, user_id, is_member, checked_at)
+    except Exception as e:
+        logging.error(f"Error storing membership result for user {user_id}: {e}")
+    
+    return is_member
+
+async def _fetch_channel_membership(user_id, bot):
+    """Fetch membership from Telegram, sharing one request between concurrent callers"""
+    task = membership_lookups.get(user_id)
+    if task is None:
+        task = asyncio.create_task(_lookup_channel_membership(user_id, bot))
+        membership_lookups[user_id] = task
+        task.add_done_callback(lambda _: membership_lookups.pop(user_id, None))
+    return await asyncio.shield(task)
+
+async def _revalidate_channel_membership(user_id, bot):
+    """Refresh a cached membership result in the background"""
+    try:
+        await _fetch_channel_membership(user_id, bot)
+    except Exception as e:
+        logging.warning(f"Background membership refresh failed for user {user_id}: {e}")
+    finally:
+        membership_revalidations.pop(user_id, None)
+
+async def is_channel_member(user_id, bot):
+    """Check channel membership, answering from the cache whenever the result is fresh"""
+    entry = membership_cache.get(user_id)
+    if entry is None:
+        try:
+            entry = await run_in_user_store(_membership_store_get, user_id)
+        except Exception as e:
+            logging.error(f"Error reading membership result for user {user_id}: {e}")
+    
+    if entry:
+        _remember_membership(user_id, entry)
+        age = time.time() - entry['checked_at']
+        if entry['is_member'] and age < MEMBERSHIP_POSITIVE_TTL:
+            if age > MEMBERSHIP_REVALIDATE_AFTER and user_id not in membership_revalidations:
+                membership_revalidations[user_id] = asyncio.create_task(_revalidate_channel_membership(user_id, bot))
+            return True
+        if not entry['is_member'] and age < MEMBERSHIP_NEGATIVE_TTL:
+            return False
+    
+    return await _fetch_channel_membership(user_id, bot)
+
 # === KEYBOARDS ===
 def join_channel_keyboard():
     return InlineKeyboardMarkup([
@@ -561,9 +2118,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # Check channel membership for new user
-        chat_member = await context.bot.get_chat_member(CHANNEL_ID, user_id)
-        
-        if chat_member.status in ("member", "administrator", "creator"):
+        if await is_channel_member(user_id, context.bot):
             # Store user data in database
             db = context.bot_data["db"]
             users_coll = db[USERS_COLLECTION]
@@ -615,13 +2170,11 @@ async def check_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
         first_name = query.from_user.first_name
         last_name = query.from_user.last_name
         
-        # Check if user is already verified in database
+        # Check if user is already verified (local user store or database)
         db = context.bot_data["db"]
         users_coll = db[USERS_COLLECTION]
         
-        existing_user = await users_coll.find_one({"user_id": user_id})
-        
-        if existing_user:
+        if await is_user_verified(user_id, context):
             # User already verified, proceed directly
             await query.edit_message_text(
                 "✅ Welcome back Tella Bot! You are already verified.\n\n"
@@ -631,9 +2184,7 @@ async def check_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # Check channel membership for new user
-        chat_member = await context.bot.get_chat_member(CHANNEL_ID, user_id)
-        
-        if chat_member.status in ['member', 'administrator', 'creator']:
+        if await is_channel_member(user_id, context.bot):
             # Store user data in database
             user_data = {
                 "user_id": user_id,
@@ -665,14 +2216,8 @@ async def check_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("❌ Error checking channel membership. Please try again.", show_alert=True)
 
 async def create_user_cache(user_id, user_data):
-    """Create a cache file for verified user using config directory"""
+    """Store a verified user in the local user store"""
     try:
-        cache_dir = USER_CACHE_DIR
-        if not os.path.exists(cache_dir):
-            os.makedirs(cache_dir)
-        
-        cache_file = os.path.join(cache_dir, f"user_{user_id}.json")
-        
         cache_data = {
             "user_id": user_id,
             "username": user_data.get("username"),
@@ -682,17 +2227,20 @@ async def create_user_cache(user_id, user_data):
             "status": "verified"
         }
         
-        with open(cache_file, 'w') as f:
-            json.dump(cache_data, f, indent=2)
+        await run_in_user_store(_user_store_put, cache_data)
         
-        logging.info(f"Cache file created for user {user_id}")
+        logging.info(f"User store entry created for user {user_id}")
     except Exception as e:
-        logging.error(f"Error creating cache file for user {user_id}: {e}")
+        logging.error(f"Error storing user {user_id} in user store: {e}")
 
 async def is_user_verified(user_id, context):
-    """Check if user is verified (database or cache)"""
+    """Check if user is verified (local user store or database)"""
     try:
-        # First check database
+        # First check local user store - no network round trip
+        if await run_in_user_store(_user_store_get, user_id):
+            return True
+        
+        # Then check database
         db = context.bot_data.get("db")
         if db is not None:
             users_coll = db[USERS_COLLECTION]
@@ -700,11 +2248,6 @@ async def is_user_verified(user_id, context):
             if user:
                 return True
         
-        # Then check cache file
-        cache_file = os.path.join(USER_CACHE_DIR, f"user_{user_id}.json")
-        if os.path.exists(cache_file):
-            return True
-        
         return False
     except Exception as e:
         logging.error(f"Error checking user verification: {e}")
@@ -722,6 +2265,7 @@ async def request_number(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def send_number(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    started = time.monotonic()
     await query.answer()
     country_code = query.data.split('_', 1)[1]
     
@@ -731,12 +2275,12 @@ async def send_number(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # PERFORMANCE OPTIMIZATION: Try simple approach first for speed
     try:
-        # Fast path: Simple random selection without lookup
-        simple_pipeline = [
-            {"$match": {"country_code": country_code}},
-            {"$sample": {"size": 1}}
-        ]
-        results = await coll.aggregate(simple_pipeline).to_list(length=1)
+        # Fast path: score-weighted selection without lookup, skipping numbers other users are waiting on
+        busy_numbers = numbers_in_morning_calls()
+        with trace_span("mongo.sample_number", country_code=country_code):
+            results = await coll.aggregate(number_selection_pipeline(country_code, busy_numbers)).to_list(length=1)
+            if not results and busy_numbers:
+                results = await coll.aggregate(number_selection_pipeline(country_code)).to_list(length=1)
         result = results[0] if results else None
         
         if result:
@@ -759,7 +2303,7 @@ async def send_number(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Fallback: Full aggregation pipeline with lookup
         pipeline = [
-            {"$match": {"country_code": country_code}},
+            {"$match": available_numbers_filter(country_code)},
             {"$sample": {"size": 1}},
             {"$lookup": {
                 "from": COUNTRIES_COLLECTION,
@@ -787,8 +2331,7 @@ async def send_number(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if user_id in user_monitoring_sessions:
             old_sessions = list(user_monitoring_sessions[user_id].keys())
             for session_id in old_sessions:
-                if session_id in active_number_monitors:
-                    await stop_otp_monitoring(session_id)
+                await stop_otp_monitoring_session(session_id)
             user_monitoring_sessions[user_id].clear()
             logging.info(f"Cancelled {len(old_sessions)} previous sessions for user {user_id}")
         
@@ -807,11 +2350,17 @@ async def send_number(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Select an option:"
         )
         
-        sent_message = await query.edit_message_text(
-            message,
-            reply_markup=number_options_keyboard(number, country_code),
-            parse_mode=ParseMode.MARKDOWN
-        )
+        options_keyboard = number_options_keyboard(number, country_code)
+        annotate_span(phone_number=number, country_code=country_code)
+        with trace_span("telegram.show_number"):
+            sent_message = await query.edit_message_text(
+                message,
+                reply_markup=options_keyboard,
+                parse_mode=ParseMode.MARKDOWN
+            )
+        remember_message_render(query.message.chat_id, sent_message.message_id, message, options_keyboard, ParseMode.MARKDOWN)
+        metric_inc("bot_number_handouts_total", outcome="handed_out")
+        metric_observe("bot_number_handout_seconds", time.monotonic() - started)
         
         # Start OTP monitoring for this number (this will update the message with SMS if found)
         await start_otp_monitoring(
@@ -824,6 +2373,8 @@ async def send_number(update: Update, context: ContextTypes.DEFAULT_TYPE):
             query.from_user.id
         )
     else:
+        metric_inc("bot_number_handouts_total", outcome="none_available")
+        
         # Get country name for error message
         country_info = await countries_coll.find_one({"country_code": country_code})
         country_name = country_info["display_name"] if country_info else country_code
@@ -869,7 +2420,7 @@ async def change_number(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # First, let's see all available numbers for this country
     all_numbers_pipeline = [
-        {"$match": {"country_code": country_code}},
+        {"$match": available_numbers_filter(country_code)},
         {"$project": {"number": 1, "_id": 0}}
     ]
     all_numbers = await coll.aggregate(all_numbers_pipeline).to_list(length=None)
@@ -880,14 +2431,14 @@ async def change_number(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if current_number and current_number in all_number_list and len(all_number_list) > 1:
         # Exclude current number and get a different one
         pipeline = [
-            {"$match": {"country_code": country_code, "number": {"$ne": current_number}}},
+            {"$match": {**available_numbers_filter(country_code), "number": {"$ne": current_number}}},
             {"$sample": {"size": 1}}
         ]
         logging.info(f"Trying to get different number, excluding: {current_number}")
     else:
         # No current number or only one number available, get any random number
         pipeline = [
-            {"$match": {"country_code": country_code}},
+            {"$match": available_numbers_filter(country_code)},
             {"$sample": {"size": 1}}
         ]
         if current_number:
@@ -927,8 +2478,7 @@ async def change_number(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if user_id in user_monitoring_sessions:
             old_sessions = list(user_monitoring_sessions[user_id].keys())
             for session_id in old_sessions:
-                if session_id in active_number_monitors:
-                    await stop_otp_monitoring(session_id)
+                await stop_otp_monitoring_session(session_id)
             user_monitoring_sessions[user_id].clear()
             logging.info(f"Cancelled {len(old_sessions)} previous sessions for user {user_id}")
         
@@ -972,100 +2522,770 @@ async def change_number(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context,
             user_id
         )
-    else:
-        # No different numbers available for this country
-        if current_number:
-            # Check if we got the same number
-            if len(all_number_list) == 1:
-                logging.info(f"Only one number available for {country_code}: {all_number_list[0]}")
-                await query.answer(f"⚠️ Only one number available for {country_name}. Try another country.", show_alert=True)
-            else:
-                logging.info(f"No different number available, keeping current: {current_number}")
-                await query.answer(f"⚠️ No different number available for {country_name}. Available: {len(all_number_list)} numbers. Try another country.", show_alert=True)
-        else:
-            # No numbers available at all
-            keyboard = await countries_keyboard(db)
-            await query.edit_message_text(
-                f"⚠️ No numbers available for {country_name}.\n"
-                f"📱 All numbers for this country have been used (received OTPs).\n\n"
-                f"🌍 Please select another country:",
-                reply_markup=keyboard
-            )
+    else:
+        # No different numbers available for this country
+        if current_number:
+            # Check if we got the same number
+            if len(all_number_list) == 1:
+                logging.info(f"Only one number available for {country_code}: {all_number_list[0]}")
+                await query.answer(f"⚠️ Only one number available for {country_name}. Try another country.", show_alert=True)
+            else:
+                logging.info(f"No different number available, keeping current: {current_number}")
+                await query.answer(f"⚠️ No different number available for {country_name}. Available: {len(all_number_list)} numbers. Try another country.", show_alert=True)
+        else:
+            # No numbers available at all
+            keyboard = await countries_keyboard(db)
+            await query.edit_message_text(
+                f"⚠️ No numbers available for {country_name}.\n"
+                f"📱 All numbers for this country have been used (received OTPs).\n\n"
+                f"🌍 Please select another country:",
+                reply_markup=keyboard
+            )
+
+async def get_latest_sms_for_number(phone_number, date_str=None):
+    """Get the latest SMS for a phone number and extract OTP - OPTIMIZED"""
+    logging.info(f"Getting latest SMS for {phone_number}")
+    
+    # PERFORMANCE OPTIMIZATION: Use shorter timeout for initial checks
+    import asyncio
+    try:
+        sms_data = await asyncio.wait_for(
+            check_sms_for_number(phone_number, date_str), 
+            timeout=15.0  # 15 second timeout instead of 30
+        )
+    except asyncio.TimeoutError:
+        logging.warning(f"SMS check timed out for {phone_number} - returning None")
+        return None
+    
+    if sms_data and 'aaData' in sms_data and sms_data['aaData']:
+        logging.info(f"SMS data found for {phone_number}, processing {len(sms_data['aaData'])} rows")
+        
+        # PERFORMANCE OPTIMIZATION: Only process first few rows for initial check
+        rows_to_check = min(10, len(sms_data['aaData']))  # Limit to first 10 rows
+        
+        # Filter out summary rows and get actual SMS messages
+        sms_messages = []
+        for i, row in enumerate(sms_data['aaData'][:rows_to_check]):
+            if isinstance(row, list) and len(row) >= 6:
+                # Check if this is a real SMS message (not a summary row)
+                first_item = str(row[0])
+                if not first_item.startswith('0.') and not ',' in first_item and len(first_item) > 10:
+                    sms_messages.append({
+                        'datetime': row[0],
+                        'range': row[1],
+                        'number': row[2],
+                        'sender': row[3] if len(row) > 3 else 'Unknown',
+                        'message': row[5] if len(row) > 5 else 'No message content'
+                    })
+                    
+                    # PERFORMANCE OPTIMIZATION: Stop after finding first valid SMS with OTP
+                    test_otp = extract_otp_from_message(sms_messages[-1]['message'])
+                    if test_otp:
+                        logging.info(f"🚀 FAST OTP DETECTED for {phone_number}: {test_otp}")
+                        return {
+                            'sms': sms_messages[-1],
+                            'otp': test_otp,
+                            'total_messages': len(sms_messages)
+                        }
+        
+        logging.info(f"Found {len(sms_messages)} valid SMS messages for {phone_number}")
+        
+        if sms_messages:
+            # Get the latest SMS (first in the list since it's sorted by desc)
+            latest_sms = sms_messages[0]
+            logging.info(f"Latest SMS for {phone_number}: {latest_sms}")
+            
+            # Enhanced OTP extraction with more detailed logging
+            otp = extract_otp_from_message(latest_sms['message'])
+            if otp:
+                logging.info(f"🎯 OTP DETECTED for {phone_number}: {otp}")
+            else:
+                logging.info(f"❌ No OTP found in message: {latest_sms['message'][:100]}...")
+            
+            result = {
+                'sms': latest_sms,
+                'otp': otp,
+                'total_messages': len(sms_messages)
+            }
+            logging.info(f"Returning SMS info for {phone_number}: {result}")
+            return result
+    else:
+        logging.info(f"No SMS data found for {phone_number}")
+    
+    return None
+
+# === SESSION PERSISTENCE ===
+# Morning-call sessions and the admin upload flow are written through to MongoDB so a restart or
+# redeploy only pauses them: post_init reloads unexpired sessions and resumes their monitors with
+# the time they had left. Documents carry an `expires_at` TTL field, so MongoDB removes leftovers.
+session_store_db = None  # Set by init_session_store()
+
+def _as_local_time(value):
+    """Convert a datetime read back from MongoDB (naive UTC) to the bot timezone"""
+    if value.tzinfo is None:
+        value = pytz.utc.localize(value)
+    return value.astimezone(TIMEZONE)
+
+async def init_session_store(db):
+    """Remember the database used for session persistence and ensure its TTL indexes"""
+    global session_store_db
+    session_store_db = db
+    try:
+        await db[SESSIONS_COLLECTION].create_index("expires_at", expireAfterSeconds=0)
+        await db[SESSIONS_COLLECTION].create_index("user_id")
+        await db[BOT_STATE_COLLECTION].create_index("expires_at", expireAfterSeconds=0)
+    except Exception as e:
+        logging.warning(f"⚠️ Could not create session store indexes: {e}")
+
+async def persist_monitoring_session(session_id, user_id, session_data):
+    """Write a newly started morning-call session through to MongoDB"""
+    if session_store_db is None:
+        return
+    try:
+        await session_store_db[SESSIONS_COLLECTION].replace_one(
+            {"_id": session_id},
+            {
+                "_id": session_id,
+                "user_id": user_id,
+                "phone_number": session_data['phone_number'],
+                "message_id": session_data['message_id'],
+                "chat_id": session_data['chat_id'],
+                "country_code": session_data['country_code'],
+                "country_name": session_data['country_name'],
+                "start_time": session_data['start_time'],
+                "expires_at": session_data['start_time'] + timedelta(seconds=MORNING_CALL_TIMEOUT),
+                # Updater-only processes leave the session unowned for a worker to claim
+                "owner": WORKER_ID if runs_monitors else None,
+                "lease_expires_at": datetime.now(TIMEZONE) + timedelta(seconds=LEASE_TTL),
+            },
+            upsert=True
+        )
+    except Exception as e:
+        logging.error(f"❌ Failed to persist monitoring session {session_id}: {e}")
+
+async def forget_monitoring_sessions(session_ids):
+    """Remove stopped morning-call sessions from MongoDB"""
+    if session_store_db is None or not session_ids:
+        return
+    try:
+        await session_store_db[SESSIONS_COLLECTION].delete_many({"_id": {"$in": list(session_ids)}})
+    except Exception as e:
+        logging.error(f"❌ Failed to remove persisted sessions {session_ids}: {e}")
+
+async def warm_start_sessions(app):
+    """Reload unexpired morning-call sessions after a restart
+    
+    Monitoring processes claim the sessions through their leases; an updater-only process just
+    rebuilds its view of the sessions that workers are monitoring.
+    """
+    if session_store_db is None:
+        return 0
+    
+    try:
+        if runs_monitors:
+            resumed = await claim_monitoring_sessions(app)
+        else:
+            session_docs = await session_store_db[SESSIONS_COLLECTION].find(
+                {"expires_at": {"$gt": datetime.now(TIMEZONE)}}
+            ).sort("start_time", 1).to_list(length=None)
+            for doc in session_docs:
+                await _resume_session_doc(app, doc)
+            resumed = len(session_docs)
+    except Exception as e:
+        logging.error(f"❌ Failed to load persisted sessions: {e}")
+        return 0
+    
+    if resumed:
+        logging.info(f"♻️ Resumed {resumed} morning call session(s) after restart")
+    return resumed
+
+async def save_admin_flow(user_id):
+    """Write an admin's upload flow (state, manual numbers, pending CSV) through to MongoDB"""
+    if session_store_db is None:
+        return
+    try:
+        coll = session_store_db[BOT_STATE_COLLECTION]
+        doc_id = f"admin_flow:{user_id}"
+        uploaded_csv = uploaded_csvs.get(user_id)
+        if user_id not in user_states and not manual_numbers.get(user_id) and uploaded_csv is None:
+            await coll.delete_one({"_id": doc_id})
+            return
+        
+        csv_bytes = uploaded_csv.getvalue() if uploaded_csv is not None else None
+        if csv_bytes is not None and len(csv_bytes) > ADMIN_FLOW_MAX_CSV_BYTES:
+            logging.warning(f"⚠️ Uploaded CSV too large to persist ({len(csv_bytes)} bytes) - it will not survive a restart")
+            csv_bytes = None
+        
+        await coll.replace_one(
+            {"_id": doc_id},
+            {
+                "_id": doc_id,
+                "user_id": user_id,
+                "state": user_states.get(user_id),
+                "manual_numbers": manual_numbers.get(user_id, []),
+                "uploaded_csv": csv_bytes,
+                "updated_at": datetime.now(TIMEZONE),
+                "expires_at": datetime.now(TIMEZONE) + timedelta(seconds=ADMIN_FLOW_TTL),
+            },
+            upsert=True
+        )
+    except Exception as e:
+        logging.error(f"❌ Failed to persist admin flow for {user_id}: {e}")
+
+async def restore_admin_flows():
+    """Reload admin upload flows saved before a restart"""
+    if session_store_db is None:
+        return
+    try:
+        flow_docs = await session_store_db[BOT_STATE_COLLECTION].find(
+            {"_id": {"$regex": "^admin_flow:"}, "expires_at": {"$gt": datetime.now(TIMEZONE)}}
+        ).sort("updated_at", 1).to_list(length=None)
+    except Exception as e:
+        logging.error(f"❌ Failed to load persisted admin flows: {e}")
+        return
+    
+    for doc in flow_docs:
+        user_id = doc["user_id"]
+        # An upload that was running when the bot stopped has to be started again
+        if doc.get("state") and doc["state"] != "upload_running":
+            user_states[user_id] = doc["state"]
+        if doc.get("manual_numbers"):
+            manual_numbers[user_id] = list(doc["manual_numbers"])
+        if doc.get("uploaded_csv"):
+            uploaded_csvs[user_id] = BytesIO(doc["uploaded_csv"])
+    
+    if flow_docs:
+        logging.info(f"♻️ Restored {len(flow_docs)} admin upload flow(s) after restart")
+
+# === WORKER LEASES ===
+# Several processes can share one database: a single "updater" polls Telegram while "worker"
+# processes claim morning-call sessions and background sweep shards. Ownership is tracked with
+# leases in MongoDB (owner, heartbeat, expiry); a lease whose owner stops renewing it expires
+# after LEASE_TTL seconds and is taken over by another process.
+BOT_ROLE = os.environ.get("BOT_ROLE", BOT_ROLE).lower()
+WORKER_ID = os.environ.get("BOT_WORKER_ID") or BOT_WORKER_ID or socket.gethostname()
+runs_updater = BOT_ROLE in ("all", "updater")
+runs_monitors = BOT_ROLE in ("all", "worker")
+lease_db = None  # Set by init_leases()
+owned_sweep_shards = set()
+
+async def init_leases(db):
+    """Remember the database used for leases and ensure its indexes"""
+    global lease_db
+    lease_db = db
+    try:
+        await db[SESSIONS_COLLECTION].create_index([("owner", 1), ("lease_expires_at", 1)])
+        await db[SESSIONS_COLLECTION].create_index([("phone_number", 1), ("expires_at", 1)])
+    except Exception as e:
+        logging.warning(f"⚠️ Could not create lease indexes: {e}")
+    logging.info(f"👷 Running as {BOT_ROLE} process {WORKER_ID}")
+
+async def try_acquire_lease(name, ttl=LEASE_TTL):
+    """Take or renew the named lease, returning False while another live process holds it"""
+    now = datetime.now(TIMEZONE)
+    try:
+        await lease_db[LEASES_COLLECTION].update_one(
+            {"_id": name, "$or": [{"owner": WORKER_ID}, {"expires_at": {"$lte": now}}]},
+            {"$set": {"owner": WORKER_ID, "heartbeat": now, "expires_at": now + timedelta(seconds=ttl)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # The lease exists and belongs to someone else, so the upsert tried to insert a duplicate
+        return False
+
+async def release_lease(name):
+    """Give up the named lease if this process holds it"""
+    await lease_db[LEASES_COLLECTION].delete_one({"_id": name, "owner": WORKER_ID})
+
+def _sweep_shard(phone_number):
+    """Sweep shard of a number - its last digit"""
+    return int(phone_number[-1]) % SWEEP_SHARDS if phone_number[-1:].isdigit() else 0
+
+def sweep_shard_filter():
+    """MongoDB filter selecting the numbers in the sweep shards owned by this process"""
+    if len(owned_sweep_shards) == SWEEP_SHARDS:
+        return {}
+    digits = "".join(str(d) for d in range(10) if d % SWEEP_SHARDS in owned_sweep_shards)
+    return {"number": {"$regex": f"[{digits}]$"}}
+
+async def _rebalance_sweep_shards():
+    """Renew owned sweep shards and claim or release shards to hold a fair share"""
+    now = datetime.now(TIMEZONE)
+    live_sweepers = await lease_db[LEASES_COLLECTION].count_documents(
+        {"_id": {"$regex": "^worker:"}, "sweeps": True, "expires_at": {"$gt": now}}
+    )
+    fair_share = -(-SWEEP_SHARDS // max(live_sweepers, 1))
+    
+    for shard in sorted(owned_sweep_shards):
+        if len(owned_sweep_shards) > fair_share:
+            await release_lease(f"sweep:{shard}")
+            owned_sweep_shards.discard(shard)
+        elif not await try_acquire_lease(f"sweep:{shard}"):
+            owned_sweep_shards.discard(shard)
+    
+    for shard in range(SWEEP_SHARDS):
+        if len(owned_sweep_shards) >= fair_share:
+            break
+        if shard not in owned_sweep_shards and await try_acquire_lease(f"sweep:{shard}"):
+            owned_sweep_shards.add(shard)
+
+def _drop_local_session(session_id):
+    """Stop monitoring a session locally without touching its persisted document"""
+    monitor = active_number_monitors.pop(session_id, None)
+    if monitor:
+        monitor['stop'] = True
+    for user_sessions in user_monitoring_sessions.values():
+        user_sessions.pop(session_id, None)
+
+async def _resume_session_doc(app, doc):
+    """Start (or show) a persisted morning-call session in this process"""
+    user_id = doc["user_id"]
+    # Later sessions overwrite earlier ones, matching send_number's "latest number" rule
+    current_user_numbers[user_id] = doc["phone_number"]
+    await start_otp_monitoring(
+        doc["phone_number"],
+        doc["message_id"],
+        doc["chat_id"],
+        doc["country_code"],
+        doc["country_name"],
+        app,  # Application provides .bot and .bot_data like a handler context
+        user_id,
+        session_id=doc["_id"],
+        start_time=_as_local_time(doc["start_time"])
+    )
+
+async def claim_monitoring_sessions(app):
+    """Claim unowned or abandoned morning-call sessions and start monitoring them"""
+    claimed = 0
+    coll = lease_db[SESSIONS_COLLECTION]
+    while len(active_number_monitors) < WORKER_MAX_SESSIONS:
+        now = datetime.now(TIMEZONE)
+        doc = await coll.find_one_and_update(
+            {
+                "expires_at": {"$gt": now},
+                "_id": {"$nin": list(active_number_monitors) + list(released_session_ids)},
+                "$or": [{"owner": None}, {"owner": WORKER_ID}, {"lease_expires_at": {"$lte": now}}],
+            },
+            {"$set": {"owner": WORKER_ID, "lease_expires_at": now + timedelta(seconds=LEASE_TTL)}},
+            sort=[("start_time", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+        if doc is None:
+            break
+        try:
+            await _resume_session_doc(app, doc)
+            claimed += 1
+        except Exception as e:
+            logging.error(f"❌ Failed to start claimed session {doc.get('_id')}: {e}")
+    return claimed
+
+async def _renew_session_leases():
+    """Extend the leases of locally monitored sessions and drop the ones stopped elsewhere"""
+    coll = lease_db[SESSIONS_COLLECTION]
+    now = datetime.now(TIMEZONE)
+    local_ids = list(active_number_monitors)
+    if local_ids:
+        await coll.update_many(
+            {"_id": {"$in": local_ids}, "owner": WORKER_ID},
+            {"$set": {"lease_expires_at": now + timedelta(seconds=LEASE_TTL)}}
+        )
+        still_owned = {doc["_id"] for doc in await coll.find(
+            {"_id": {"$in": local_ids}, "owner": WORKER_ID}, {"_id": 1}
+        ).to_list(length=None)}
+        for session_id in local_ids:
+            if session_id not in still_owned:
+                # Stopped by the updater (document deleted) or taken over after a stall
+                logging.info(f"🛑 Session {session_id} is no longer owned by {WORKER_ID} - stopping it here")
+                _drop_local_session(session_id)
+    
+    # Sessions monitored by other processes are only shown here - forget them once they end
+    viewed_ids = [session_id for user_sessions in user_monitoring_sessions.values()
+                  for session_id in user_sessions if session_id not in active_number_monitors]
+    if viewed_ids:
+        alive = {doc["_id"] for doc in await coll.find(
+            {"_id": {"$in": viewed_ids}, "expires_at": {"$gt": now}}, {"_id": 1}
+        ).to_list(length=None)}
+        for session_id in viewed_ids:
+            if session_id not in alive:
+                _drop_local_session(session_id)
+
+async def _hold_updater_lease(app):
+    """Receive Telegram updates only while this process holds the updater lease"""
+    if not accepting_updates:
+        return
+    receiving = app.bot_data.get("receiving_updates", False)
+    if await try_acquire_lease("updater"):
+        if not receiving:
+            await start_receiving_updates(app)
+            logging.info(f"📡 {WORKER_ID} holds the updater lease - receiving updates ({UPDATE_MODE})")
+    elif receiving:
+        logging.error(f"❌ {WORKER_ID} lost the updater lease - no longer receiving updates")
+        await stop_receiving_updates(app)
+    else:
+        logging.info(f"⏳ Another process holds the updater lease - {WORKER_ID} is standing by")
+
+async def lease_heartbeat_task(app):
+    """Background task that renews this process's leases and rebalances sweep shards"""
+    logging.info(f"💓 Lease heartbeat started for {WORKER_ID} (role: {BOT_ROLE})")
+    try:
+        while True:
+            try:
+                now = datetime.now(TIMEZONE)
+                await lease_db[LEASES_COLLECTION].update_one(
+                    {"_id": f"worker:{WORKER_ID}"},
+                    {"$set": {
+                        "role": BOT_ROLE,
+                        "sweeps": runs_monitors,
+                        "sessions": len(active_number_monitors),
+                        "heartbeat": now,
+                        "expires_at": now + timedelta(seconds=LEASE_TTL),
+                    }},
+                    upsert=True
+                )
+                if runs_updater:
+                    await _hold_updater_lease(app)
+                await _renew_session_leases()
+                if runs_monitors:
+                    await _rebalance_sweep_shards()
+            except Exception as e:
+                logging.error(f"❌ Lease heartbeat error: {e}")
+            await asyncio.sleep(LEASE_HEARTBEAT_INTERVAL)
+    except asyncio.CancelledError:
+        # Hand everything over right away instead of waiting for the leases to expire
+        for monitor in active_number_monitors.values():
+            monitor['stop'] = True
+        try:
+            if lease_db is not None:
+                await lease_db[SESSIONS_COLLECTION].update_many(
+                    {"owner": WORKER_ID}, {"$set": {"owner": None}}
+                )
+                await lease_db[LEASES_COLLECTION].delete_many({"owner": WORKER_ID})
+                await lease_db[LEASES_COLLECTION].delete_one({"_id": f"worker:{WORKER_ID}"})
+        except Exception as e:
+            logging.warning(f"⚠️ Could not release leases on shutdown: {e}")
+        logging.info("🛑 Lease heartbeat stopped")
+
+async def session_claim_task(app):
+    """Background task that picks up morning calls started by the updater process"""
+    try:
+        while True:
+            try:
+                claimed = await claim_monitoring_sessions(app)
+                if claimed:
+                    logging.info(f"👷 {WORKER_ID} claimed {claimed} morning call session(s)")
+            except Exception as e:
+                logging.error(f"❌ Session claim error: {e}")
+            await asyncio.sleep(SESSION_CLAIM_INTERVAL)
+    except asyncio.CancelledError:
+        logging.info("🛑 Session claim task stopped")
+
+# === OTP ANALYTICS ===
+# Every morning call ends in one $inc on a time-bucketed aggregate document keyed by country,
+# range and sender (sender "" for timeouts). The sums give averages for each leg of the OTP's
+# way: hand-out -> SMS at the panel -> detection by the monitor -> delivery to the user, and a
+# coarse histogram of detection times gives percentiles and the SLO compliance for /otpstats.
+OTP_STATS_TIMINGS = ("to_sms", "detection", "delivery", "to_otp")
+OTP_STATS_EXPORT_FIELDS = ("bucket", "country_code", "range", "sender", "sessions", "otps", "timeouts", "within_slo",
+                           *(f"{timing}_sum" for timing in OTP_STATS_TIMINGS), "detection_max")
+otp_stats_db = None  # Set by init_otp_stats()
+
+def _otp_hist_key(bound):
+    return "le_" + f"{bound:g}".replace(".", "_")
+
+OTP_STATS_HIST_KEYS = [_otp_hist_key(bound) for bound in METRICS_OTP_BUCKETS] + ["le_inf"]
+
+async def init_otp_stats(db):
+    """Remember the analytics database and ensure its bucket key and TTL indexes"""
+    global otp_stats_db
+    otp_stats_db = db
+    try:
+        coll = db[OTP_STATS_COLLECTION]
+        await coll.create_index([("bucket", 1), ("country_code", 1), ("range", 1), ("sender", 1)], unique=True)
+        await coll.create_index("bucket_ttl", expireAfterSeconds=OTP_STATS_RETENTION_DAYS * 86400)
+    except Exception as e:
+        logging.warning(f"⚠️ Could not create OTP analytics indexes: {e}")
+
+def otp_stats_bucket(moment):
+    """Start (UTC) of the aggregate bucket a moment falls into"""
+    timestamp = int(moment.timestamp())
+    return datetime.fromtimestamp(timestamp - timestamp % OTP_STATS_BUCKET_SECONDS, pytz.utc).replace(tzinfo=None)
+
+def parse_sms_time(sms):
+    """When the panel received an SMS (its datetime column is in the bot timezone), or None"""
+    try:
+        return TIMEZONE.localize(datetime.strptime(sms['datetime'], "%Y-%m-%d %H:%M:%S"))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+async def record_otp_stats(phone_number, country_code, start_time, sms=None, detected_at=None, delivered_at=None):
+    """Add one morning call (with its OTP timings, or a timeout when sms is None) to the analytics buckets"""
+    if otp_stats_db is None:
+        return
+    try:
+        increments = {"sessions": 1}
+        maximums = {}
+        if sms is None:
+            increments["timeouts"] = 1
+            doc = await otp_stats_db[COLLECTION_NAME].find_one({"number": phone_number}, {"range": 1, "_id": 0})
+            range_name = (doc or {}).get("range") or ""
+            sender = ""
+        else:
+            increments["otps"] = 1
+            range_name = sms.get('range') or ""
+            sender = sms.get('sender') or "Unknown"
+            received_at = parse_sms_time(sms) or detected_at
+            timings = {
+                "to_sms": (received_at - start_time).total_seconds(),
+                "detection": (detected_at - received_at).total_seconds(),
+                "delivery": (delivered_at - detected_at).total_seconds(),
+                "to_otp": (delivered_at - start_time).total_seconds(),
+            }
+            for timing, seconds in timings.items():
+                increments[f"{timing}_sum"] = max(0.0, seconds)
+            detection = increments["detection_sum"]
+            increments["within_slo"] = int(detection <= OTP_DETECTION_SLO)
+            index = bisect_left(METRICS_OTP_BUCKETS, detection)
+            increments[f"detection_hist.{OTP_STATS_HIST_KEYS[index]}"] = 1
+            maximums["detection_max"] = detection
+        
+        bucket = otp_stats_bucket(start_time)
+        update = {"$inc": increments, "$setOnInsert": {"bucket_ttl": bucket}}
+        if maximums:
+            update["$max"] = maximums
+        await otp_stats_db[OTP_STATS_COLLECTION].update_one(
+            {"bucket": bucket, "country_code": country_code, "range": range_name, "sender": sender},
+            update,
+            upsert=True
+        )
+    except Exception as e:
+        logging.warning(f"⚠️ Could not record OTP analytics for {phone_number}: {e}")
+
+def record_otp_shown(phone_number, country_code, sms, start_time, detected_at, delivered_at):
+    """Record a morning call ending with an OTP: time since the hand-out and since the SMS reached the panel"""
+    metric_inc("bot_morning_calls_total", outcome="otp")
+    metric_observe("bot_time_to_otp_seconds", (delivered_at - start_time).total_seconds())
+    received_at = parse_sms_time(sms)
+    if received_at is not None:
+        metric_observe("bot_otp_detection_seconds", max(0.0, (detected_at - received_at).total_seconds()))
+    asyncio.create_task(record_otp_stats(phone_number, country_code, start_time, sms, detected_at, delivered_at))
+
+async def load_otp_stats(hours, country_code=None):
+    """Aggregate buckets of the last hours, grouped by country and by range (country_code narrows both)"""
+    since = otp_stats_bucket(datetime.now(TIMEZONE) - timedelta(hours=hours))
+    match = {"bucket": {"$gte": since}}
+    if country_code:
+        match["country_code"] = country_code
+    sums = {field: {"$sum": f"${field}"} for field in ("sessions", "otps", "timeouts", "within_slo")}
+    sums.update({f"{timing}_sum": {"$sum": f"${timing}_sum"} for timing in OTP_STATS_TIMINGS})
+    sums.update({key: {"$sum": f"$detection_hist.{key}"} for key in OTP_STATS_HIST_KEYS})
+    sums["detection_max"] = {"$max": "$detection_max"}
+    
+    coll = otp_stats_db[OTP_STATS_COLLECTION]
+    groups = {}
+    for name, key in (("total", None), ("countries", "$country_code"), ("ranges", {"country_code": "$country_code", "range": "$range"}),
+                      ("senders", "$sender")):
+        pipeline = [{"$match": match}, {"$group": {"_id": key, **sums}}, {"$sort": {"sessions": -1}}]
+        groups[name] = await coll.aggregate(pipeline).to_list(length=None)
+    return groups
+
+def otp_detection_percentile(row, p):
+    """Upper bound of the detection-time bucket holding percentile p (None when there were no OTPs)"""
+    if not row.get('otps'):
+        return None
+    rank = row['otps'] * p / 100
+    seen = 0
+    for bound, key in zip(list(METRICS_OTP_BUCKETS) + [None], OTP_STATS_HIST_KEYS):
+        seen += row.get(key, 0)
+        if seen >= rank:
+            return bound
+    return None
+
+def otp_stats_line(label, row):
+    """One report line: hit rate, SLO compliance and the average time of each leg"""
+    sessions = row['sessions'] or 1
+    otps = row['otps']
+    line = f"{label}: {row['sessions']} calls, {otps * 100 / sessions:.0f}% OTP"
+    if otps:
+        p95 = otp_detection_percentile(row, 95)
+        p95_text = f"≤{p95:g}s" if p95 is not None else f">{METRICS_OTP_BUCKETS[-1]:g}s"
+        line += (f", SLO {row['within_slo'] * 100 / otps:.0f}%"
+                 f"\n    SMS {row['to_sms_sum'] / otps:.0f}s · detect {row['detection_sum'] / otps:.1f}s (p95 {p95_text})"
+                 f" · deliver {row['delivery_sum'] / otps:.1f}s")
+    return line
+
+def otp_stats_report_lines(groups, hours, country_code=None):
+    """Text of /otpstats"""
+    scope = f" for {country_code}" if country_code else ""
+    lines = [f"📈 OTP analytics, last {hours}h{scope}", f"🎯 SLO: detected within {OTP_DETECTION_SLO}s of reaching the panel", ""]
+    if not groups['total'] or not groups['total'][0]['sessions']:
+        lines.append("No morning calls recorded yet.")
+        return lines
+    lines.append(otp_stats_line("Σ All", groups['total'][0]))
+    
+    lines.extend(["", "🌍 Countries:"])
+    for row in groups['countries'][:OTP_STATS_REPORT_ROWS]:
+        lines.append(otp_stats_line(f"{get_country_flag(row['_id'])} {row['_id']}", row))
+    
+    ranges = [row for row in groups['ranges'] if row['_id'].get('range')]
+    if ranges:
+        ranked = sorted(ranges, key=lambda row: (row['otps'] / row['sessions'], row['otps']), reverse=True)
+        lines.extend(["", "✅ Best ranges (worth keeping stock of):"])
+        for row in ranked[:OTP_STATS_REPORT_ROWS]:
+            lines.append(otp_stats_line(f"{row['_id']['range']} ({row['_id']['country_code']})", row))
+        dead = [row for row in ranked if not row['otps']]
+        if dead:
+            lines.extend(["", f"💤 Ranges without OTPs: {len(dead)}"])
+            lines.extend(f"{row['_id']['range']} ({row['_id']['country_code']}): {row['sessions']} calls" for row in dead[:OTP_STATS_REPORT_ROWS])
+    
+    senders = [row for row in groups['senders'] if row['_id']]
+    if senders:
+        lines.extend(["", "📨 Senders: " + ", ".join(f"{row['_id']} {row['otps']}" for row in senders[:OTP_STATS_REPORT_ROWS])])
+    return lines
+
+async def export_otp_stats(hours, country_code=None):
+    """CSV bytes of the raw buckets of the last hours"""
+    since = otp_stats_bucket(datetime.now(TIMEZONE) - timedelta(hours=hours))
+    query = {"bucket": {"$gte": since}}
+    if country_code:
+        query["country_code"] = country_code
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(list(OTP_STATS_EXPORT_FIELDS) + OTP_STATS_HIST_KEYS)
+    async for doc in otp_stats_db[OTP_STATS_COLLECTION].find(query, {"_id": 0}).sort("bucket", 1):
+        row = [round(value, 3) if isinstance(value, float) else value
+               for value in (doc.get(field, 0) for field in OTP_STATS_EXPORT_FIELDS)]
+        row[0] = pytz.utc.localize(doc['bucket']).astimezone(TIMEZONE).strftime("%Y-%m-%d %H:%M")
+        writer.writerow(row + [doc.get('detection_hist', {}).get(key, 0) for key in OTP_STATS_HIST_KEYS])
+    return output.getvalue().encode('utf-8')
+
+# === NUMBER QUALITY ===
+# Every morning call that ends in this process is counted in the number's number_stats document
+# (hand-outs, OTPs, timeouts, cancellations, last OTP time). Timeouts lower the quality_score kept
+# on the number itself (a re-uploaded number gets its score back from number_stats), and
+# send_number prefers well-scored numbers through the (country_code, quality_score, available_after)
+# index; numbers in a running morning call are not handed out twice. A timed-out number rests until available_after (NUMBER_COOLDOWN); after
+# NUMBER_QUARANTINE_AFTER timeouts in a row it is quarantined for NUMBER_QUARANTINE_TIME, and the
+# background sweep only checks it every QUARANTINE_RECHECK_INTERVAL.
+NUMBER_QUALITY_UNTESTED = NUMBER_QUALITY_PRIOR_OTPS / (NUMBER_QUALITY_PRIOR_OTPS + NUMBER_QUALITY_PRIOR_TIMEOUTS)
+NUMBER_OUTCOME_FIELDS = {"otp": "otps", "timeout": "timeouts", "cancelled": "cancelled"}
+number_stats_db = None  # Set by init_number_stats()
+
+async def init_number_stats(db):
+    """Remember the stats database and give numbers uploaded before scoring a score and availability"""
+    global number_stats_db
+    number_stats_db = db
+    if not runs_updater:
+        return
+    try:
+        result = await db[COLLECTION_NAME].update_many(
+            {"quality_score": {"$exists": False}},
+            {"$set": {"quality_score": NUMBER_QUALITY_UNTESTED}}
+        )
+        if result.modified_count:
+            logging.info(f"🏷️ Gave {result.modified_count} number(s) the untested quality score")
+        await db[COLLECTION_NAME].update_many(
+            {"available_after": {"$exists": False}},
+            {"$set": {"available_after": datetime.now(TIMEZONE)}}
+        )
+    except Exception as e:
+        logging.warning(f"⚠️ Could not backfill number quality scores: {e}")
+
+def number_quality_score(stats):
+    """Smoothed OTP rate of a number (cancelled morning calls do not count)"""
+    otps = stats.get('otps', 0) + NUMBER_QUALITY_PRIOR_OTPS
+    return otps / (otps + stats.get('timeouts', 0) + NUMBER_QUALITY_PRIOR_TIMEOUTS)
+
+async def seed_quality_scores(documents):
+    """Give uploaded numbers that were handed out before (and deleted since) their earned score"""
+    if number_stats_db is None or not documents:
+        return
+    try:
+        cursor = number_stats_db[NUMBER_STATS_COLLECTION].find(
+            {"_id": {"$in": [document["number"] for document in documents]}}, {"otps": 1, "timeouts": 1}
+        )
+        scores = {stats["_id"]: number_quality_score(stats) async for stats in cursor}
+    except Exception as e:
+        logging.warning(f"⚠️ Could not look up the quality scores of uploaded numbers: {e}")
+        return
+    for document in documents:
+        if document["number"] in scores:
+            document["quality_score"] = scores[document["number"]]
 
-async def get_latest_sms_for_number(phone_number, date_str=None):
-    """Get the latest SMS for a phone number and extract OTP - OPTIMIZED"""
-    logging.info(f"Getting latest SMS for {phone_number}")
+async def record_number_outcome(phone_number, country_code, outcome):
+    """Count a finished morning call (otp, timeout or cancelled) in the number's stats and rescore it
     
-    # PERFORMANCE OPTIMIZATION: Use shorter timeout for initial checks
-    import asyncio
+    After a timeout the number is put to rest or quarantined; the fields set on it are returned.
+    """
+    if number_stats_db is None:
+        return None
     try:
-        sms_data = await asyncio.wait_for(
-            check_sms_for_number(phone_number, date_str), 
-            timeout=15.0  # 15 second timeout instead of 30
+        now = datetime.now(TIMEZONE)
+        fields = {"country_code": country_code, "last_handout_at": now}
+        increments = {"handouts": 1, NUMBER_OUTCOME_FIELDS[outcome]: 1}
+        if outcome == "otp":
+            fields["last_otp_at"] = now
+            fields["consecutive_timeouts"] = 0
+        elif outcome == "timeout":
+            increments["consecutive_timeouts"] = 1
+        stats = await number_stats_db[NUMBER_STATS_COLLECTION].find_one_and_update(
+            {"_id": phone_number},
+            {"$inc": increments, "$set": fields},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
         )
-    except asyncio.TimeoutError:
-        logging.warning(f"SMS check timed out for {phone_number} - returning None")
+        if outcome != "timeout":
+            # After an OTP the number is deleted, a cancellation says nothing about it
+            return None
+        
+        state = {"quality_score": number_quality_score(stats), "consecutive_timeouts": stats['consecutive_timeouts']}
+        if stats['consecutive_timeouts'] >= NUMBER_QUARANTINE_AFTER:
+            state.update({
+                "status": "quarantined",
+                "available_after": now + timedelta(seconds=NUMBER_QUARANTINE_TIME),
+                "next_check_at": now + timedelta(seconds=QUARANTINE_RECHECK_INTERVAL)
+            })
+            logging.info(f"🚫 {phone_number} timed out {stats['consecutive_timeouts']} times in a row - quarantined")
+        else:
+            state["available_after"] = now + timedelta(seconds=NUMBER_COOLDOWN)
+        await number_stats_db[COLLECTION_NAME].update_many({"number": phone_number}, {"$set": state})
+        return state
+    except Exception as e:
+        logging.warning(f"⚠️ Could not record the {outcome} of {phone_number}: {e}")
         return None
-    
-    if sms_data and 'aaData' in sms_data and sms_data['aaData']:
-        logging.info(f"SMS data found for {phone_number}, processing {len(sms_data['aaData'])} rows")
-        
-        # PERFORMANCE OPTIMIZATION: Only process first few rows for initial check
-        rows_to_check = min(10, len(sms_data['aaData']))  # Limit to first 10 rows
-        
-        # Filter out summary rows and get actual SMS messages
-        sms_messages = []
-        for i, row in enumerate(sms_data['aaData'][:rows_to_check]):
-            if isinstance(row, list) and len(row) >= 6:
-                # Check if this is a real SMS message (not a summary row)
-                first_item = str(row[0])
-                if not first_item.startswith('0.') and not ',' in first_item and len(first_item) > 10:
-                    sms_messages.append({
-                        'datetime': row[0],
-                        'range': row[1],
-                        'number': row[2],
-                        'sender': row[3] if len(row) > 3 else 'Unknown',
-                        'message': row[5] if len(row) > 5 else 'No message content'
-                    })
-                    
-                    # PERFORMANCE OPTIMIZATION: Stop after finding first valid SMS with OTP
-                    test_otp = extract_otp_from_message(sms_messages[-1]['message'])
-                    if test_otp:
-                        logging.info(f"🚀 FAST OTP DETECTED for {phone_number}: {test_otp}")
-                        return {
-                            'sms': sms_messages[-1],
-                            'otp': test_otp,
-                            'total_messages': len(sms_messages)
-                        }
-        
-        logging.info(f"Found {len(sms_messages)} valid SMS messages for {phone_number}")
-        
-        if sms_messages:
-            # Get the latest SMS (first in the list since it's sorted by desc)
-            latest_sms = sms_messages[0]
-            logging.info(f"Latest SMS for {phone_number}: {latest_sms}")
-            
-            # Enhanced OTP extraction with more detailed logging
-            otp = extract_otp_from_message(latest_sms['message'])
-            if otp:
-                logging.info(f"🎯 OTP DETECTED for {phone_number}: {otp}")
-            else:
-                logging.info(f"❌ No OTP found in message: {latest_sms['message'][:100]}...")
-            
-            result = {
-                'sms': latest_sms,
-                'otp': otp,
-                'total_messages': len(sms_messages)
-            }
-            logging.info(f"Returning SMS info for {phone_number}: {result}")
-            return result
-    else:
-        logging.info(f"No SMS data found for {phone_number}")
-    
-    return None
 
-async def start_otp_monitoring(phone_number, message_id, chat_id, country_code, country_name, context, user_id=None):
-    """Start monitoring a phone number for new OTPs (morning call system)"""
+def numbers_in_morning_calls():
+    """Numbers currently handed out to a user"""
+    return {session['phone_number'] for user_sessions in user_monitoring_sessions.values()
+            for session in user_sessions.values()}
+
+def available_numbers_filter(country_code):
+    """Numbers of a country that are neither resting after a timeout nor quarantined"""
+    return {"country_code": country_code, "available_after": {"$lte": datetime.now(TIMEZONE)}}
+
+def number_selection_pipeline(country_code, exclude=()):
+    """Pipeline picking one available number of a country, epsilon-greedy over quality_score
+    
+    Usually one of the NUMBER_SELECTION_POOL best-scored numbers; NUMBER_EXPLORE_RATE of the
+    hand-outs sample the whole country so scores keep being tested.
+    """
+    match = available_numbers_filter(country_code)
+    if exclude:
+        match["number"] = {"$nin": list(exclude)}
+    if random.random() < NUMBER_EXPLORE_RATE:
+        return [{"$match": match}, {"$sample": {"size": 1}}]
+    return [
+        {"$match": match},
+        {"$sort": {"quality_score": -1}},
+        {"$limit": NUMBER_SELECTION_POOL},
+        {"$sample": {"size": 1}}
+    ]
+
+async def start_otp_monitoring(phone_number, message_id, chat_id, country_code, country_name, context, user_id=None, session_id=None, start_time=None):
+    """Start monitoring a phone number for new OTPs (morning call system)
+    
+    Pass session_id and start_time to resume a persisted session after a restart.
+    """
     if user_id is None:
         user_id = context.effective_user.id if context.effective_user else None
     
@@ -1073,8 +3293,11 @@ async def start_otp_monitoring(phone_number, message_id, chat_id, country_code,
         logging.error(f"Cannot start monitoring for {phone_number}: user_id is None")
         return
     
-    # Create unique session ID for this monitoring session
-    session_id = f"{phone_number}_{int(time.time())}"
+    resuming = session_id is not None
+    if not resuming:
+        # Create unique session ID for this monitoring session
+        session_id = f"{phone_number}_{int(time.time())}"
+        start_time = datetime.now(TIMEZONE)
     
     # Initialize user monitoring sessions if not exists
     if user_id not in user_monitoring_sessions:
@@ -1087,39 +3310,53 @@ async def start_otp_monitoring(phone_number, message_id, chat_id, country_code,
         'chat_id': chat_id,
         'country_code': country_code,
         'country_name': country_name,
-        'start_time': datetime.now(TIMEZONE),
+        'start_time': start_time,
         'stop': False,
         'last_otp': None,
         'last_check': None
     }
     
+    if not runs_monitors:
+        # An updater-only process keeps the session for display; a worker claims and monitors it
+        if not resuming:
+            await persist_monitoring_session(session_id, user_id, user_monitoring_sessions[user_id][session_id])
+        logging.info(f"Queued morning call session {session_id} for user {user_id} on number {phone_number} for a worker")
+        return
+    
     # Start new monitor (multiple monitors can run simultaneously)
     active_number_monitors[session_id] = {
         'stop': False,
         'last_otp': None,
         'last_check': None,
-        'start_time': datetime.now(TIMEZONE),
+        'start_time': start_time,
         'user_id': user_id,
-        'phone_number': phone_number
+        'phone_number': phone_number,
+        'country_code': country_code
     }
     
+    if not resuming:
+        await persist_monitoring_session(session_id, user_id, user_monitoring_sessions[user_id][session_id])
+    
     logging.info(f"Started morning call monitoring session {session_id} for user {user_id} on number {phone_number}")
     logging.info(f"Active monitors count: {len(active_number_monitors)}")
     logging.info(f"User monitoring sessions for user {user_id}: {len(user_monitoring_sessions.get(user_id, {}))}")
     
+    check_count = 0
+    
     async def monitor_otp():
         """Morning call monitoring - runs for 2 minutes then auto-cancels"""
+        nonlocal check_count
         logging.info(f"Starting morning call monitoring for {phone_number} - checking every 5 seconds for 2 minutes")
         
-        # Morning call timeout: 2 minutes (120 seconds)
-        MORNING_CALL_TIMEOUT = 120
-        check_count = 0
         
         # Immediate check for existing OTP
         logging.info(f"🔍 Immediate OTP check for {phone_number}")
+        metric_inc("bot_morning_call_checks_total")
         immediate_sms_info = await get_latest_sms_for_number(phone_number)
         if immediate_sms_info and immediate_sms_info['otp']:
+            detected_at = datetime.now(TIMEZONE)
             logging.info(f"🎯 IMMEDIATE OTP FOUND for {phone_number}: {immediate_sms_info['otp']}")
+            annotate_span(otp_sender=immediate_sms_info['sms']['sender'], otp_sms_time=immediate_sms_info['sms']['datetime'])
             # Process this OTP immediately
             current_otp = immediate_sms_info['otp']
             active_number_monitors[session_id]['last_otp'] = current_otp
@@ -1136,13 +3373,18 @@ async def start_otp_monitoring(phone_number, message_id, chat_id, country_code,
             )
             
             try:
-                await context.bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    text=message,
-                    reply_markup=number_options_keyboard(phone_number, country_code),
-                    parse_mode=ParseMode.MARKDOWN
-                )
+                with trace_span("telegram.show_otp"):
+                    await queue_bot_call(
+                        context.bot,
+                        "edit_message_text",
+                        priority=PRIORITY_OTP,
+                        chat_id=chat_id,
+                        message_id=message_id,
+                        text=message,
+                        reply_markup=number_options_keyboard(phone_number, country_code),
+                        parse_mode=ParseMode.MARKDOWN
+                    )
+                delivered_at = datetime.now(TIMEZONE)
                 logging.info(f"✅ Immediate OTP update successful for {phone_number}: {current_otp}")
                 
                 # Delete the number permanently
@@ -1150,26 +3392,34 @@ async def start_otp_monitoring(phone_number, message_id, chat_id, country_code,
                 coll = db[COLLECTION_NAME]
                 countries_coll = db[COUNTRIES_COLLECTION]
                 
-                delete_result = await coll.delete_one({"number": phone_number})
+                with trace_span("mongo.delete_number"):
+                    delete_result = await coll.delete_one({"number": phone_number})
                 if delete_result.deleted_count > 0:
                     logging.info(f"🗑️ Number {phone_number} permanently deleted after immediate OTP")
                     
                     # Update country count
-                    await countries_coll.update_one(
-                        {"country_code": country_code},
-                        {"$inc": {"number_count": -1}}
-                    )
+                    with trace_span("mongo.update_country_count"):
+                        await countries_coll.update_one(
+                            {"country_code": country_code},
+                            {"$inc": {"number_count": -1}}
+                        )
+                        record_otp_shown(phone_number, country_code, immediate_sms_info['sms'],
+                                         active_number_monitors[session_id]['start_time'], detected_at, delivered_at)
                     
                     # Stop this monitoring session
-                    await stop_otp_monitoring_session(session_id)
+                    active_number_monitors[session_id]['outcome'] = "otp"
+                    with trace_span("session.stop"):
+                        await stop_otp_monitoring_session(session_id)
                     
                     # Send clean OTP notification to user's private chat
-                    monitoring_user_id = active_number_monitors[session_id].get('user_id')
-                    if monitoring_user_id:
-                        await context.bot.send_message(
-                            chat_id=monitoring_user_id,  # Send to user's private chat
-                            text=f"📞 Number: {formatted_number}\n🔐 {immediate_sms_info['sms']['sender']} : {current_otp}"
-                        )
+                    # (the session entry is gone now, the owner is the enclosing user_id)
+                    trace_future("telegram.send_private_otp", queue_bot_call(
+                        context.bot,
+                        "send_message",
+                        priority=PRIORITY_OTP,
+                        chat_id=user_id,  # Send to user's private chat
+                        text=f"📞 Number: {formatted_number}\n🔐 {immediate_sms_info['sms']['sender']} : {current_otp}"
+                    ))
                     return  # Exit monitoring since OTP was found
                     
             except Exception as e:
@@ -1177,10 +3427,11 @@ async def start_otp_monitoring(phone_number, message_id, chat_id, country_code,
         else:
             logging.info(f"❌ No immediate OTP found for {phone_number}, starting monitoring loop")
         
-        while not active_number_monitors[session_id]['stop']:
+        while session_id in active_number_monitors and not active_number_monitors[session_id]['stop']:
             try:
                 check_count += 1
                 logging.info(f"🔍 Morning call check #{check_count} for {phone_number}")
+                metric_inc("bot_morning_call_checks_total")
                 
                 # Get latest SMS and OTP
                 sms_info = await get_latest_sms_for_number(phone_number)
@@ -1193,7 +3444,9 @@ async def start_otp_monitoring(phone_number, message_id, chat_id, country_code,
                     
                     # Check if this is a new OTP (including first OTP detection)
                     if last_otp != current_otp or last_otp is None:
+                        detected_at = datetime.now(TIMEZONE)
                         logging.info(f"🎯 NEW OTP DETECTED for {phone_number}: {current_otp}")
+                        annotate_span(otp_sender=sms_info['sms']['sender'], otp_sms_time=sms_info['sms']['datetime'])
                         active_number_monitors[session_id]['last_otp'] = current_otp
                         
                         # Update the message with new OTP
@@ -1208,13 +3461,18 @@ async def start_otp_monitoring(phone_number, message_id, chat_id, country_code,
                         )
                         
                         try:
-                            await context.bot.edit_message_text(
-                                chat_id=chat_id,
-                                message_id=message_id,
-                                text=message,
-                                reply_markup=number_options_keyboard(phone_number, country_code),
-                                parse_mode=ParseMode.MARKDOWN
-                            )
+                            with trace_span("telegram.show_otp"):
+                                await queue_bot_call(
+                                    context.bot,
+                                    "edit_message_text",
+                                    priority=PRIORITY_OTP,
+                                    chat_id=chat_id,
+                                    message_id=message_id,
+                                    text=message,
+                                    reply_markup=number_options_keyboard(phone_number, country_code),
+                                    parse_mode=ParseMode.MARKDOWN
+                                )
+                            delivered_at = datetime.now(TIMEZONE)
                             logging.info(f"✅ OTP detected and message updated for {phone_number}: {current_otp}")
                             
                             # Delete the number permanently (never give to others)
@@ -1222,26 +3480,34 @@ async def start_otp_monitoring(phone_number, message_id, chat_id, country_code,
                             coll = db[COLLECTION_NAME]
                             countries_coll = db[COUNTRIES_COLLECTION]
                             
-                            delete_result = await coll.delete_one({"number": phone_number})
+                            with trace_span("mongo.delete_number"):
+                                delete_result = await coll.delete_one({"number": phone_number})
                             if delete_result.deleted_count > 0:
                                 logging.info(f"🗑️ Number {phone_number} permanently deleted after OTP")
                                 
                                 # Update country count
-                                await countries_coll.update_one(
-                                    {"country_code": country_code},
-                                    {"$inc": {"number_count": -1}}
-                                )
+                                with trace_span("mongo.update_country_count"):
+                                    await countries_coll.update_one(
+                                        {"country_code": country_code},
+                                        {"$inc": {"number_count": -1}}
+                                    )
+                                    record_otp_shown(phone_number, country_code, sms_info['sms'],
+                                                     active_number_monitors[session_id]['start_time'], detected_at, delivered_at)
                                 
                                 # Stop this monitoring session
-                                await stop_otp_monitoring_session(session_id)
+                                active_number_monitors[session_id]['outcome'] = "otp"
+                                with trace_span("session.stop"):
+                                    await stop_otp_monitoring_session(session_id)
                                 
                                 # Send clean OTP notification to user's private chat
-                                monitoring_user_id = active_number_monitors[session_id].get('user_id')
-                                if monitoring_user_id:
-                                    await context.bot.send_message(
-                                        chat_id=monitoring_user_id,  # Send to user's private chat
-                                        text=f"📞 Number: {formatted_number}\n🔐 {sms_info['sms']['sender']} : {current_otp}"
-                                    )
+                                trace_future("telegram.send_private_otp", queue_bot_call(
+                                    context.bot,
+                                    "send_message",
+                                    priority=PRIORITY_OTP,
+                                    chat_id=user_id,  # Send to user's private chat
+                                    text=f"📞 Number: {formatted_number}\n🔐 {sms_info['sms']['sender']} : {current_otp}"
+                                ))
+                                break  # Exit monitoring since OTP was found
                                 
                         except Exception as e:
                             logging.error(f"Failed to update message for {phone_number}: {e}")
@@ -1253,40 +3519,32 @@ async def start_otp_monitoring(phone_number, message_id, chat_id, country_code,
                 
                 if time_elapsed > MORNING_CALL_TIMEOUT:
                     logging.info(f"⏰ Morning call timeout reached for {phone_number} (2 minutes), auto-canceling")
+                    annotate_span(timed_out=True)
+                    metric_inc("bot_morning_calls_total", outcome="timeout")
+                    asyncio.create_task(record_otp_stats(phone_number, country_code, start_time))
                     
-                    # Stop this monitoring session (number stays in database for reuse)
-                    await stop_otp_monitoring_session(session_id)
+                    # Stop this monitoring session (number stays in database, resting or quarantined)
+                    active_number_monitors[session_id]['outcome'] = "timeout"
+                    number_state = await stop_otp_monitoring_session(session_id)
+                    if number_state and number_state.get('status') == "quarantined":
+                        availability = (f"🚫 This number timed out {number_state['consecutive_timeouts']} times in a row "
+                                        f"and is set aside for {NUMBER_QUARANTINE_TIME // 3600} hours.")
+                    else:
+                        availability = f"🔄 This number can be given to other users again in {NUMBER_COOLDOWN // 60} minutes."
                     
                     # Notify user about morning call ending (send to user's private chat only)
-                    try:
-                        # Get the user ID from the monitoring session to ensure private message
-                        monitoring_user_id = active_number_monitors[session_id].get('user_id')
-                        if monitoring_user_id:
-                            await context.bot.send_message(
-                                chat_id=monitoring_user_id,  # Send to user's private chat, not group/channel
-                                text=f"⏰ Morning call ended for {format_number_display(phone_number)} (2 minutes timeout)\n\n"
-                                     f"🔄 This number can be given to other users again.\n"
-                                     f"📞 You can get a new number anytime!"
-                            )
-                    except Exception as e:
-                        logging.error(f"Failed to send morning call timeout message for {phone_number}: {e}")
+                    queue_bot_call(
+                        context.bot,
+                        "send_message",
+                        priority=PRIORITY_USER,
+                        chat_id=user_id,  # Send to user's private chat, not group/channel
+                        text=f"⏰ Morning call ended for {format_number_display(phone_number)} (2 minutes timeout)\n\n"
+                             f"{availability}\n"
+                             f"📞 You can get a new number anytime!"
+                    )
                     
-                    # Notify admins about monitoring session expiration
-                    for admin_id in ADMIN_IDS:
-                        try:
-                            await context.bot.send_message(
-                                chat_id=admin_id,
-                                text=f"⏰ **OTP Monitoring Expired**\n\n"
-                                     f"📞 Number: {format_number_display(phone_number)}\n"
-                                     f"👤 User ID: {monitoring_user_id}\n"
-                                     f"⏱️ Duration: 2 minutes\n"
-                                     f"🔄 Number returned to pool\n\n"
-                                     f"ℹ️ _Expired at {current_time.strftime('%H:%M:%S')}_",
-                                parse_mode=ParseMode.MARKDOWN
-                            )
-                            logging.info(f"📢 OTP monitoring expiration notification sent to admin {admin_id}")
-                        except Exception as admin_notify_error:
-                            logging.error(f"Failed to notify admin {admin_id} about monitoring expiration: {admin_notify_error}")
+                    # Report the expiration in the next admin digest
+                    record_admin_event('expired', f"{format_number_display(phone_number)} - user {user_id}")
                     
                     break
                 
@@ -1297,26 +3555,56 @@ async def start_otp_monitoring(phone_number, message_id, chat_id, country_code,
                 logging.error(f"Error in morning call monitoring for {phone_number}: {e}")
                 await asyncio.sleep(OTP_CHECK_INTERVAL)
     
-    # Start the monitoring task
-    asyncio.create_task(monitor_otp())
+    async def traced_monitor_otp():
+        with trace_span("morning_call", new_trace=True, session_id=session_id, phone_number=phone_number,
+                        country_code=country_code, resumed=resuming) as span:
+            await monitor_otp()
+            if span is not None:
+                span['attributes']['checks'] = check_count
+    
+    # Start the monitoring task (it inherits the handler's trace)
+    annotate_span(session_id=session_id)
+    asyncio.create_task(traced_monitor_otp())
 
 async def stop_otp_monitoring_session(session_id):
-    """Stop a specific monitoring session"""
-    if session_id in active_number_monitors:
+    """Stop a specific monitoring session (after a timeout, returns the rest or quarantine set on the number)"""
+    number_state = None
+    # Taken out before any await, so a second stop cannot count the outcome again
+    monitor = active_number_monitors.pop(session_id, None)
+    if monitor is not None:
         logging.info(f"Stopping monitoring session {session_id}")
-        active_number_monitors[session_id]['stop'] = True
-        del active_number_monitors[session_id]
-        
-        # Also remove from user monitoring sessions
-        user_id = active_number_monitors[session_id].get('user_id') if session_id in active_number_monitors else None
-        if user_id and user_id in user_monitoring_sessions:
-            if session_id in user_monitoring_sessions[user_id]:
-                del user_monitoring_sessions[user_id][session_id]
-                logging.info(f"Removed session {session_id} from user {user_id} monitoring sessions")
-        
-        logging.info(f"Monitoring session {session_id} stopped")
+        monitor['stop'] = True
+        user_id = monitor.get('user_id')
+        
+        # Never claimed again, even while its persisted document is still being deleted
+        released_session_ids.append(session_id)
+        await forget_monitoring_sessions([session_id])
+        
+        outcome = monitor.get('outcome', "cancelled")
+        recording = record_number_outcome(monitor['phone_number'], monitor.get('country_code'), outcome)
+        if outcome == "timeout":
+            # The timeout message tells the user how long the number rests
+            number_state = await recording
+        else:
+            asyncio.create_task(recording)
     else:
-        logging.info(f"No active monitoring session found for {session_id}")
+        # Sessions monitored by a worker process are only tracked in the user's view here;
+        # deleting the persisted document tells the worker to stop
+        user_id = next((uid for uid, user_sessions in user_monitoring_sessions.items()
+                        if session_id in user_sessions), None)
+        if user_id is None:
+            logging.info(f"No active monitoring session found for {session_id}")
+            return None
+        await forget_monitoring_sessions([session_id])
+    
+    # Also remove from user monitoring sessions
+    if user_id and user_id in user_monitoring_sessions:
+        if session_id in user_monitoring_sessions[user_id]:
+            del user_monitoring_sessions[user_id][session_id]
+            logging.info(f"Removed session {session_id} from user {user_id} monitoring sessions")
+    
+    logging.info(f"Monitoring session {session_id} stopped")
+    return number_state
 
 async def stop_otp_monitoring(phone_number):
     """Stop monitoring a phone number for OTPs (legacy function)"""
@@ -1335,175 +3623,28 @@ async def stop_otp_monitoring(phone_number):
         logging.info(f"No active monitoring found for {phone_number}")
 
 async def check_sms_for_number(phone_number, date_str=None):
-    """Check SMS for a specific phone number using the API"""
+    """Check SMS for a specific phone number on the panel that owns it"""
     if not date_str:
         # For live monitoring, check last 24 hours to catch recent messages
         now = datetime.now(TIMEZONE)
         yesterday = now - timedelta(hours=24)
         date_str = yesterday.strftime("%Y-%m-%d")
     
-    logging.info(f"Checking SMS for number: {phone_number} on date: {date_str}")
-    
-    # Build the API URL with parameters - optimized for live monitoring
-    params = {
-        'fdate1': f"{date_str} 00:00:00",
-        'fdate2': f"{datetime.now(TIMEZONE).strftime('%Y-%m-%d %H:%M:%S')}",  # Current time
-        'frange': '',
-        'fclient': '',
-        'fnum': phone_number,  # Filter by phone number
-        'fcli': '',
-        'fgdate': '',
-        'fgmonth': '',
-        'fgrange': '',
-        'fgclient': '',
-        'fgnumber': '',
-        'fgcli': '',
-        'fg': '0',
-        'sEcho': '1',
-        'iColumns': '9',
-        'sColumns': ',,,,,,,,',
-        'iDisplayStart': '0',
-        'iDisplayLength': '50',  # Get more messages for better coverage
-        'mDataProp_0': '0',
-        'sSearch_0': '',
-        'bRegex_0': 'false',
-        'bSearchable_0': 'true',
-        'bSortable_0': 'true',
-        'mDataProp_1': '1',
-        'sSearch_1': '',
-        'bRegex_1': 'false',
-        'bSearchable_1': 'true',
-        'bSortable_1': 'true',
-        'mDataProp_2': '2',
-        'sSearch_2': '',
-        'bRegex_2': 'false',
-        'bSearchable_2': 'true',
-        'bSortable_2': 'true',
-        'mDataProp_3': '3',
-        'sSearch_3': '',
-        'bRegex_3': 'false',
-        'bSearchable_3': 'true',
-        'bSortable_3': 'true',
-        'mDataProp_4': '4',
-        'sSearch_4': '',
-        'bRegex_4': 'false',
-        'bSearchable_4': 'true',
-        'bSortable_4': 'true',
-        'mDataProp_5': '5',
-        'sSearch_5': '',
-        'bRegex_5': 'false',
-        'bSearchable_5': 'true',
-        'bSortable_5': 'true',
-        'mDataProp_6': '6',
-        'sSearch_6': '',
-        'bRegex_6': 'false',
-        'bSearchable_6': 'true',
-        'bSortable_6': 'true',
-        'mDataProp_7': '7',
-        'sSearch_7': '',
-        'bRegex_7': 'false',
-        'bSearchable_7': 'true',
-        'bSortable_7': 'true',
-        'mDataProp_8': '8',
-        'sSearch_8': '',
-        'bRegex_8': 'false',
-        'bSearchable_8': 'true',
-        'bSortable_8': 'false',
-        'sSearch': '',
-        'bRegex': 'false',
-        'iSortCol_0': '0',
-        'sSortDir_0': 'desc',
-        'iSortingCols': '1',
-        '_': str(int(datetime.now().timestamp() * 1000))
-    }
-    
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Mobile Safari/537.36',
-        'Accept': 'application/json, text/javascript, */*; q=0.01',
-        'X-Requested-With': 'XMLHttpRequest',
-        'Referer': f'{SMS_API_BASE_URL}/ints/agent/SMSCDRReports',
-        'Accept-Encoding': 'gzip, deflate',
-        'Accept-Language': 'en-US,en;q=0.9,ks-IN;q=0.8,ks;q=0.7',
-                    'Cookie': get_current_sms_cookie()
-    }
+    panel = await panel_for_number(phone_number)
+    logging.info(f"Checking SMS for number: {phone_number} on date: {date_str} (panel {panel.name})")
     
-    try:
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
-            url = f"{SMS_API_BASE_URL}{SMS_API_ENDPOINT}"
-            logging.info(f"Making API request to: {url}")
-            logging.info(f"With params: {params}")
-            
-            async with session.get(url, params=params, headers=headers) as response:
-                logging.info(f"API response status: {response.status}")
-                
-                if response.status == 200:
-                    # Check content type
-                    content_type = response.headers.get('content-type', '')
-                    logging.info(f"Content-Type: {content_type}")
-                    
-                    # Get response text first to check for login redirect
-                    response_text = await response.text()
-                    
-                    # Check if we got redirected to login page
-                    if 'login' in response_text.lower() or 'msi sms | login' in response_text.lower():
-                        logging.error(f"❌ SMS API session expired - redirected to login page")
-                        logging.error(f"🔑 Current session: {get_current_sms_cookie()[:20]}...{get_current_sms_cookie()[-10:]}")
-                        
-                        # Try to reload session from config file
-                        logging.info(f"🔄 Attempting to reload session from config file...")
-                        if reload_config_session():
-                            logging.info(f"✅ Session reloaded, retrying API call...")
-                            # Notify admins of successful auto-recovery
-                            asyncio.create_task(notify_admins_api_recovery())
-                            # Don't return None, let it try again with new session
-                        else:
-                            logging.error(f"❌ Config reload failed - need manual session update")
-                            # Notify admins of API failure
-                            asyncio.create_task(notify_admins_api_failure("session_expired"))
-                            return None
-                    
-                    # Always try to parse as JSON regardless of content type
-                    try:
-                        data = await response.json()
-                        logging.info(f"API response data: {data}")
-                        return data
-                    except Exception as json_error:
-                        logging.error(f"JSON parsing failed: {json_error}")
-                        logging.info(f"Response text: {response_text[:500]}...")  # Log first 500 chars
-                        
-                        # Try to extract JSON from HTML response
-                        if 'aaData' in response_text:
-                            try:
-                                # Find JSON part in the response
-                                start = response_text.find('{')
-                                end = response_text.rfind('}') + 1
-                                if start != -1 and end != 0:
-                                    json_part = response_text[start:end]
-                                    data = json.loads(json_part)
-                                    logging.info(f"Extracted JSON data: {data}")
-                                    return data
-                            except Exception as extract_error:
-                                logging.error(f"Failed to extract JSON: {extract_error}")
-                        
-                        return None
-                else:
-                    response_text = await response.text()
-                    logging.error(f"SMS API error: {response.status}, Response: {response_text}")
-                    
-                    # Check if it's an access blocked error
-                    if 'direct script access not allowed' in response_text.lower():
-                        asyncio.create_task(notify_admins_api_failure("access_blocked"))
-                    else:
-                        asyncio.create_task(notify_admins_api_failure(f"HTTP {response.status}"))
-                    return None
-    except asyncio.TimeoutError:
-        logging.error(f"SMS API timeout")
-        asyncio.create_task(notify_admins_api_failure("connection_timeout"))
-        return None
-    except Exception as e:
-        logging.error(f"Error checking SMS: {e}")
-        asyncio.create_task(notify_admins_api_failure(f"connection_error: {str(e)}"))
-        return None
+    started = time.monotonic()
+    with trace_span("panel.poll", panel=panel.name) as span:
+        try:
+            result = await panel.check_sms(phone_number, date_str)
+        except PanelError as e:
+            set_span_error(span, e.failure_type)
+            metric_inc("bot_sms_checks_total", panel=panel.name, outcome="failed")
+            asyncio.create_task(notify_admins_api_failure(e.failure_type, panel.name, e.base_url))
+            return None
+    metric_inc("bot_sms_checks_total", panel=panel.name, outcome="ok")
+    metric_observe("bot_sms_check_seconds", time.monotonic() - started, panel=panel.name)
+    return result
 
 async def show_sms(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1524,7 +3665,10 @@ async def show_sms(update: Update, context: ContextTypes.DEFAULT_TYPE):
             message += f"🔐 {sms_info['sms']['sender']} : {sms_info['otp']}"
             
             # Send as a new message
-            await context.bot.send_message(
+            await queue_bot_call(
+                context.bot,
+                "send_message",
+                priority=PRIORITY_OTP,
                 chat_id=query.from_user.id,
                 text=message,
                 parse_mode=ParseMode.MARKDOWN
@@ -1596,9 +3740,9 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     user_id = query.from_user.id
     
-    # Stop any active OTP monitoring
-    for phone_number in list(active_number_monitors.keys()):
-        await stop_otp_monitoring(phone_number)
+    # Stop this user's OTP monitoring
+    for session_id in list(user_monitoring_sessions.get(user_id, {})):
+        await stop_otp_monitoring_session(session_id)
     
     # Clear user's current number and monitoring sessions
     if user_id in current_user_numbers:
@@ -1899,11 +4043,14 @@ async def fix_empty_database(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     "original_number": number,
                     "range": "",
                     "detected_country": "unknown",
-                    "added_at": current_time
+                    "added_at": current_time,
+                    "quality_score": NUMBER_QUALITY_UNTESTED,
+                    "available_after": current_time
                 })
             
             # Insert numbers
             if documents:
+                await seed_quality_scores(documents)
                 result = await coll.insert_many(documents)
                 inserted_count = len(result.inserted_ids)
                 total_inserted += inserted_count
@@ -2022,11 +4169,14 @@ async def fix_empty_database_internal(query, context):
                     "original_number": number,
                     "range": "",
                     "detected_country": "unknown",
-                    "added_at": current_time
+                    "added_at": current_time,
+                    "quality_score": NUMBER_QUALITY_UNTESTED,
+                    "available_after": current_time
                 })
             
             # Insert numbers
             if documents:
+                await seed_quality_scores(documents)
                 result = await coll.insert_many(documents)
                 inserted_count = len(result.inserted_ids)
                 total_inserted += inserted_count
@@ -2105,7 +4255,7 @@ async def check_manual_numbers(update: Update, context: ContextTypes.DEFAULT_TYP
     report += f"📱 **Manual Numbers**: {manual_numbers.get(user_id, [])}\n"
     report += f"📊 **Count**: {len(manual_numbers.get(user_id, []))}\n"
     report += f"🔄 **User State**: {user_states.get(user_id, 'None')}\n"
-    report += f"📁 **CSV Uploaded**: {'Yes' if uploaded_csv else 'No'}\n"
+    report += f"📁 **CSV Uploaded**: {'Yes' if user_id in uploaded_csvs else 'No'}\n"
     
     await update.message.reply_text(report)
 
@@ -2252,6 +4402,9 @@ async def check_api_connection(update: Update, context: ContextTypes.DEFAULT_TYP
                     f"📊 **JSON Valid**: {'✅ Yes' if json_valid else '❌ No'}",
                     f"📈 **Test Query Records**: {record_count}",
                     f"🍪 **Cookie**: {get_current_sms_cookie()[:20]}...{get_current_sms_cookie()[-10:]}",
+                    f"",
+                    f"🛰️ **Panel Mirrors**:",
+                    *panel_health_lines(),
                 ]
                 
                 # Add issues section
@@ -2330,18 +4483,22 @@ async def delete_all_numbers(update: Update, context: ContextTypes.DEFAULT_TYPE)
     coll = db[COLLECTION_NAME]
     countries_coll = db[COUNTRIES_COLLECTION]
 
-    # Get count before deletion
-    total_numbers = await coll.count_documents({})
-    
-    # Delete all numbers
-    result = await coll.delete_many({})
-    
-    # Delete all countries
-    await countries_coll.delete_many({})
+    async def run(job):
+        # Get count before deletion
+        total_numbers = await coll.count_documents({})
+        await report_job_progress(job, f"🗑️ Deleting {total_numbers} numbers...", force=True)
+        
+        # Delete all numbers
+        result = await coll.delete_many({})
+        
+        # Delete all countries
+        await countries_coll.delete_many({})
+        clear_countries_cache()
+        
+        await report_job_progress(job, f"🗑️ Deleted all {result.deleted_count} numbers from database.")
+        job['result'] = f"{result.deleted_count} numbers deleted"
     
-    await update.message.reply_text(
-        f"🗑️ Deleted all {result.deleted_count} numbers from database."
-    )
+    await submit_admin_job(context.application, user_id, update.effective_chat.id, "deleteall", "Delete all numbers", run)
 
 async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show database statistics"""
@@ -2356,6 +4513,10 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Get total numbers
     total_numbers = await coll.count_documents({})
+    quarantined_numbers = await coll.count_documents({"status": "quarantined"})
+    resting_numbers = await coll.count_documents({
+        "available_after": {"$gt": datetime.now(TIMEZONE)}, "status": {"$ne": "quarantined"}
+    })
     
     # Get countries with counts
     countries = await countries_coll.find({}).to_list(length=50)
@@ -2363,6 +4524,8 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message_lines = [
         "📊 Database Statistics:",
         f"📱 Total Numbers: {total_numbers}",
+        f"💤 Resting after a timeout: {resting_numbers}",
+        f"🚫 Quarantined: {quarantined_numbers}",
         f"🌍 Total Countries: {len(countries)}",
         "",
         "📋 Countries:"
@@ -2386,6 +4549,7 @@ async def add_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Initialize user state
     user_states[user_id] = "waiting_for_manual_numbers"
     manual_numbers[user_id] = []
+    await save_admin_flow(user_id)
     
     await update.message.reply_text(
         "📱 **Add Numbers Command**\n\n"
@@ -2396,7 +4560,7 @@ async def add_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "94743123866\n\n"
         "💡 **Options:**\n"
         "• Send 'done' when finished entering numbers manually\n"
-        "• Upload a CSV file (will skip to country name step)\n"
+        "• Upload a CSV file, or a .gz/.zip/.xlsx panel export (will skip to country name step)\n"
         "• Send 'cancel' to cancel the operation",
         parse_mode=ParseMode.MARKDOWN
     )
@@ -2436,46 +4600,360 @@ async def quickadd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Processing..."
     )
     
-    # Process immediately
-    await process_all_numbers_with_country(update, context, country_name)
+    # Process immediately
+    await start_upload_job(update, context, country_name, process_all_numbers_with_country)
+
+async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Test command for debugging"""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        await send_lol_message(update)
+        return
+    
+    args = context.args
+    if args and args[0].isdigit():
+        # Test specific phone number
+        phone_number = args[0]
+        await update.message.reply_text(f"🔍 Testing OTP for number: {phone_number}")
+        
+        # Check SMS for this number
+        sms_info = await get_latest_sms_for_number(phone_number)
+        
+        if sms_info:
+            await update.message.reply_text(
+                f"📱 SMS Info for {phone_number}:\n"
+                f"Sender: {sms_info['sms']['sender']}\n"
+                f"Message: {sms_info['sms']['message']}\n"
+                f"OTP: {sms_info['otp']}\n"
+                f"Total Messages: {sms_info['total_messages']}"
+            )
+        else:
+            await update.message.reply_text(f"❌ No SMS found for {phone_number}")
+    else:
+        # Test OTP extraction
+        test_message = "# Snapchat 157737 is your one time passcode for phone enrollment"
+        otp = extract_otp_from_message(test_message)
+        
+        await update.message.reply_text(
+            f"🧪 Test Results:\n"
+            f"Test Message: {test_message}\n"
+            f"Extracted OTP: {otp}\n"
+            f"Active Monitors: {list(active_number_monitors.keys())}"
+        )
+
+# === ADMIN JOBS ===
+# Long admin operations (uploads, /cleanup, /deleteall) run as jobs on a small worker pool instead
+# of inside the command handler. Each job edits a single progress message (throttled), can be
+# listed with /jobs and cancelled with /canceljob, and its status is kept in MongoDB.
+JOB_STATUS_ICONS = {
+    "queued": "🕒",
+    "running": "⏳",
+    "done": "✅",
+    "failed": "❌",
+    "cancelled": "🛑",
+    "interrupted": "⚠️",
+}
+JOB_FINISHED_STATUSES = ("done", "failed", "cancelled", "interrupted")
+admin_jobs = {}  # job_id -> job dict, for jobs submitted to this process
+admin_job_queue = None  # Created by admin_job_runner_task()
+jobs_db = None  # Set by init_admin_jobs()
+
+async def init_admin_jobs(db):
+    """Remember the jobs database and mark jobs this process left unfinished as interrupted"""
+    global jobs_db
+    jobs_db = db
+    try:
+        await db[JOBS_COLLECTION].create_index([("created_at", -1)])
+        result = await db[JOBS_COLLECTION].update_many(
+            {"worker": WORKER_ID, "status": {"$in": ["queued", "running"]}},
+            {"$set": {"status": "interrupted", "finished_at": datetime.now(TIMEZONE)}}
+        )
+        if result.modified_count:
+            logging.warning(f"⚠️ Marked {result.modified_count} admin job(s) interrupted by the restart")
+    except Exception as e:
+        logging.error(f"❌ Failed to initialize admin jobs: {e}")
+
+def render_job_message(job):
+    """Text of a job's progress message"""
+    lines = [
+        f"{JOB_STATUS_ICONS[job['status']]} Job {job['id']} - {job['title']}",
+        f"Status: {job['status']}",
+    ]
+    if job.get('progress'):
+        lines.extend(["", job['progress']])
+    if job.get('result'):
+        lines.extend(["", f"Result: {job['result']}"])
+    if job.get('error'):
+        lines.extend(["", f"Error: {job['error']}"])
+    if job['status'] in ("queued", "running"):
+        lines.extend(["", f"Cancel with /canceljob {job['id']}"])
+    return "\n".join(lines)
+
+async def _save_job(job):
+    """Persist a job's status (without its callable) to MongoDB"""
+    if jobs_db is None:
+        return
+    try:
+        doc = {key: value for key, value in job.items() if key not in ("func", "task", "bot", "last_report")}
+        doc["_id"] = job["id"]
+        await jobs_db[JOBS_COLLECTION].replace_one({"_id": job["id"]}, doc, upsert=True)
+    except Exception as e:
+        logging.error(f"❌ Failed to save admin job {job['id']}: {e}")
+
+async def _publish_job(job, bot):
+    """Edit the job's progress message and persist its status"""
+    if job.get('message_id'):
+        queue_bot_call(
+            bot,
+            "edit_message_text",
+            priority=PRIORITY_ADMIN,
+            chat_id=job['chat_id'],
+            message_id=job['message_id'],
+            text=render_job_message(job)
+        )
+    await _save_job(job)
+
+async def report_job_progress(job, text, force=False):
+    """Update a job's progress text; the message is edited at most every JOB_PROGRESS_INTERVAL seconds"""
+    job['progress'] = text
+    now = time.monotonic()
+    if not force and now - job['last_report'] < JOB_PROGRESS_INTERVAL:
+        return
+    job['last_report'] = now
+    await _publish_job(job, job['bot'])
+
+def _prune_admin_jobs():
+    """Forget the oldest finished jobs once more than ADMIN_JOBS_KEPT are remembered"""
+    finished = [job for job in admin_jobs.values() if job['status'] in JOB_FINISHED_STATUSES]
+    for job in sorted(finished, key=lambda job: job['created_at'])[:max(0, len(finished) - ADMIN_JOBS_KEPT)]:
+        del admin_jobs[job['id']]
+
+async def submit_admin_job(app, user_id, chat_id, kind, title, func):
+    """Queue func(job) as an admin job and post its progress message"""
+    job = {
+        'id': uuid.uuid4().hex[:8],
+        'kind': kind,
+        'title': title,
+        'user_id': user_id,
+        'chat_id': chat_id,
+        'message_id': None,
+        'status': "queued",
+        'progress': None,
+        'result': None,
+        'error': None,
+        'worker': WORKER_ID,
+        'created_at': datetime.now(TIMEZONE),
+        'started_at': None,
+        'finished_at': None,
+        'func': func,
+        'task': None,
+        'bot': app.bot,
+        'last_report': 0,
+    }
+    _prune_admin_jobs()
+    admin_jobs[job['id']] = job
+    
+    try:
+        message = await queue_bot_call(
+            app.bot, "send_message", priority=PRIORITY_ADMIN, chat_id=chat_id, text=render_job_message(job)
+        )
+        job['message_id'] = message.message_id
+    except Exception as e:
+        logging.error(f"❌ Failed to post progress message for job {job['id']}: {e}")
+    
+    await _save_job(job)
+    if admin_job_queue is None:
+        # Job runner not started (e.g. during startup) - run the job right away
+        asyncio.create_task(_run_admin_job(job))
+    else:
+        admin_job_queue.put_nowait(job)
+    logging.info(f"🧰 Admin job {job['id']} ({kind}) queued by {user_id}: {title}")
+    return job
+
+async def _run_admin_job(job):
+    """Run one job to completion, recording how it ended"""
+    job['status'] = "running"
+    job['started_at'] = datetime.now(TIMEZONE)
+    # Create the task before the first await so /canceljob always finds it
+    job['task'] = asyncio.create_task(job['func'](job))
+    try:
+        await _publish_job(job, job['bot'])
+        await asyncio.wait([job['task']])
+    except asyncio.CancelledError:
+        # The runner is shutting down
+        job['task'].cancel()
+        job['status'] = "interrupted"
+        job['finished_at'] = datetime.now(TIMEZONE)
+        await _save_job(job)
+        raise
+    
+    if job['task'].cancelled():
+        job['status'] = "cancelled"
+    elif job['task'].exception() is not None:
+        job['status'] = "failed"
+        job['error'] = str(job['task'].exception())
+        logging.error(f"❌ Admin job {job['id']} failed: {job['error']}")
+    else:
+        job['status'] = "done"
+    job['finished_at'] = datetime.now(TIMEZONE)
+    metric_observe("bot_admin_job_seconds", (job['finished_at'] - job['started_at']).total_seconds(),
+                   kind=job['kind'], status=job['status'])
+    await _publish_job(job, job['bot'])
+    logging.info(f"🧰 Admin job {job['id']} finished: {job['status']}")
+
+async def admin_job_worker(worker_number):
+    """Take jobs from the queue one at a time"""
+    while True:
+        job = await admin_job_queue.get()
+        if job['status'] != "queued":
+            continue  # Cancelled while waiting
+        try:
+            await _run_admin_job(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"❌ Admin job worker {worker_number} error: {e}")
+
+async def admin_job_runner_task(app):
+    """Background task running JOB_WORKERS admin job workers"""
+    global admin_job_queue
+    admin_job_queue = asyncio.Queue()
+    workers = [asyncio.create_task(admin_job_worker(n)) for n in range(JOB_WORKERS)]
+    logging.info(f"🧰 Admin job runner started with {JOB_WORKERS} worker(s)")
+    try:
+        await asyncio.gather(*workers)
+    except asyncio.CancelledError:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        logging.info("🛑 Admin job runner stopped")
+    finally:
+        admin_job_queue = None
+
+def cancel_admin_job(job_id):
+    """Cancel a queued or running job; returns False if it is unknown or already finished"""
+    job = admin_jobs.get(job_id)
+    if job is None or job['status'] in JOB_FINISHED_STATUSES:
+        return False
+    if job['status'] == "queued":
+        job['status'] = "cancelled"
+        job['finished_at'] = datetime.now(TIMEZONE)
+        asyncio.create_task(_publish_job(job, job['bot']))
+    else:
+        job['task'].cancel()
+    return True
+
+async def start_upload_job(update: Update, context: ContextTypes.DEFAULT_TYPE, country_name, process_func):
+    """Run an upload as an admin job so the admin (and everyone else) is not blocked while it runs"""
+    user_id = update.effective_user.id
+    user_states[user_id] = "upload_running"
+    
+    async def run(job):
+        try:
+            await process_func(update, context, country_name, job)
+        finally:
+            # On failure or cancellation the numbers and CSV are kept so the upload can be retried
+            if user_states.get(user_id) == "upload_running":
+                del user_states[user_id]
+            await save_admin_flow(user_id)
+    
+    await submit_admin_job(context.application, user_id, update.effective_chat.id, "upload", f"Upload to {country_name}", run)
+
+async def list_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the most recent admin jobs"""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        await send_lol_message(update)
+        return
+    
+    jobs = []
+    if jobs_db is not None:
+        try:
+            jobs = await jobs_db[JOBS_COLLECTION].find({}).sort("created_at", -1).limit(JOB_LIST_LIMIT).to_list(length=JOB_LIST_LIMIT)
+        except Exception as e:
+            logging.error(f"❌ Failed to load admin jobs: {e}")
+    if not jobs:
+        jobs = sorted(admin_jobs.values(), key=lambda job: job['created_at'], reverse=True)[:JOB_LIST_LIMIT]
+    
+    if not jobs:
+        await update.message.reply_text("🧰 No admin jobs yet.")
+        return
+    
+    lines = ["🧰 Recent admin jobs:", ""]
+    for job in jobs:
+        icon = JOB_STATUS_ICONS.get(job['status'], "❔")
+        lines.append(f"{icon} {job.get('id', job.get('_id'))} - {job['title']} ({job['status']})")
+        detail = job.get('error') or job.get('result') or job.get('progress')
+        if detail:
+            lines.append(f"    {detail.splitlines()[0]}")
+    lines.extend(["", "Cancel a queued or running job with /canceljob <id>"])
+    await update.message.reply_text("\n".join(lines))
+
+async def perf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show event-loop lag, captured stalls and the slowest handlers: /perf [reset]"""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        await send_lol_message(update)
+        return
+    
+    if context.args and context.args[0].lower() == "reset":
+        loop_lag_samples.clear()
+        loop_stalls.clear()
+        handler_timings.clear()
+        await update.message.reply_text("🩺 Performance statistics reset.")
+        return
+    
+    await update.message.reply_text("\n".join(perf_report_lines()), parse_mode=ParseMode.MARKDOWN)
 
-async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Test command for debugging"""
+async def otp_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show OTP hit rates and latencies per country and range: /otpstats [export] [hours] [country code]"""
     user_id = update.effective_user.id
     if user_id not in ADMIN_IDS:
         await send_lol_message(update)
         return
     
-    args = context.args
+    args = list(context.args or [])
+    export = bool(args) and args[0].lower() == "export"
+    if export:
+        args.pop(0)
+    hours = 24
     if args and args[0].isdigit():
-        # Test specific phone number
-        phone_number = args[0]
-        await update.message.reply_text(f"🔍 Testing OTP for number: {phone_number}")
-        
-        # Check SMS for this number
-        sms_info = await get_latest_sms_for_number(phone_number)
-        
-        if sms_info:
-            await update.message.reply_text(
-                f"📱 SMS Info for {phone_number}:\n"
-                f"Sender: {sms_info['sms']['sender']}\n"
-                f"Message: {sms_info['sms']['message']}\n"
-                f"OTP: {sms_info['otp']}\n"
-                f"Total Messages: {sms_info['total_messages']}"
-            )
-        else:
-            await update.message.reply_text(f"❌ No SMS found for {phone_number}")
+        hours = max(1, int(args.pop(0)))
+    country_code = args[0].lower() if args else None
+    
+    if otp_stats_db is None:
+        await update.message.reply_text("❌ OTP analytics are not available yet.")
+        return
+    try:
+        if export:
+            data = await export_otp_stats(hours, country_code)
+            filename = f"otp_stats_{hours}h{'_' + country_code if country_code else ''}.csv"
+            await update.message.reply_document(document=BytesIO(data), filename=filename,
+                                                caption=f"📈 OTP analytics buckets, last {hours}h")
+            return
+        groups = await load_otp_stats(hours, country_code)
+    except Exception as e:
+        logging.error(f"❌ Failed to load OTP analytics: {e}")
+        await update.message.reply_text(f"❌ Could not load OTP analytics: {e}")
+        return
+    await update.message.reply_text("\n".join(otp_stats_report_lines(groups, hours, country_code)))
+
+async def cancel_job_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancel an admin job: /canceljob <id>"""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        await send_lol_message(update)
+        return
+    
+    if not context.args:
+        await update.message.reply_text("❌ Usage: /canceljob <job id>\nUse /jobs to see job ids.")
+        return
+    
+    job_id = context.args[0]
+    if cancel_admin_job(job_id):
+        await update.message.reply_text(f"🛑 Cancelling job {job_id}...")
     else:
-        # Test OTP extraction
-        test_message = "# Snapchat 157737 is your one time passcode for phone enrollment"
-        otp = extract_otp_from_message(test_message)
-        
-        await update.message.reply_text(
-            f"🧪 Test Results:\n"
-            f"Test Message: {test_message}\n"
-            f"Extracted OTP: {otp}\n"
-            f"Active Monitors: {list(active_number_monitors.keys())}"
-        )
+        await update.message.reply_text(f"❌ Job {job_id} is not queued or running on this bot.")
 
 async def cleanup_used_numbers(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Clean up numbers that have received OTPs"""
@@ -2484,45 +4962,79 @@ async def cleanup_used_numbers(update: Update, context: ContextTypes.DEFAULT_TYP
         await send_lol_message(update)
         return
     
-    await update.message.reply_text("🧹 Starting cleanup of numbers with OTPs...")
-    
     db = context.bot_data["db"]
     coll = db[COLLECTION_NAME]
     countries_coll = db[COUNTRIES_COLLECTION]
     
-    # Get all numbers from database
-    all_numbers = await coll.find({}).to_list(length=None)
-    deleted_count = 0
-    kept_count = 0
-    
-    for num_data in all_numbers:
-        phone_number = num_data["number"]
-        country_code = num_data["country_code"]
+    async def run(job):
+        await report_job_progress(job, "🧹 Starting cleanup of numbers with OTPs...", force=True)
         
-        # Check if this number has received any OTPs
-        sms_info = await get_latest_sms_for_number(phone_number)
-        
-        if sms_info and sms_info['otp']:
-            # This number has received an OTP, delete it
-            await coll.delete_one({"number": phone_number})
+        total_numbers = await coll.count_documents({})
+        checked_count = 0
+        deleted_count = 0
+        # Leave part of the SMS API limiter free for live morning-call checks
+        check_limiter = asyncio.Semaphore(CLEANUP_CONCURRENCY)
+        
+        async def has_otp(num_data):
+            async with check_limiter:
+                sms_info = await get_latest_sms_for_number(num_data["number"])
+            return bool(sms_info and sms_info['otp'])
+        
+        async def flush(batch):
+            """Check a batch of numbers concurrently, then delete the used ones in bulk"""
+            nonlocal checked_count, deleted_count
+            results = await asyncio.gather(*(has_otp(num_data) for num_data in batch))
+            used = [num_data for num_data, used in zip(batch, results) if used]
+            checked_count += len(batch)
             
-            # Update country count
-            await countries_coll.update_one(
-                {"country_code": country_code},
-                {"$inc": {"number_count": -1}}
-            )
+            if used:
+                per_country = {}
+                for num_data in used:
+                    per_country.setdefault(num_data["country_code"], []).append(num_data["number"])
+                
+                # One delete per country, so each counter drops by what was actually deleted
+                # (a number may already be gone, e.g. handed out and removed meanwhile)
+                deleted_per_country = {}
+                for country_code, numbers in per_country.items():
+                    result = await coll.delete_many({"country_code": country_code, "number": {"$in": numbers}})
+                    if result.deleted_count:
+                        deleted_per_country[country_code] = result.deleted_count
+                batch_deleted = sum(deleted_per_country.values())
+                deleted_count += batch_deleted
+                
+                if deleted_per_country:
+                    await countries_coll.bulk_write([
+                        UpdateOne({"country_code": country_code}, {"$inc": {"number_count": -count}})
+                        for country_code, count in deleted_per_country.items()
+                    ], ordered=False)
+                logging.info(f"Cleaned up {batch_deleted} numbers with OTPs: {[num_data['number'] for num_data in used]}")
             
-            deleted_count += 1
-            logging.info(f"Cleaned up number {phone_number} with OTP: {sms_info['otp']}")
-        else:
-            kept_count += 1
+            await report_job_progress(
+                job,
+                f"🔍 Checked {checked_count}/{total_numbers} numbers\n"
+                f"🗑️ Deleted {deleted_count} numbers with OTPs"
+            )
+        
+        # Stream the numbers instead of loading the whole collection
+        batch = []
+        async for num_data in coll.find({}, {"number": 1, "country_code": 1, "_id": 0}):
+            batch.append(num_data)
+            if len(batch) >= CLEANUP_BATCH_SIZE:
+                await flush(batch)
+                batch = []
+        if batch:
+            await flush(batch)
+        
+        kept_count = checked_count - deleted_count
+        await report_job_progress(
+            job,
+            f"🗑️ Deleted {deleted_count} numbers with OTPs\n"
+            f"✅ Kept {kept_count} numbers without OTPs\n"
+            f"📊 Total processed: {checked_count}"
+        )
+        job['result'] = f"{deleted_count} deleted, {kept_count} kept"
     
-    await update.message.reply_text(
-        f"✅ Cleanup completed!\n\n"
-        f"🗑️ Deleted {deleted_count} numbers with OTPs\n"
-        f"✅ Kept {kept_count} numbers without OTPs\n"
-        f"📊 Total processed: {deleted_count + kept_count}"
-    )
+    await submit_admin_job(context.application, user_id, update.effective_chat.id, "cleanup", "Cleanup numbers with OTPs", run)
 
 async def force_otp_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Force OTP check for a specific number"""
@@ -2646,10 +5158,10 @@ async def show_my_morning_calls(update: Update, context: ContextTypes.DEFAULT_TY
         country_name = session_data['country_name']
         start_time = session_data['start_time']
         
-        # Calculate remaining time (2 minutes = 120 seconds)
+        # Calculate remaining time of the morning call window
         current_time = datetime.now(TIMEZONE)
         elapsed = (current_time - start_time).total_seconds()
-        remaining = max(0, 120 - elapsed)
+        remaining = max(0, MORNING_CALL_TIMEOUT - elapsed)
         
         status_text += f"📱 {format_number_display(phone_number)}\n"
         status_text += f"   🌍 {country_name}\n"
@@ -2789,15 +5301,15 @@ async def update_sms_session(update: Update, context: ContextTypes.DEFAULT_TYPE)
                         # Update runtime session (immediate effect)
                         update_runtime_session(new_cookie)
                         
-                        # Update config file (for bot restart persistence) 
-                        config_updated = "✅ Config file updated" if update_config_file_session(new_cookie) else "⚠️ Config file update failed"
+                        # Save in the local session store (for bot restart persistence)
+                        config_updated = "✅ Saved for restarts" if await save_runtime_session(new_cookie) else "⚠️ Saving for restarts failed"
                         
                         await update.message.reply_text(
                             f"✅ **SMS API Session Updated Successfully!**\n\n"
                             f"🔑 **New session:** `{new_cookie[:20]}...{new_cookie[-10:]}`\n"
                             f"🔑 **Old session:** `{old_cookie[:20]}...{old_cookie[-10:]}`\n\n"
                             f"🔄 **Status:** Active immediately (no restart needed)\n"
-                            f"📁 **Config:** {config_updated}\n"
+                            f"💾 **Store:** {config_updated}\n"
                             f"🎯 **API:** Ready for OTP detection\n\n"
                             f"_Session updated at {now.strftime('%Y-%m-%d %H:%M:%S')}_",
                             parse_mode=ParseMode.MARKDOWN
@@ -2853,6 +5365,12 @@ async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 1️⃣7️⃣ `/reloadsession` - Reload session from config.py file
 1️⃣8️⃣ `/clearcache` - Clear countries cache for performance
 
+**🧰 BACKGROUND JOBS:**
+1️⃣9️⃣ `/jobs` - List recent uploads, cleanups and deletions
+2️⃣0️⃣ `/canceljob a1b2c3d4` - Cancel a queued or running job
+2️⃣1️⃣ `/perf` - Event-loop lag, stalls and slowest handlers (`/perf reset` clears them)
+2️⃣2️⃣ `/otpstats 24 ci` - OTP hit rate and latency SLO per country and range (`/otpstats export 168` sends the CSV)
+
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━
 📋 **QUICK EXAMPLES:**
 
@@ -3026,6 +5544,8 @@ async def ensure_all_database_indexes(db):
         await numbers_coll.create_index([("country_code", 1), ("number", 1)])  # Compound for country+number
         await numbers_coll.create_index("added_at")  # For time-based queries
         await numbers_coll.create_index("detected_country")  # For country detection queries
+        await numbers_coll.create_index([("country_code", 1), ("quality_score", -1), ("available_after", 1)])  # Best available numbers
+        await numbers_coll.create_index([("status", 1), ("available_after", 1)])  # Quarantine releases
         
         # Countries collection indexes
         countries_coll = db[COUNTRIES_COLLECTION]
@@ -3051,6 +5571,7 @@ async def check_database_health(db):
         start_time = time.time()
         await db.command('ping')
         ping_time = (time.time() - start_time) * 1000  # Convert to milliseconds
+        metric_observe("bot_database_ping_seconds", ping_time / 1000)
         
         # Get database stats
         stats = await db.command('dbStats')
@@ -3071,10 +5592,12 @@ async def check_database_health(db):
         }
         
         logging.info(f"📊 Database health: {health_info}")
+        metric_inc("bot_database_health_checks_total", status=health_info['status'])
         return health_info
         
     except Exception as e:
         logging.error(f"❌ Database health check failed: {e}")
+        metric_inc("bot_database_health_checks_total", status="unhealthy")
         return {'status': 'unhealthy', 'error': str(e)}
 
 async def retry_database_operation(operation, max_retries=3, delay=1):
@@ -3100,65 +5623,498 @@ async def safe_database_operation(db_operation, default_value=None, operation_na
         return default_value
 
 # === CSV PROCESSING ===
-async def process_csv_file(file_bytes, progress_callback=None):
-    """Process the uploaded CSV file and return extracted numbers with progress updates"""
+# === NUMBER BATCHES ===
+class NumberBatch:
+    """Columnar batch of uploaded numbers, used from CSV parsing through insertion and reports
+    
+    Rows are stored in parallel arrays instead of one dict per number: numbers as 64-bit integers
+    (with a side table for the rare ones that do not round-trip, e.g. a leading zero), ranges and
+    country codes as ids into one interned string table, and the source as one byte. Original
+    spellings are only kept when they differ from the cleaned number. Panel payout and limits
+    metadata is interned like ranges. Numbers whose country could not be detected are not rows;
+    their original spellings are kept in `invalid` for the report.
+    """
+    __slots__ = (
+        "numbers", "text_numbers", "original_numbers", "range_ids", "country_ids", "payout_ids", "limits_ids",
+        "sources", "strings", "string_ids", "invalid"
+    )
+    
+    MANUAL = 0
+    CSV = 1
+    
+    def __init__(self):
+        self.numbers = array('Q')
+        self.text_numbers = {}  # row -> number that does not fit in an integer
+        self.original_numbers = {}  # row -> original spelling when it differs from the number
+        self.range_ids = array('I')
+        self.country_ids = array('I')
+        self.payout_ids = array('I')
+        self.limits_ids = array('I')
+        self.sources = bytearray()
+        self.strings = [""]  # Interned ranges, country codes and metadata, id 0 is "no value"
+        self.string_ids = {"": 0}
+        self.invalid = []  # Original spellings of skipped numbers
+    
+    def __len__(self):
+        return len(self.sources)
+    
+    @staticmethod
+    def number_key(number):
+        """Integer form of a number when it round-trips, otherwise the number itself"""
+        if number.isdigit() and not number.startswith("0") and len(number) <= 19:
+            return int(number)
+        return number
+    
+    def _intern(self, value):
+        value = value or ""
+        string_id = self.string_ids.get(value)
+        if string_id is None:
+            string_id = self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        return string_id
+    
+    def append(self, number, original_number=None, range_val="", country_code=None, source=CSV, payout="", limits=""):
+        """Add one row"""
+        row = len(self.sources)
+        key = self.number_key(number)
+        if isinstance(key, int):
+            self.numbers.append(key)
+        else:
+            self.numbers.append(0)
+            self.text_numbers[row] = number
+        if original_number and original_number != number:
+            self.original_numbers[row] = original_number
+        self.range_ids.append(self._intern(range_val))
+        self.country_ids.append(self._intern(country_code))
+        self.payout_ids.append(self._intern(payout))
+        self.limits_ids.append(self._intern(limits))
+        self.sources.append(source)
+    
+    def extend(self, other):
+        """Append all rows of another batch"""
+        offset = len(self)
+        id_map = [self._intern(value) for value in other.strings]
+        self.numbers.extend(other.numbers)
+        self.text_numbers.update((row + offset, number) for row, number in other.text_numbers.items())
+        self.original_numbers.update((row + offset, number) for row, number in other.original_numbers.items())
+        self.range_ids.extend(id_map[string_id] for string_id in other.range_ids)
+        self.country_ids.extend(id_map[string_id] for string_id in other.country_ids)
+        self.payout_ids.extend(id_map[string_id] for string_id in other.payout_ids)
+        self.limits_ids.extend(id_map[string_id] for string_id in other.limits_ids)
+        self.sources.extend(other.sources)
+        self.invalid.extend(other.invalid)
+    
+    def select(self, rows):
+        """New batch holding only the given rows, in order"""
+        selected = NumberBatch()
+        for row in rows:
+            selected.append(
+                self.number(row), self.original_number(row), self.range(row), self.country_code(row), self.sources[row],
+                self.strings[self.payout_ids[row]], self.strings[self.limits_ids[row]]
+            )
+        return selected
+    
+    def key(self, row):
+        """Value to compare numbers by (see number_key)"""
+        text = self.text_numbers.get(row)
+        return text if text is not None else self.numbers[row]
+    
+    def number(self, row):
+        text = self.text_numbers.get(row)
+        return text if text is not None else str(self.numbers[row])
+    
+    def original_number(self, row):
+        return self.original_numbers.get(row) or self.number(row)
+    
+    def range(self, row):
+        return self.strings[self.range_ids[row]]
+    
+    def country_code(self, row):
+        return self.strings[self.country_ids[row]] or None
+    
+    def source(self, row):
+        return "manual" if self.sources[row] == self.MANUAL else "csv"
+    
+    def country_counts(self):
+        """Rows per detected country code"""
+        counts = {}
+        for string_id in self.country_ids:
+            if string_id:
+                counts[string_id] = counts.get(string_id, 0) + 1
+        return {self.strings[string_id]: count for string_id, count in counts.items()}
+    
+    def documents(self, country_code, detected_country, added_at, start=0, stop=None):
+        """Build the MongoDB documents for rows start..stop (payout/limits only when the export had them)"""
+        documents = []
+        for row in range(start, len(self) if stop is None else min(stop, len(self))):
+            document = {
+                "country_code": country_code,
+                "number": self.number(row),
+                "original_number": self.original_number(row),
+                "range": self.range(row),
+                "detected_country": detected_country,
+                "added_at": added_at,
+                "quality_score": NUMBER_QUALITY_UNTESTED,  # Seeded from number_stats on insert
+                "available_after": added_at
+            }
+            if self.payout_ids[row]:
+                document["payout"] = self.strings[self.payout_ids[row]]
+            if self.limits_ids[row]:
+                document["limits"] = self.strings[self.limits_ids[row]]
+            documents.append(document)
+        return documents
+
+# === UPLOAD REPORTS ===
+class UploadReport:
+    """Per-row upload report, written to a spooled temporary file while the upload runs (closed by a with block)
+    
+    Outcomes: inserted, country_mismatch (inserted, but the number's detected country differs from the
+    upload's), duplicate (already in this upload or in the database), invalid (no country detected)
+    and failed (insert error).
+    """
+    OUTCOMES = ("inserted", "country_mismatch", "duplicate", "invalid", "failed")
+    
+    def __init__(self, custom_name, detected_country):
+        self.custom_name = custom_name
+        self.detected_country = detected_country
+        self.flag = get_country_flag(detected_country)
+        self.counts = dict.fromkeys(self.OUTCOMES, 0)
+        self.file = tempfile.SpooledTemporaryFile(max_size=UPLOAD_REPORT_SPOOL_BYTES, mode="w+b")
+        self.text = TextIOWrapper(self.file, encoding='utf-8', newline='', write_through=True)
+        self.writer = csv.writer(self.text, lineterminator="\n")
+        self.writer.writerow(["Number", "Custom Country", "Detected Country", "Source", "Outcome"])
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        # Also when the upload job is cancelled or fails before the report is sent
+        self.close()
+    
+    @property
+    def rows(self):
+        return sum(self.counts.values())
+    
+    def _write(self, number, detected_country, source, outcome):
+        self.counts[outcome] += 1
+        self.writer.writerow([f"{self.flag} {number}", self.custom_name, detected_country.upper(), source, outcome])
+    
+    def add(self, numbers, row, outcome="inserted"):
+        """Record the outcome of one NumberBatch row"""
+        row_country = numbers.country_code(row) or ""
+        if outcome == "inserted" and row_country and row_country != self.detected_country:
+            outcome = "country_mismatch"
+        self._write(numbers.number(row), row_country, numbers.source(row), outcome)
+    
+    def add_invalid(self, numbers):
+        """Record the numbers that were skipped while parsing"""
+        for number in numbers.invalid:
+            self._write(number, "", "csv", "invalid")
+    
+    def summary_lines(self):
+        """Report lines for the outcomes other than a plain insert"""
+        labels = {
+            "country_mismatch": "🌐 Country mismatches (uploaded)",
+            "duplicate": "🔁 Duplicates skipped",
+            "invalid": "⚠️ Invalid numbers skipped",
+            "failed": "❌ Failed inserts",
+        }
+        return [f"{label}: {self.counts[outcome]}" for outcome, label in labels.items() if self.counts[outcome]]
+    
+    async def send(self, message, filename, caption):
+        """Send the report as a document, gzipped when large, and close it"""
+        try:
+            size = self.file.tell()
+            self.file.seek(0)
+            document = self.file
+            if size > UPLOAD_REPORT_GZIP_BYTES:
+                document = tempfile.SpooledTemporaryFile(max_size=UPLOAD_REPORT_SPOOL_BYTES, mode="w+b")
+                with gzip.GzipFile(filename=filename, mode="wb", fileobj=document) as gz:
+                    shutil.copyfileobj(self.file, gz)
+                document.seek(0)
+                filename += ".gz"
+                caption += " (gzip)"
+            await message.reply_document(document=document, filename=filename, caption=caption)
+            if document is not self.file:
+                document.close()
+        finally:
+            self.close()
+    
+    def close(self):
+        if self.text.closed:
+            return
+        for outcome, count in self.counts.items():
+            if count:
+                metric_inc("bot_upload_numbers_total", count, outcome=outcome)
+        self.text.close()  # Closes the spooled file too
+
+async def insert_upload_batch(coll, numbers, start, stop, country_code, detected_country, added_at, report):
+    """Insert rows start..stop of a NumberBatch, record each row's outcome and return the inserted count"""
+    documents = numbers.documents(country_code, detected_country, added_at, start, stop)
+    await seed_quality_scores(documents)
+    failed = {}  # index in documents -> outcome
     try:
-        # Convert bytes to string and create CSV reader
-        file_text = file_bytes.getvalue().decode('utf-8')
-        csv_reader = csv.DictReader(StringIO(file_text))
-        
-        # Verify required columns exist
-        if 'Number' not in csv_reader.fieldnames:
-            return None, "CSV file must contain a 'Number' column"
-        
-        # Count total rows for progress tracking
-        rows = list(csv_reader)
-        total_rows = len(rows)
-        
-        # Send initial progress update for large files
-        if total_rows > 1000 and progress_callback:
-            await progress_callback(f"📊 Processing {total_rows} numbers from CSV file...")
-        
-        # Process all rows with progress updates
-        numbers = []
-        processed_count = 0
-        
-        for i, row in enumerate(rows):
+        await coll.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get("writeErrors", []):
+            failed[error["index"]] = "duplicate" if error.get("code") == 11000 else "failed"
+        logging.warning(f"Batch insert for rows {start}-{start + len(documents)} had {len(failed)} errors")
+    except Exception as e:
+        logging.error(f"Batch insert error for rows {start}-{start + len(documents)}: {e}")
+        # Try individual inserts for this batch
+        for index, doc in enumerate(documents):
             try:
-                number = row.get('Number', '')
-                range_val = row.get('Range', '')
-                
-                if not number:
-                    continue
-                
-                cleaned_number = clean_number(number)
-                country_code = detect_country_code(cleaned_number, range_val)
-                
-                if country_code:
-                    numbers.append({
-                        'number': cleaned_number,
-                        'original_number': number,
-                        'country_code': country_code,
-                        'range': range_val
-                    })
-                
-                processed_count += 1
-                
-                # Progress update every 500 rows for large files
-                if total_rows > 1000 and progress_callback and processed_count % 500 == 0:
-                    percentage = (processed_count / total_rows) * 100
-                    await progress_callback(f"⏳ Processing... {processed_count}/{total_rows} ({percentage:.1f}%)")
-                    
-            except Exception as e:
-                logging.error(f"Error processing row {i}: {e}")
+                await coll.insert_one(doc)
+            except DuplicateKeyError:
+                failed[index] = "duplicate"
+            except Exception as single_error:
+                logging.error(f"Single insert error: {single_error}")
+                failed[index] = "failed"
+    
+    for index in range(len(documents)):
+        report.add(numbers, start + index, failed.get(index, "inserted"))
+    return len(documents) - len(failed)
+
+# === UPLOAD IMPORTERS ===
+# Each importer maps the columns of one export format onto the fields the upload pipeline uses
+# (number, range and the payout/limits metadata). The header of an upload is matched against the
+# importers in order; the first one whose required columns are all present is used.
+UPLOAD_IMPORTERS = [
+    {
+        "name": "SMS panel export (MSI SMS, Seven1Tel, Sniper SMS)",
+        "required": ("number", "range", "payout"),
+        "columns": {
+            "number": ("number",),
+            "range": ("range",),
+            "payout": ("my payout",),
+            "limits": ("limits",),
+        },
+    },
+    {
+        "name": "Number list",
+        "required": ("number",),
+        "columns": {
+            "number": ("number", "numbers", "phone", "phone number", "msisdn", "mobile"),
+            "range": ("range", "country", "operator"),
+        },
+    },
+]
+
+def register_importer(name, columns, required=("number",)):
+    """Add an importer for another export format, tried before the generic number list"""
+    UPLOAD_IMPORTERS.insert(len(UPLOAD_IMPORTERS) - 1, {"name": name, "required": tuple(required), "columns": columns})
+
+def match_importer(fieldnames):
+    """Find the importer for a header row, returns (importer, {field: column index}) or (None, None)"""
+    header = [name.strip().lower() for name in fieldnames]
+    for importer in UPLOAD_IMPORTERS:
+        mapping = {}
+        for field, aliases in importer["columns"].items():
+            for alias in aliases:
+                if alias in header:
+                    mapping[field] = header.index(alias)
+                    break
+        if all(field in mapping for field in importer["required"]):
+            return importer, mapping
+    return None, None
+
+def sniff_csv_dialect(sample):
+    """Delimiter and quote character of a CSV sample, as csv.reader keyword arguments"""
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
+        return {"delimiter": dialect.delimiter, "quotechar": dialect.quotechar or '"'}
+    except csv.Error:
+        return {"delimiter": ",", "quotechar": '"'}
+
+def _read_limited(stream, what):
+    data = stream.read(UPLOAD_MAX_UNPACKED_BYTES + 1)
+    if len(data) > UPLOAD_MAX_UNPACKED_BYTES:
+        raise ValueError(f"{what} is larger than {UPLOAD_MAX_UNPACKED_BYTES // (1024 * 1024)} MB when unpacked")
+    return data
+
+def _xlsx_to_csv(data):
+    """Convert the first sheet of an Excel workbook to CSV bytes (needs the optional openpyxl package)"""
+    try:
+        import openpyxl
+    except ImportError:
+        raise ValueError("Excel uploads need the optional openpyxl package (pip install openpyxl)")
+    
+    workbook = openpyxl.load_workbook(BytesIO(data), read_only=True, data_only=True)
+    try:
+        output = StringIO()
+        writer = csv.writer(output)
+        for row in workbook.worksheets[0].iter_rows(values_only=True):
+            writer.writerow([
+                "" if value is None else str(int(value)) if isinstance(value, float) and value.is_integer() else str(value)
+                for value in row
+            ])
+    finally:
+        workbook.close()
+    return output.getvalue().encode('utf-8')
+
+def unpack_upload(data):
+    """Return the CSV bytes of an upload (plain, gzip, zip or xlsx) and a label for its container"""
+    if data[:2] == b"\x1f\x8b":
+        with gzip.GzipFile(fileobj=BytesIO(data)) as gz:
+            data = _read_limited(gz, "Gzip upload")
+        data, label = unpack_upload(data)
+        return data, f"gzip/{label}"
+    
+    if data[:4] == b"PK\x03\x04":
+        with zipfile.ZipFile(BytesIO(data)) as archive:
+            names = archive.namelist()
+            if "xl/workbook.xml" in names:
+                return _xlsx_to_csv(data), "xlsx"
+            member = next(
+                (name for name in names
+                 if name.lower().endswith((".csv", ".txt", ".xlsx")) and not name.startswith("__MACOSX")),
+                None
+            )
+            if member is None:
+                raise ValueError("ZIP archive does not contain a .csv or .xlsx file")
+            with archive.open(member) as stream:
+                data = _read_limited(stream, member)
+        data, label = unpack_upload(data)
+        return data, f"zip/{label}"
+    
+    return data, "csv"
+
+# === CSV PARSING ===
+# Decoding, csv parsing, number cleaning and country detection are CPU-bound, so large uploads are
+# split into line-aligned chunks and parsed in a process pool; the event loop only stitches the
+# compact per-chunk arrays back together. Small files are parsed in a thread.
+csv_process_pool = None
+
+def get_csv_process_pool():
+    """Process pool for CSV parsing, started on first use"""
+    global csv_process_pool
+    if csv_process_pool is None:
+        csv_process_pool = ProcessPoolExecutor(
+            max_workers=CSV_PARSE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")  # Never fork the running event loop/threads
+        )
+    return csv_process_pool
+
+def shutdown_csv_process_pool():
+    """Stop the CSV parsing processes on shutdown"""
+    if csv_process_pool is not None:
+        csv_process_pool.shutdown(wait=False, cancel_futures=True)
+
+def _parse_csv_chunk(chunk, mapping, dialect):
+    """Parse a chunk of CSV rows (runs in a worker process)
+    
+    `mapping` is the importer's {field: column index}, `dialect` the sniffed csv.reader arguments.
+    Returns (batch, row_count); the NumberBatch holds the rows whose country could be detected and
+    lists the other numbers as invalid.
+    """
+    reader = csv.reader(StringIO(chunk.decode('utf-8')), **dialect)
+    number_index = mapping["number"]
+    range_index = mapping.get("range")
+    payout_index = mapping.get("payout")
+    limits_index = mapping.get("limits")
+    
+    def column(row, index):
+        return row[index].strip() if index is not None and index < len(row) else ''
+    
+    batch = NumberBatch()
+    row_count = 0
+    for row in reader:
+        row_count += 1
+        try:
+            number = column(row, number_index)
+            if not number:
                 continue
+            range_val = column(row, range_index)
+            cleaned_number = clean_number(number)
+            country_code = detect_country_code(cleaned_number, range_val)
+            if country_code:
+                batch.append(
+                    cleaned_number, number, range_val, country_code,
+                    payout=column(row, payout_index), limits=column(row, limits_index)
+                )
+            else:
+                batch.invalid.append(number)
+        except Exception as e:
+            # A bad row is reported as invalid instead of failing the whole upload
+            logging.error(f"Error processing row {row_count} of chunk: {e}")
+            batch.invalid.append(column(row, number_index) or ",".join(row))
+    return batch, row_count
+
+def _split_csv_chunks(data, start, chunk_bytes, quotechar=b'"'):
+    """Split CSV bytes after the header into chunks that end on a row boundary
+    
+    A newline only ends a row when it is outside quotes, i.e. after an even number of quote characters.
+    """
+    chunks = []
+    while start < len(data):
+        end = min(start + chunk_bytes, len(data))
+        while end < len(data):
+            newline = data.find(b"\n", end)
+            if newline == -1:
+                end = len(data)
+                break
+            end = newline + 1
+            if data.count(quotechar, start, end) % 2 == 0:
+                break
+        chunks.append(data[start:end])
+        start = end
+    return chunks
+
+async def process_csv_file(file_bytes, progress_callback=None):
+    """Process the uploaded file and return a NumberBatch of extracted numbers with progress updates
+    
+    Gzip, zip and xlsx uploads are unpacked to CSV first; the header and dialect pick the importer.
+    """
+    try:
+        data, container = await asyncio.to_thread(unpack_upload, file_bytes.getvalue())
+        
+        # Sniff the dialect and match the header row against the importers
+        header_end = data.find(b"\n") + 1 or len(data)
+        dialect = sniff_csv_dialect(data[:64 * 1024].decode('utf-8-sig', errors='ignore'))
+        header = data[:header_end].decode('utf-8-sig').strip()
+        fieldnames = next(csv.reader([header], **dialect), [])
+        importer, mapping = match_importer(fieldnames)
+        if importer is None:
+            return None, "File must contain a 'Number' column (or Numbers, Phone, Phone Number, MSISDN, Mobile)"
+        logging.info(f"Upload format: {importer['name']} ({container}), columns {mapping}")
+        if progress_callback:
+            await progress_callback(f"📑 Detected format: {importer['name']} ({container})")
+        
+        if len(data) < CSV_PARALLEL_MIN_BYTES:
+            # Not worth the process pool, but still kept off the event loop
+            results = [await asyncio.to_thread(_parse_csv_chunk, data[header_end:], mapping, dialect)]
+        else:
+            chunks = _split_csv_chunks(data, header_end, CSV_CHUNK_BYTES, dialect["quotechar"].encode('utf-8'))
+            if progress_callback:
+                await progress_callback(f"📊 Processing {len(data) // 1024} KB of CSV in {len(chunks)} chunks...")
+            
+            loop = asyncio.get_running_loop()
+            pool = get_csv_process_pool()
+            futures = [loop.run_in_executor(pool, _parse_csv_chunk, chunk, mapping, dialect) for chunk in chunks]
+            
+            # Report progress as chunks finish, keep the results in file order
+            pending = set(futures)
+            done_bytes = 0
+            chunk_sizes = {future: len(chunk) for future, chunk in zip(futures, chunks)}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                done_bytes += sum(chunk_sizes[future] for future in done)
+                if progress_callback:
+                    percentage = (done_bytes / (len(data) - header_end)) * 100
+                    await progress_callback(f"⏳ Processing... {percentage:.1f}% of the file parsed")
+            results = [future.result() for future in futures]
+        
+        numbers = NumberBatch()
+        total_rows = 0
+        for chunk_batch, row_count in results:
+            total_rows += row_count
+            numbers.extend(chunk_batch)
         
         return numbers, f"Processed {len(numbers)} numbers from {total_rows} rows"
     except Exception as e:
-        return None, f"Error processing CSV file: {str(e)}"
+        return None, f"Error processing upload: {str(e)}"
 
 async def upload_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global uploaded_csv
     user_id = update.effective_user.id
     if user_id not in ADMIN_IDS:
         await send_lol_message(update)
@@ -3169,17 +6125,17 @@ async def upload_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     file = update.message.document
-    if not file.file_name.lower().endswith('.csv'):
-        await update.message.reply_text("❌ Only CSV files are supported.")
+    if not file.file_name.lower().endswith(tuple(f".{extension}" for extension in UPLOAD_EXTENSIONS)):
+        await update.message.reply_text(f"❌ Supported files: {', '.join('.' + extension for extension in UPLOAD_EXTENSIONS)}")
         return
 
-    await update.message.reply_text("📥 CSV file received!")
+    await update.message.reply_text("📥 File received!")
 
     file_obj = await file.get_file()
     file_bytes = BytesIO()
     await file_obj.download_to_memory(out=file_bytes)
     file_bytes.seek(0)
-    uploaded_csv = file_bytes
+    uploaded_csvs[user_id] = file_bytes
 
     # Check if user is in add command flow (either waiting for manual numbers or CSV)
     if user_id in user_states and user_states[user_id] in ["waiting_for_csv", "waiting_for_manual_numbers"]:
@@ -3198,33 +6154,35 @@ async def upload_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Examples: India Ws, India Tg, Saudi Arabia, USA, etc.\n"
             "You can use custom names like 'India Ws' for WhatsApp numbers or 'India Tg' for Telegram numbers."
         )
+    
+    await save_admin_flow(user_id)
 
 async def addlist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Process CSV file by asking for country name directly"""
-    global uploaded_csv
     user_id = update.effective_user.id
     if user_id not in ADMIN_IDS:
         await send_lol_message(update)
         return
 
-    if not uploaded_csv:
+    if user_id not in uploaded_csvs:
         await update.message.reply_text("❌ No CSV file found. Please upload the file first.")
         return
 
     # Set user state to ask for country name directly
     user_states[user_id] = "waiting_for_country"
+    await save_admin_flow(user_id)
     await update.message.reply_text(
         "🌍 Please enter the country name for the numbers in the CSV file:\n"
         "Examples: Sri Lanka Ws, Sri Lanka Tg, India, Saudi Arabia, USA, etc.\n"
         "You can use custom names like 'India Ws' for WhatsApp numbers or 'India Tg' for Telegram numbers."
     )
 
-async def process_all_numbers_with_country(update: Update, context: ContextTypes.DEFAULT_TYPE, country_name):
-    """Process both manual numbers and CSV file with the provided country name"""
-    global uploaded_csv
+async def process_all_numbers_with_country(update: Update, context: ContextTypes.DEFAULT_TYPE, country_name, job):
+    """Process both manual numbers and CSV file with the provided country name (runs as an admin job)"""
     user_id = update.effective_user.id
+    uploaded_csv = uploaded_csvs.get(user_id)
     
-    await update.message.reply_text("🔍 Analyzing and processing all numbers...")
+    await report_job_progress(job, "🔍 Analyzing and processing all numbers...")
 
     db = context.bot_data["db"]
     coll = db[COLLECTION_NAME]
@@ -3235,56 +6193,40 @@ async def process_all_numbers_with_country(update: Update, context: ContextTypes
     logging.info(f"Manual numbers for user {user_id}: {len(manual_nums)} numbers - {manual_nums}")
     
     # Process CSV file if available with progress updates
-    csv_numbers = []
+    csv_numbers = NumberBatch()
     if uploaded_csv:
         logging.info(f"CSV file found for user {user_id}")
         # Create progress callback for CSV processing
         async def csv_progress_callback(message):
-            await update.message.reply_text(message)
+            await report_job_progress(job, message)
         
         csv_numbers, process_msg = await process_csv_file(uploaded_csv, csv_progress_callback)
         if not csv_numbers:
-            csv_numbers = []
+            csv_numbers = NumberBatch()
         logging.info(f"CSV numbers processed: {len(csv_numbers)} numbers")
     else:
         logging.info(f"No CSV file for user {user_id}")
 
-    # Combine all numbers
-    all_numbers = []
+    # Combine all numbers (manual first), keeping the detected country of each one
+    all_numbers = NumberBatch()
     
     # Add manual numbers
     for number in manual_nums:
-        all_numbers.append({
-            'number': number,
-            'original_number': number,
-            'country_code': None,
-            'range': '',
-            'source': 'manual'
-        })
+        all_numbers.append(number, number, '', detect_country_code(number, ''), NumberBatch.MANUAL)
     
-    # Add CSV numbers
-    for num_data in csv_numbers:
-        all_numbers.append({
-            'number': num_data['number'],
-            'original_number': num_data['original_number'],
-            'country_code': None,
-            'range': num_data.get('range', ''),
-            'source': 'csv'
-        })
+    # Add CSV numbers (their country was detected while parsing)
+    all_numbers.extend(csv_numbers)
 
     logging.info(f"Total combined numbers: {len(all_numbers)} (manual: {len(manual_nums)}, csv: {len(csv_numbers)})")
+    csv_numbers = None
     
     if not all_numbers:
         await update.message.reply_text("❌ No numbers found to process.")
-        logging.error(f"No numbers to process - manual_nums: {manual_nums}, csv_numbers: {csv_numbers}")
+        logging.error(f"No numbers to process - manual_nums: {manual_nums}, csv_numbers: 0")
         return
 
     # Detect the most common country from all numbers
-    detected_countries = {}
-    for num_data in all_numbers:
-        detected_country = detect_country_code(num_data['number'], num_data.get('range', ''))
-        if detected_country:
-            detected_countries[detected_country] = detected_countries.get(detected_country, 0) + 1
+    detected_countries = all_numbers.country_counts()
     
     # Get the most common detected country
     most_common_country = None
@@ -3297,243 +6239,175 @@ async def process_all_numbers_with_country(update: Update, context: ContextTypes
     
     # Store the detected country for flag purposes
     detected_country_code = most_common_country if most_common_country else "unknown"
-
-    # Set country code for all numbers
-    for num_data in all_numbers:
-        num_data['country_code'] = country_code
+    flag = get_country_flag(detected_country_code)
 
     # Upload to database using bulk operations for better performance
     inserted_count = 0
-    number_details = []
-    manual_count = 0
-    csv_count = 0
-    
-    # Prepare all documents for bulk insertion with duplicate detection
-    documents_to_insert = []
-    current_time = datetime.now(TIMEZONE)
-    seen_numbers = set()  # Track duplicates within this upload
-    duplicates_count = 0
-    
-    # Check for existing numbers in database to avoid duplicates
-    existing_numbers = set()
-    if len(all_numbers) > 100:  # Only check for large uploads to avoid overhead
-        # Get existing numbers for this country
-        existing_docs = await coll.find(
-            {"country_code": country_code}, 
-            {"number": 1, "_id": 0}
-        ).to_list(length=None)
-        existing_numbers = {doc["number"] for doc in existing_docs}
-    
-    for num_data in all_numbers:
-        number = num_data['number']
-        
-        # Skip duplicates within this upload
-        if number in seen_numbers:
-            duplicates_count += 1
-            continue
-            
-        # Skip if number already exists in database (for large uploads)
-        if number in existing_numbers:
-            duplicates_count += 1
-            continue
+    with UploadReport(country_display_name, detected_country_code) as report:
+        report.add_invalid(all_numbers)
+        
+        # Select the rows to insert with duplicate detection
+        unique_rows = array('I')
+        current_time = datetime.now(TIMEZONE)
+        seen_numbers = set()  # Track duplicates within this upload
+        duplicates_count = 0
+        
+        # Check for existing numbers in database to avoid duplicates
+        existing_numbers = set()
+        if len(all_numbers) > 100:  # Only check for large uploads to avoid overhead
+            # Get existing numbers for this country
+            existing_docs = await coll.find(
+                {"country_code": country_code}, 
+                {"number": 1, "_id": 0}
+            ).to_list(length=None)
+            existing_numbers = {NumberBatch.number_key(str(doc["number"])) for doc in existing_docs}
+            existing_docs = None
+        
+        for row in range(len(all_numbers)):
+            number = all_numbers.key(row)
+        
+            # Skip duplicates within this upload and numbers that already exist in database (for large uploads)
+            if number in seen_numbers or number in existing_numbers:
+                duplicates_count += 1
+                report.add(all_numbers, row, "duplicate")
+                continue
             
-        seen_numbers.add(number)
-        
-        documents_to_insert.append({
-            "country_code": num_data['country_code'],
-            "number": number,
-            "original_number": num_data['original_number'],
-            "range": num_data['range'],
-            "detected_country": detected_country_code,
-            "added_at": current_time
-        })
+            seen_numbers.add(number)
+            unique_rows.append(row)
         
-        if num_data['source'] == 'manual':
-            manual_count += 1
-        else:
-            csv_count += 1
+        upload_numbers = all_numbers if duplicates_count == 0 else all_numbers.select(unique_rows)
+        all_numbers = seen_numbers = existing_numbers = unique_rows = None
+        manual_count = upload_numbers.sources.count(NumberBatch.MANUAL)
+        csv_count = len(upload_numbers) - manual_count
         
-        # Get country flag from detected country, but display custom name
-        flag = get_country_flag(detected_country_code)
-        number_details.append(f"{flag} {number} - {country_display_name}")
-    
-    # Add duplicate info if any were found
-    if duplicates_count > 0:
-        await update.message.reply_text(
-            f"ℹ️ Skipped {duplicates_count} duplicate numbers\n"
-            f"Will upload {len(documents_to_insert)} unique numbers"
-        )
+        # Add duplicate info if any were found
+        if duplicates_count > 0:
+            await update.message.reply_text(
+                f"ℹ️ Skipped {duplicates_count} duplicate numbers\n"
+                f"Will upload {len(upload_numbers)} unique numbers"
+            )
 
-    # Perform bulk insert with batching for large uploads
-    if documents_to_insert:
-        try:
-            total_documents = len(documents_to_insert)
-            
+        # Insert in batches, writing each row's outcome to the report as its batch completes
+        total_documents = len(upload_numbers)
+        if total_documents:
             # Send progress message for large uploads
             if total_documents > 500:
-                progress_msg = await update.message.reply_text(
+                await report_job_progress(
+                    job,
                     f"⏳ Uploading {total_documents} numbers to database...\n"
                     "Using optimized bulk upload for faster processing."
                 )
-            
-            # Use batching for very large uploads to prevent memory/timeout issues
+        
             batch_size = 1000  # Insert 1000 documents at a time
-            inserted_count = 0
-            
-            if total_documents > batch_size:
-                # Process in batches
-                for i in range(0, total_documents, batch_size):
-                    batch = documents_to_insert[i:i + batch_size]
-                    
-                    try:
-                        result = await coll.insert_many(batch, ordered=False)
-                        batch_inserted = len(result.inserted_ids)
-                        inserted_count += batch_inserted
-                        
-                        # Update progress every batch
-                        if total_documents > 500:
-                            progress_percentage = (inserted_count / total_documents) * 100
-                            await progress_msg.edit_text(
-                                f"📊 Uploading... {inserted_count}/{total_documents} ({progress_percentage:.1f}%)\n"
-                                f"Processed {i//batch_size + 1} batch(es) of {batch_size} numbers"
-                            )
-                            
-                    except Exception as batch_error:
-                        logging.error(f"Batch insert error for batch {i//batch_size + 1}: {batch_error}")
-                        # Try individual inserts for this batch
-                        for doc in batch:
-                            try:
-                                await coll.insert_one(doc)
-                                inserted_count += 1
-                            except Exception as single_error:
-                                logging.error(f"Single insert error: {single_error}")
-                                continue
-            else:
-                # Small upload, use single bulk insert
-                result = await coll.insert_many(documents_to_insert, ordered=False)
-                inserted_count = len(result.inserted_ids)
+            for i in range(0, total_documents, batch_size):
+                inserted_count += await insert_upload_batch(
+                    coll, upload_numbers, i, i + batch_size, country_code, detected_country_code, current_time, report
+                )
             
+                # Update progress every batch
+                if total_documents > 500:
+                    progress_percentage = (min(i + batch_size, total_documents) / total_documents) * 100
+                    await report_job_progress(
+                        job,
+                        f"📊 Uploading... {inserted_count}/{total_documents} ({progress_percentage:.1f}%)\n"
+                        f"Processed {i//batch_size + 1} batch(es) of {batch_size} numbers"
+                    )
+        
             # Final progress update
             if total_documents > 500:
-                await progress_msg.edit_text(
+                await report_job_progress(
+                    job,
                     f"✅ Successfully uploaded {inserted_count} numbers!\n"
                     "Finalizing upload and updating statistics..."
                 )
-            
+        
             # Ensure database indexes exist for optimal performance
             await ensure_database_indexes(coll)
-                
-        except Exception as e:
-            logging.error(f"Bulk insert error: {e}")
-            # Fallback to individual inserts if all bulk operations fail
-            await update.message.reply_text("⚠️ Bulk upload failed, trying individual inserts...")
-            
-            for i, doc in enumerate(documents_to_insert):
-                try:
-                    await coll.insert_one(doc)
-                    inserted_count += 1
-                    
-                    # Progress update every 100 numbers
-                    if i > 0 and i % 100 == 0:
-                        await update.message.reply_text(f"📊 Uploaded {i}/{len(documents_to_insert)} numbers...")
-                        
-                except Exception as insert_error:
-                    logging.error(f"Error inserting individual number: {insert_error}")
-                    continue
 
-    # Update countries collection
-    await countries_coll.update_one(
-        {"country_code": country_code},
-        {"$set": {
-            "country_code": country_code,
-            "display_name": country_display_name,
-            "detected_country": detected_country_code,
-            "last_updated": datetime.now(TIMEZONE),
-            "number_count": inserted_count
-        }},
-        upsert=True
-    )
+        # Update countries collection
+        await countries_coll.update_one(
+            {"country_code": country_code},
+            {"$set": {
+                "country_code": country_code,
+                "display_name": country_display_name,
+                "detected_country": detected_country_code,
+                "last_updated": datetime.now(TIMEZONE),
+                "number_count": inserted_count
+            }},
+            upsert=True
+        )
 
-    # Clear all user data
-    uploaded_csv = None
-    if user_id in user_states:
-        del user_states[user_id]
-    if user_id in manual_numbers:
-        del manual_numbers[user_id]
-
-    # Prepare report
-    report_lines = [
-        "📊 Combined Upload Report:",
-        f"✅ Successfully uploaded {inserted_count} numbers",
-        f"📱 Manual numbers: {manual_count}",
-        f"📄 CSV numbers: {csv_count}",
-        f"🌍 Custom Name: {country_display_name}",
-    ]
-    
-    if most_common_country:
-        detected_country_name = "Unknown"
-        try:
-            country = pycountry.countries.get(alpha_2=most_common_country.upper())
-            if country:
-                detected_country_name = country.name
-        except:
-            pass
-        report_lines.append(f"🏳️ Detected Country: {detected_country_name} ({most_common_country.upper()})")
-    
-    report_lines.extend([
-        "",
-        "📋 Sample numbers:",
-        *number_details[:10]
-    ])
+        # Clear all user data
+        uploaded_csvs.pop(user_id, None)
+        if user_id in user_states:
+            del user_states[user_id]
+        if user_id in manual_numbers:
+            del manual_numbers[user_id]
+
+        # Prepare report
+        report_lines = [
+            "📊 Combined Upload Report:",
+            f"✅ Successfully uploaded {inserted_count} numbers",
+            f"📱 Manual numbers: {manual_count}",
+            f"📄 CSV numbers: {csv_count}",
+            f"🌍 Custom Name: {country_display_name}",
+            *report.summary_lines(),
+        ]
+        
+        if most_common_country:
+            detected_country_name = "Unknown"
+            try:
+                country = pycountry.countries.get(alpha_2=most_common_country.upper())
+                if country:
+                    detected_country_name = country.name
+            except:
+                pass
+            report_lines.append(f"🏳️ Detected Country: {detected_country_name} ({most_common_country.upper()})")
+        
+        # Get country flag from detected country, but display custom name
+        report_lines.extend([
+            "",
+            "📋 Sample numbers:",
+            *[f"{flag} {upload_numbers.number(row)} - {country_display_name}" for row in range(min(10, len(upload_numbers)))]
+        ])
 
-    if len(number_details) > 10:
-        report_lines.append(f"\n... and {len(number_details) - 10} more numbers")
-
-    # Send report
-    await update.message.reply_text("\n".join(report_lines))
-
-    # Send complete list as file if many numbers
-    if len(number_details) > 10:
-        report_file = BytesIO()
-        report_file.write("\n".join([
-            "Number,Custom Country,Detected Country,Source",
-            *[f"{num.split(' - ')[0]},{country_display_name},{detected_country_code.upper()},{'manual' if i < manual_count else 'csv'}" 
-              for i, num in enumerate(number_details)]
-        ]).encode('utf-8'))
-        report_file.seek(0)
-        await update.message.reply_document(
-            document=report_file,
-            filename="combined_number_upload_report.csv",
-            caption="📄 Complete combined number upload report"
-        )
+        if len(upload_numbers) > 10:
+            report_lines.append(f"\n... and {len(upload_numbers) - 10} more numbers")
+
+        # Send report
+        await update.message.reply_text("\n".join(report_lines))
+        job['result'] = f"{inserted_count} numbers uploaded to {country_display_name}"
 
-async def process_csv_with_country(update: Update, context: ContextTypes.DEFAULT_TYPE, country_name):
-    """Process CSV file with the provided country name"""
-    global uploaded_csv
+        # Send the per-row report as a file if many numbers or any were skipped
+        if report.rows > 10 or report.rows > report.counts["inserted"]:
+            await report.send(update.message, "combined_number_upload_report.csv", "📄 Complete combined number upload report")
+
+async def process_csv_with_country(update: Update, context: ContextTypes.DEFAULT_TYPE, country_name, job):
+    """Process CSV file with the provided country name (runs as an admin job)"""
     user_id = update.effective_user.id
+    uploaded_csv = uploaded_csvs.get(user_id)
     
     if not uploaded_csv:
         await update.message.reply_text("❌ No CSV file found. Please upload the file first.")
         return
 
-    await update.message.reply_text("🔍 Analyzing and processing numbers...")
+    await report_job_progress(job, "🔍 Analyzing and processing numbers...")
 
     db = context.bot_data["db"]
     coll = db[COLLECTION_NAME]
     countries_coll = db[COUNTRIES_COLLECTION]
 
     # Process CSV file first to detect country from numbers
-    numbers, process_msg = await process_csv_file(uploaded_csv)
+    async def csv_progress_callback(message):
+        await report_job_progress(job, message)
+    
+    numbers, process_msg = await process_csv_file(uploaded_csv, csv_progress_callback)
     if not numbers:
         await update.message.reply_text(f"❌ {process_msg}")
         return
 
     # Detect the most common country from the numbers
-    detected_countries = {}
-    for num_data in numbers:
-        detected_country = detect_country_code(num_data['number'], num_data.get('range', ''))
-        if detected_country:
-            detected_countries[detected_country] = detected_countries.get(detected_country, 0) + 1
+    detected_countries = numbers.country_counts()
     
     # Get the most common detected country
     most_common_country = None
@@ -3546,124 +6420,82 @@ async def process_csv_with_country(update: Update, context: ContextTypes.DEFAULT
     
     # Store the detected country for flag purposes
     detected_country_code = most_common_country if most_common_country else "unknown"
-
-    # Override country codes with the provided country
-    for num_data in numbers:
-        num_data['country_code'] = country_code
+    # Get country flag from detected country, but display custom name
+    flag = get_country_flag(detected_country_code)
 
     # Upload to database using bulk operations for better performance
     inserted_count = 0
-    number_details = []
-    
-    # Prepare all documents for bulk insertion
-    documents_to_insert = []
     current_time = datetime.now(TIMEZONE)
-    
-    for num_data in numbers:
-        documents_to_insert.append({
-            "country_code": num_data['country_code'],
-            "number": num_data['number'],
-            "original_number": num_data['original_number'],
-            "range": num_data['range'],
-            "detected_country": detected_country_code,  # Store detected country for flag
-            "added_at": current_time
-        })
+    with UploadReport(country_display_name, detected_country_code) as report:
+        report.add_invalid(numbers)
         
-        # Get country flag from detected country, but display custom name
-        flag = get_country_flag(detected_country_code)
-        number_details.append(f"{flag} {num_data['number']} - {country_display_name}")
-    
-    # Perform bulk insert
-    if documents_to_insert:
-        try:
+        # Perform bulk insert in batches, writing each row's outcome to the report as its batch completes
+        if len(numbers):
             # Send progress message for large uploads
-            if len(documents_to_insert) > 500:
-                progress_msg = await update.message.reply_text(
-                    f"⏳ Uploading {len(documents_to_insert)} numbers to database..."
-                )
-            
-            result = await coll.insert_many(documents_to_insert, ordered=False)
-            inserted_count = len(result.inserted_ids)
-            
-            if len(documents_to_insert) > 500:
-                await progress_msg.edit_text(
-                    f"✅ Successfully uploaded {inserted_count} numbers!"
+            if len(numbers) > 500:
+                await report_job_progress(job, f"⏳ Uploading {len(numbers)} numbers to database...")
+        
+            batch_size = 1000  # Documents are built per batch instead of all at once
+            for i in range(0, len(numbers), batch_size):
+                inserted_count += await insert_upload_batch(
+                    coll, numbers, i, i + batch_size, country_code, detected_country_code, current_time, report
                 )
-                
-        except Exception as e:
-            logging.error(f"Bulk insert error: {e}")
-            # Fallback to individual inserts
-            await update.message.reply_text("⚠️ Bulk upload failed, trying individual inserts...")
-            
-            for doc in documents_to_insert:
-                try:
-                    await coll.insert_one(doc)
-                    inserted_count += 1
-                except Exception as insert_error:
-                    logging.error(f"Error inserting individual number: {insert_error}")
-                    continue
+        
+            if len(numbers) > 500:
+                await report_job_progress(job, f"✅ Successfully uploaded {inserted_count} numbers!")
+
+        # Update countries collection
+        await countries_coll.update_one(
+            {"country_code": country_code},
+            {"$set": {
+                "country_code": country_code,
+                "display_name": country_display_name,
+                "detected_country": detected_country_code,  # Store detected country
+                "last_updated": datetime.now(TIMEZONE),
+                "number_count": inserted_count
+            }},
+            upsert=True
+        )
 
-    # Update countries collection
-    await countries_coll.update_one(
-        {"country_code": country_code},
-        {"$set": {
-            "country_code": country_code,
-            "display_name": country_display_name,
-            "detected_country": detected_country_code,  # Store detected country
-            "last_updated": datetime.now(TIMEZONE),
-            "number_count": inserted_count
-        }},
-        upsert=True
-    )
+        uploaded_csvs.pop(user_id, None)
+        # Clear user state
+        if user_id in user_states:
+            del user_states[user_id]
+
+        # Prepare report
+        report_lines = [
+            "📊 Upload Report:",
+            f"✅ Successfully uploaded {inserted_count} numbers",
+            f"🌍 Custom Name: {country_display_name}",
+            *report.summary_lines(),
+        ]
+        
+        if most_common_country:
+            detected_country_name = "Unknown"
+            try:
+                country = pycountry.countries.get(alpha_2=most_common_country.upper())
+                if country:
+                    detected_country_name = country.name
+            except:
+                pass
+            report_lines.append(f"🏳️ Detected Country: {detected_country_name} ({most_common_country.upper()})")
+        
+        report_lines.extend([
+            "",
+            "📋 Sample numbers:",
+            *[f"{flag} {numbers.number(row)} - {country_display_name}" for row in range(min(10, len(numbers)))]
+        ])
 
-    uploaded_csv = None
-    # Clear user state
-    if user_id in user_states:
-        del user_states[user_id]
+        if len(numbers) > 10:
+            report_lines.append(f"\n... and {len(numbers) - 10} more numbers")
 
-    # Prepare report
-    report_lines = [
-        "📊 Upload Report:",
-        f"✅ Successfully uploaded {inserted_count} numbers",
-        f"🌍 Custom Name: {country_display_name}",
-    ]
-    
-    if most_common_country:
-        detected_country_name = "Unknown"
-        try:
-            country = pycountry.countries.get(alpha_2=most_common_country.upper())
-            if country:
-                detected_country_name = country.name
-        except:
-            pass
-        report_lines.append(f"🏳️ Detected Country: {detected_country_name} ({most_common_country.upper()})")
-    
-    report_lines.extend([
-        "",
-        "📋 Sample numbers:",
-        *number_details[:10]
-    ])
+        # Send report
+        await update.message.reply_text("\n".join(report_lines))
+        job['result'] = f"{inserted_count} numbers uploaded to {country_display_name}"
 
-    if len(number_details) > 10:
-        report_lines.append(f"\n... and {len(number_details) - 10} more numbers")
-
-    # Send report
-    await update.message.reply_text("\n".join(report_lines))
-
-    # Send complete list as file if many numbers
-    if len(number_details) > 10:
-        report_file = BytesIO()
-        report_file.write("\n".join([
-            "Number,Custom Country,Detected Country",
-            *[f"{num.split(' - ')[0]},{country_display_name},{detected_country_code.upper()}" 
-              for num in number_details]
-        ]).encode('utf-8'))
-        report_file.seek(0)
-        await update.message.reply_document(
-            document=report_file,
-            filename="number_upload_report.csv",
-            caption="📄 Complete number upload report"
-        )
+        # Send the per-row report as a file if many numbers or any were skipped
+        if report.rows > 10 or report.rows > report.counts["inserted"]:
+            await report.send(update.message, "number_upload_report.csv", "📄 Complete number upload report")
 
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text messages for various inputs"""
@@ -3677,9 +6509,12 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         state = user_states[user_id]
         text = update.message.text.strip()
         
-        if state == "waiting_for_country":
+        if state == "upload_running":
+            await update.message.reply_text("⏳ Your upload is still running. Use /jobs to follow it or /canceljob to stop it.")
+        
+        elif state == "waiting_for_country":
             country_name = text
-            await process_csv_with_country(update, context, country_name)
+            await start_upload_job(update, context, country_name, process_csv_with_country)
         
         elif state == "waiting_for_manual_numbers":
             if text.lower() == "done":
@@ -3757,7 +6592,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         elif state == "waiting_for_name":
             country_name = text
-            await process_all_numbers_with_country(update, context, country_name)
+            await start_upload_job(update, context, country_name, process_all_numbers_with_country)
+        
+        await save_admin_flow(user_id)
 
 async def background_otp_cleanup_task(app):
     """Background task that runs every minute to check all numbers for OTPs and clean them"""
@@ -3782,8 +6619,35 @@ async def background_otp_cleanup_task(app):
                 coll = db[COLLECTION_NAME]
                 countries_coll = db[COUNTRIES_COLLECTION]
             
-                # Get all numbers from database
-                all_numbers = await coll.find({}).to_list(length=None)
+                if not owned_sweep_shards:
+                    logging.info("ℹ️ No sweep shards owned by this process - skipping background cleanup")
+                    continue
+                
+                # Quarantined numbers whose time is up go back to the pool
+                now = datetime.now(TIMEZONE)
+                released = await coll.update_many(
+                    {**sweep_shard_filter(), "status": "quarantined", "available_after": {"$lte": now}},
+                    {"$unset": {"status": "", "next_check_at": ""}}
+                )
+                if released.modified_count:
+                    logging.info(f"🔓 Background cleanup: Released {released.modified_count} number(s) from quarantine")
+                
+                # Get the numbers in this process's sweep shards (quarantined ones only when their recheck is due)
+                all_numbers = await coll.find({
+                    **sweep_shard_filter(),
+                    "$or": [{"status": {"$ne": "quarantined"}}, {"next_check_at": {"$lte": now}}]
+                }).to_list(length=None)
+                rechecked = [doc['number'] for doc in all_numbers if doc.get('status') == "quarantined"]
+                if rechecked:
+                    await coll.update_many(
+                        {"number": {"$in": rechecked}, "status": "quarantined"},
+                        {"$set": {"next_check_at": now + timedelta(seconds=QUARANTINE_RECHECK_INTERVAL)}}
+                    )
+                
+                # Numbers monitored by any process are left to their morning call
+                monitored_numbers = set(await db[SESSIONS_COLLECTION].distinct(
+                    "phone_number", {"expires_at": {"$gt": datetime.now(TIMEZONE)}}
+                ))
                 
                 if not all_numbers:
                     logging.info("ℹ️ No numbers in database to check")
@@ -3810,6 +6674,10 @@ async def background_otp_cleanup_task(app):
                                 logging.info(f"⏭️ Background cleanup: Skipping {phone_number} - has active monitoring session {session_id}")
                                 break
                         
+                        if not has_active_session and phone_number in monitored_numbers:
+                            has_active_session = True
+                            logging.info(f"⏭️ Background cleanup: Skipping {phone_number} - monitored by another worker")
+                        
                         if has_active_session:
                             skipped_count += 1
                             continue  # Skip this number, let real-time monitoring handle it
@@ -3844,15 +6712,15 @@ async def background_otp_cleanup_task(app):
                             for user_id, user_sessions in user_monitoring_sessions.items():
                                 for session_id, session_data in user_sessions.items():
                                     if session_data.get('phone_number') == phone_number:
-                                        try:
-                                            await app.bot.send_message(
-                                                chat_id=user_id,
-                                                text=f"📞 Number: {formatted_number}\n🔐 {sender} : {otp}"
-                                            )
-                                            users_notified += 1
-                                            logging.info(f"📱 Background cleanup: Sent OTP notification to user {user_id}")
-                                        except Exception as notify_error:
-                                            logging.error(f"Failed to notify user {user_id}: {notify_error}")
+                                        queue_bot_call(
+                                            app.bot,
+                                            "send_message",
+                                            priority=PRIORITY_OTP,
+                                            chat_id=user_id,
+                                            text=f"📞 Number: {formatted_number}\n🔐 {sender} : {otp}"
+                                        )
+                                        users_notified += 1
+                                        logging.info(f"📱 Background cleanup: Queued OTP notification for user {user_id}")
                                         break  # Only notify each user once
                             
                             # Stop any active monitoring sessions for this number
@@ -3883,6 +6751,9 @@ async def background_otp_cleanup_task(app):
                                 for session_id in user_sessions_to_remove:
                                     if session_id in user_sessions:
                                         del user_sessions[session_id]
+                                sessions_to_remove.extend(user_sessions_to_remove)
+                            
+                            await forget_monitoring_sessions(set(sessions_to_remove))
                             
                             # Log cleanup details to terminal only (no admin notifications)
                             session_info = f" - Stopped {sessions_stopped} monitoring session(s)" if sessions_stopped > 0 else ""
@@ -3898,6 +6769,7 @@ async def background_otp_cleanup_task(app):
                 
                 if cleaned_count > 0:
                     logging.info(f"✅ Background cleanup completed: {cleaned_count} numbers cleaned, {skipped_count} numbers skipped (active sessions)")
+                    record_admin_event('cleanup', f"{cleaned_count} number(s) with OTPs deleted, {skipped_count} skipped (active sessions)")
                 else:
                     skip_info = f", {skipped_count} numbers skipped (active sessions)" if skipped_count > 0 else ""
                     logging.info(f"ℹ️ Background cleanup completed: No numbers with OTPs found{skip_info}")
@@ -3919,12 +6791,45 @@ async def post_init(app):
     """Initialize background tasks after bot startup"""
     logging.info("🔄 Starting background tasks...")
     try:
+        # Open the local user store and migrate legacy JSON cache files
+        await init_user_store()
+        
+        # SMS panels route numbers by the range stored with them; saved logins are reused
+        init_sms_panels(app.bot_data["db"])
+        await restore_panel_sessions()
+        
+        # Resume morning calls and admin upload flows that were running before the restart
+        await init_session_store(app.bot_data["db"])
+        await init_leases(app.bot_data["db"])
+        await init_otp_stats(app.bot_data["db"])
+        await init_number_stats(app.bot_data["db"])
+        if runs_updater:
+            await restore_admin_flows()
+            await init_admin_jobs(app.bot_data["db"])
+        await warm_start_sessions(app)
+        
         # Store the task references in app.bot_data for cleanup later
-        cleanup_task = asyncio.create_task(background_otp_cleanup_task(app))
         health_task = asyncio.create_task(background_database_health_task(app))
+        user_store_task = asyncio.create_task(background_user_store_compaction_task(app))
+        outbound_task = asyncio.create_task(outbound_dispatcher_task(app))
+        digest_task = asyncio.create_task(admin_digest_task(app))
+        lease_task = asyncio.create_task(lease_heartbeat_task(app))
+        app.bot_data["panel_session_task"] = asyncio.create_task(panel_session_task(app))
+        app.bot_data["perf_task"] = asyncio.create_task(loop_lag_monitor_task(app))
+        if TRACE_EXPORTER:
+            app.bot_data["trace_task"] = asyncio.create_task(trace_export_task(app))
         
-        app.bot_data["cleanup_task"] = cleanup_task
         app.bot_data["health_task"] = health_task
+        app.bot_data["user_store_task"] = user_store_task
+        app.bot_data["outbound_task"] = outbound_task
+        app.bot_data["digest_task"] = digest_task
+        app.bot_data["lease_task"] = lease_task
+        
+        if runs_updater:
+            app.bot_data["job_runner_task"] = asyncio.create_task(admin_job_runner_task(app))
+        if runs_monitors:
+            app.bot_data["cleanup_task"] = asyncio.create_task(background_otp_cleanup_task(app))
+            app.bot_data["claim_task"] = asyncio.create_task(session_claim_task(app))
         
         logging.info("✅ Background tasks started successfully")
     except Exception as e:
@@ -3981,9 +6886,232 @@ async def background_database_health_task(app):
     finally:
         logging.info("📊 Database health monitoring finished")
 
+# === UPDATE PROCESSING ===
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Handle updates from different users concurrently while keeping each user's updates in order
+    
+    An update first waits for the earlier updates of its user (or chat, when there is no user) and
+    only then takes one of the max_concurrent_updates slots, so a user tapping buttons quickly queues
+    behind their own updates instead of holding slots every other user needs. PTB's own limit
+    (UPDATE_BACKLOG_LIMIT) only bounds how many updates are held at once.
+    """
+    
+    def __init__(self, max_concurrent_updates):
+        super().__init__(UPDATE_BACKLOG_LIMIT)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._running = 0
+        self._user_locks = {}  # key -> [lock, updates holding or waiting for it]
+    
+    @property
+    def current_concurrent_updates(self):
+        """Updates being handled in one of the slots right now"""
+        return self._running
+    
+    @property
+    def waiting_updates(self):
+        """Updates waiting for their user's earlier updates or for a free slot"""
+        return super().current_concurrent_updates - self._running
+    
+    @staticmethod
+    def serialization_key(update):
+        """User (or chat) whose updates must be handled in order, None for unordered updates"""
+        if isinstance(update, Update):
+            if update.effective_user:
+                return ("user", update.effective_user.id)
+            if update.effective_chat:
+                return ("chat", update.effective_chat.id)
+        return None
+    
+    async def _run_in_slot(self, coroutine):
+        async with self._slots:
+            self._running += 1
+            try:
+                await coroutine
+            finally:
+                self._running -= 1
+    
+    async def do_process_update(self, update, coroutine):
+        key = self.serialization_key(update)
+        if key is None:
+            await self._run_in_slot(coroutine)
+            return
+        
+        entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run_in_slot(coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[key]
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+# === HTTP SERVER ===
+# One aiohttp server on PORT serves the Telegram webhook (in webhook mode), the /health check
+# used by Docker/Koyeb, /metrics and a small status page, so no separate health script is needed.
+HTTP_PORT = int(os.environ.get("PORT", HTTP_PORT))
+UPDATE_MODE = os.environ.get("BOT_UPDATE_MODE", UPDATE_MODE).lower()
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", WEBHOOK_URL)
+bot_start_time = time.time()
+accepting_updates = True  # Cleared on shutdown so Telegram redelivers instead of us dropping updates
+
+STATUS_PAGE_HTML = """<!DOCTYPE html>
+<html><head><title>Telegram Bot - Bot Active</title>
+<style>body{{font-family:Arial,sans-serif;text-align:center;padding:50px;background:#f0f8ff}}
+.container{{max-width:600px;margin:0 auto;background:white;padding:40px;border-radius:10px;box-shadow:0 4px 6px rgba(0,0,0,0.1)}}
+.status{{color:#28a745;font-size:24px;font-weight:bold}}
+.endpoint{{background:#f8f9fa;padding:10px;margin:5px 0;border-left:4px solid #007bff;font-family:monospace;text-align:left}}
+</style></head><body>
+<div class="container">
+<h1>🤖 Telegram Bot</h1>
+<div class="status">✅ Bot Active</div>
+<p><strong>Role:</strong> {role} &nbsp; <strong>Updates:</strong> {mode}</p>
+<p><strong>Timestamp:</strong> {timestamp}Z</p>
+<div class="endpoint">GET / - This status page</div>
+<div class="endpoint">GET /health - JSON health check</div>
+<div class="endpoint">GET /metrics - Metrics (text format)</div>
+</div></body></html>"""
+
+def collect_metrics(app):
+    """Current values of the bot's gauges, as (name, help, value) tuples"""
+    outbound_depth = outbound_queue.qsize() if outbound_queue is not None else 0
+    return [
+        ("bot_uptime_seconds", "Seconds since the process started", round(time.time() - bot_start_time, 1)),
+        ("bot_active_monitors", "Morning call sessions monitored by this process", len(active_number_monitors)),
+        ("bot_update_queue_depth", "Telegram updates waiting to be processed", app.update_queue.qsize()),
+        ("bot_updates_in_progress", "Telegram updates being handled right now", app.update_processor.current_concurrent_updates),
+        ("bot_updates_waiting", "Telegram updates waiting for the same user's earlier updates or a free slot",
+         app.update_processor.waiting_updates),
+        ("bot_outbound_queue_depth", "Outbound Telegram calls waiting to be sent", outbound_depth),
+        ("bot_admin_events_buffered", "Admin events waiting for the next digest", len(admin_event_buffer)),
+        ("bot_sweep_shards_owned", "Background cleanup shards owned by this process", len(owned_sweep_shards)),
+        ("bot_panel_login_sessions", "Logged-in SMS panel sessions pooled by this process",
+         sum(len(mirror['sessions']) for panel in sms_panels.values() for mirror in panel.mirrors)),
+    ]
+
+async def health_handler(request):
+    """GET /health - JSON health check"""
+    app = request.app["bot_app"]
+    healthy = app.running and accepting_updates
+    if healthy:
+        status, message = "healthy", "Bot Active"
+    elif accepting_updates:
+        status, message = "starting", "Bot starting"
+    else:
+        status, message = "draining", "Bot shutting down"
+    return web.json_response(
+        {
+            "status": status,
+            "message": message,
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "service": "telegram-bot",
+            "role": BOT_ROLE,
+            "worker_id": WORKER_ID,
+            "update_mode": UPDATE_MODE,
+            "active_monitors": len(active_number_monitors),
+        },
+        status=200 if healthy else 503
+    )
+
+async def metrics_handler(request):
+    """GET /metrics - gauges, counters and histograms in the Prometheus text format"""
+    lines = []
+    for name, help_text, value in collect_metrics(request.app["bot_app"]):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    lines.extend(render_metrics())
+    return web.Response(text="\n".join(lines) + "\n", content_type="text/plain")
+
+async def status_page_handler(request):
+    """GET / - human readable status page"""
+    html = STATUS_PAGE_HTML.format(role=BOT_ROLE, mode=UPDATE_MODE, timestamp=datetime.utcnow().isoformat())
+    return web.Response(text=html, content_type="text/html")
+
+async def telegram_webhook_handler(request):
+    """POST WEBHOOK_PATH - hand a Telegram update to the application"""
+    app = request.app["bot_app"]
+    if WEBHOOK_SECRET_TOKEN and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET_TOKEN:
+        return web.Response(status=403)
+    if not accepting_updates:
+        # Telegram retries non-2xx responses, so the update is delivered to the next process
+        return web.Response(status=503)
+    try:
+        update = Update.de_json(await request.json(), app.bot)
+    except Exception as e:
+        logging.warning(f"⚠️ Ignoring malformed webhook payload: {e}")
+        return web.Response(status=400)
+    await app.update_queue.put(update)
+    return web.Response()
+
+async def start_http_server(app):
+    """Start the aiohttp server for the webhook, health check and metrics"""
+    http_app = web.Application()
+    http_app["bot_app"] = app
+    http_app.router.add_get("/", status_page_handler)
+    http_app.router.add_get("/health", health_handler)
+    http_app.router.add_get("/metrics", metrics_handler)
+    if UPDATE_MODE == "webhook" and runs_updater:
+        http_app.router.add_post(WEBHOOK_PATH, telegram_webhook_handler)
+    
+    runner = web.AppRunner(http_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", HTTP_PORT).start()
+    logging.info(f"🌐 HTTP server listening on port {HTTP_PORT} ({UPDATE_MODE} mode)")
+    return runner
+
+async def start_receiving_updates(app):
+    """Start polling, or register the webhook with Telegram"""
+    if UPDATE_MODE == "webhook":
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+        logging.info(f"📡 Webhook registered at {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    elif app.updater and not app.updater.running:
+        await app.updater.start_polling()
+    app.bot_data["receiving_updates"] = True
+
+async def stop_receiving_updates(app):
+    """Stop polling (the webhook stays registered for the next updater process)"""
+    if app.updater and app.updater.running:
+        await app.updater.stop()
+    app.bot_data["receiving_updates"] = False
+
+async def drain_updates(app, timeout=SHUTDOWN_DRAIN_TIMEOUT):
+    """Stop taking new updates and wait for the queued ones to be handled"""
+    global accepting_updates
+    accepting_updates = False
+    await stop_receiving_updates(app)
+    
+    def pending_updates():
+        processor = app.update_processor
+        return app.update_queue.qsize() + processor.current_concurrent_updates + processor.waiting_updates
+    
+    deadline = time.monotonic() + timeout
+    while pending_updates() and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    if not pending_updates():
+        logging.info("✅ Update queue drained")
+    else:
+        logging.warning(f"⚠️ Shutting down with {pending_updates()} unprocessed update(s)")
+
 async def main():
-    # Build the application
-    app = ApplicationBuilder().token(TOKEN).post_init(post_init).build()
+    # Build the application (webhook mode feeds updates from the HTTP server, so no Updater)
+    builder = ApplicationBuilder().token(TOKEN).concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+    if UPDATE_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise RuntimeError("WEBHOOK_URL must be set when UPDATE_MODE is 'webhook'")
+        builder = builder.updater(None)
+    app = builder.build()
     
     # Initialize the bot properly
     await app.initialize()
@@ -4012,6 +7140,9 @@ async def main():
         # Additional optimizations
         compressors=['zstd', 'zlib', 'snappy'],  # Enable compression
         zlibCompressionLevel=6,  # Compression level
+        
+        # Command timings for /metrics
+        event_listeners=[MongoCommandMetrics()],
     )
     
     # Test connection and get database
@@ -4032,14 +7163,16 @@ async def main():
         raise
 
     # Register handlers
+    # Slow admin checks use block=False so they run in the background instead of holding the
+    # admin's place in the per-user update order; bulk operations go through the admin job runner
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("test", test_command))
     app.add_handler(CommandHandler("add", add_command))
     app.add_handler(CommandHandler("delete", delete_country))
-    app.add_handler(CommandHandler("checkapi", check_api_connection))
+    app.add_handler(CommandHandler("checkapi", check_api_connection, block=False))
     app.add_handler(CommandHandler("checkdb", check_database_status))
-    app.add_handler(CommandHandler("diagnose", diagnose_deployment))
-    app.add_handler(CommandHandler("fixdb", fix_empty_database))
+    app.add_handler(CommandHandler("diagnose", diagnose_deployment, block=False))
+    app.add_handler(CommandHandler("fixdb", fix_empty_database, block=False))
     app.add_handler(CommandHandler("uploadstatus", check_upload_status))
     app.add_handler(CommandHandler("debugmanual", check_manual_numbers))
     app.add_handler(CommandHandler("quickadd", quickadd))
@@ -4048,7 +7181,11 @@ async def main():
     app.add_handler(CommandHandler("list", list_numbers))
     app.add_handler(CommandHandler("addlist", addlist))
     app.add_handler(CommandHandler("cleanup", cleanup_used_numbers))
-    app.add_handler(CommandHandler("forceotp", force_otp_check))
+    app.add_handler(CommandHandler("jobs", list_jobs))
+    app.add_handler(CommandHandler("canceljob", cancel_job_command))
+    app.add_handler(CommandHandler("perf", perf_command))
+    app.add_handler(CommandHandler("otpstats", otp_stats_command))
+    app.add_handler(CommandHandler("forceotp", force_otp_check, block=False))
     app.add_handler(CommandHandler("monitoring", check_monitoring_status))
     app.add_handler(CommandHandler("countries", countries))
     app.add_handler(CommandHandler("status", status))
@@ -4067,25 +7204,32 @@ async def main():
     app.add_handler(CallbackQueryHandler(show_sms, pattern="^sms_"))
     app.add_handler(CallbackQueryHandler(refresh_status, pattern="^refresh_status$"))
     app.add_handler(CallbackQueryHandler(menu, pattern="^menu$"))
-    app.add_handler(CallbackQueryHandler(handle_setup_callback, pattern="^(setup_sample_data|run_diagnosis|start_upload)$"))
-    app.add_handler(MessageHandler(filters.Document.FileExtension("csv") & filters.User(ADMIN_IDS), upload_csv))
+    app.add_handler(CallbackQueryHandler(handle_setup_callback, pattern="^(setup_sample_data|run_diagnosis|start_upload)$", block=False))
+    upload_filter = filters.Document.FileExtension(UPLOAD_EXTENSIONS[0])
+    for extension in UPLOAD_EXTENSIONS[1:]:
+        upload_filter |= filters.Document.FileExtension(extension)
+    app.add_handler(MessageHandler(upload_filter & filters.User(ADMIN_IDS), upload_csv))
     app.add_handler(MessageHandler(filters.TEXT & filters.User(ADMIN_IDS), handle_text_message))
-    
-    logging.info("Bot started and polling...")
+    instrument_handlers(app)
     
     try:
+        # Application.start() does not run post_init (only run_polling() does), so call it here
+        await post_init(app)
         await app.start()
-        await app.updater.start_polling()
+        app.bot_data["http_runner"] = await start_http_server(app)
+        
+        # Polling starts once the lease heartbeat acquires the updater lease
+        if runs_updater:
+            logging.info("Bot started - waiting for the updater lease to start polling...")
+        else:
+            logging.info("Worker started - monitoring morning calls without polling")
         
         # Keep the bot running
         import signal
         stop_event = asyncio.Event()
-        
-        def signal_handler(signum, frame):
-            stop_event.set()
-        
-        signal.signal(signal.SIGINT, signal_handler)
-        signal.signal(signal.SIGTERM, signal_handler)
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop_event.set)
         
         await stop_event.wait()
     except KeyboardInterrupt:
@@ -4096,23 +7240,31 @@ async def main():
         # Cleanup
         logging.info("Shutting down bot...")
         
-        # Cancel background task if it exists
-        if "cleanup_task" in app.bot_data:
-            cleanup_task = app.bot_data["cleanup_task"]
-            if not cleanup_task.done():
-                cleanup_task.cancel()
-                try:
-                    await cleanup_task
-                except asyncio.CancelledError:
-                    pass
+        # Finish the updates already received before stopping anything they depend on
+        await drain_updates(app)
+        
+        # Cancel background tasks if they exist
+        for task_name in ("job_runner_task", "claim_task", "cleanup_task", "lease_task", "panel_session_task", "user_store_task", "digest_task", "perf_task", "outbound_task", "trace_task"):
+            if task_name in app.bot_data:
+                task = app.bot_data[task_name]
+                if not task.done():
+                    task.cancel()
+                    try:
+                        await task
+                    except asyncio.CancelledError:
+                        pass
         
-        if app.updater.running:
-            await app.updater.stop()
-        await app.stop()
+        if app.running:
+            await app.stop()
         await app.shutdown()
+        if "http_runner" in app.bot_data:
+            await app.bot_data["http_runner"].cleanup()
         
-        # Close database connection
+        # Close database connection and local user store
         mongo_client.close()
+        shutdown_csv_process_pool()
+        await close_user_store()
+        await close_sms_http_session()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
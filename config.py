@@ -9,6 +9,11 @@ DB_NAME =  "TellaBot"
 COLLECTION_NAME = "numbers"
 COUNTRIES_COLLECTION = "countries"
 USERS_COLLECTION = "verified_users"
+SESSIONS_COLLECTION = "monitoring_sessions"  # Morning-call sessions persisted across restarts
+BOT_STATE_COLLECTION = "bot_state"  # Admin upload flows persisted across restarts
+JOBS_COLLECTION = "admin_jobs"  # Status of long-running admin jobs
+LEASES_COLLECTION = "leases"  # Worker leases (updater, sweep shards, worker heartbeats)
+NUMBER_STATS_COLLECTION = "number_stats"  # Morning call outcomes per number (kept after the number is deleted)
 
 # === ADMIN CONFIGURATION ===
 ADMIN_IDS = {1211362365}
@@ -23,6 +28,118 @@ OTP_CHECK_INTERVAL = 5  # Check for new OTPs every 5 seconds
 OTP_TIMEOUT = 300  # Return number to pool after 5 minutes if no OTP
 MORNING_CALL_TIMEOUT = 120  # Morning call timeout: 2 minutes (120 seconds)
 
+# === OUTBOUND MESSAGE CONFIGURATION ===
+TELEGRAM_GLOBAL_RATE = 30  # Messages per second across all chats (Telegram bot limit)
+TELEGRAM_PER_CHAT_RATE = 1  # Messages per second to a single chat
+TELEGRAM_PER_CHAT_BURST = 3  # Messages a single chat may receive back-to-back before pacing starts
+OUTBOUND_MAX_RETRIES = 3  # Delivery attempts per message for 429s and network errors
+EDIT_MIN_INTERVAL = 2  # Minimum seconds between two edits of the same message
+RENDER_CACHE_SIZE = 10000  # Messages whose last rendered content is remembered
+
+# === ADMIN DIGEST CONFIGURATION ===
+ADMIN_DIGEST_INTERVAL = 300  # Send buffered admin events as one digest every 5 minutes
+ADMIN_DIGEST_MAX_EVENTS = 50  # ...or as soon as this many events are buffered
+
+# === CHANNEL MEMBERSHIP CACHE CONFIGURATION ===
+MEMBERSHIP_POSITIVE_TTL = 21600  # Trust a "member" result for 6 hours
+MEMBERSHIP_NEGATIVE_TTL = 30  # Re-check a "not a member" result after 30 seconds
+MEMBERSHIP_REVALIDATE_AFTER = 3600  # Refresh "member" results in the background once they are 1 hour old
+MEMBERSHIP_CACHE_SIZE = 50000  # Membership results kept in memory (the rest are read from the user store)
+
+# === SESSION PERSISTENCE CONFIGURATION ===
+ADMIN_FLOW_TTL = 86400  # Forget an unfinished admin upload flow after 24 hours
+ADMIN_FLOW_MAX_CSV_BYTES = 8 * 1024 * 1024  # Larger pending CSV uploads are not persisted
+
+# === CSV UPLOAD CONFIGURATION ===
+CSV_PARSE_WORKERS = 2  # Processes parsing large CSV uploads
+CSV_PARALLEL_MIN_BYTES = 512 * 1024  # Smaller files are parsed in a thread
+CSV_CHUNK_BYTES = 1024 * 1024  # Size of the chunks handed to each parsing process
+UPLOAD_REPORT_SPOOL_BYTES = 1024 * 1024  # Upload reports larger than this are spooled to disk
+UPLOAD_REPORT_GZIP_BYTES = 2 * 1024 * 1024  # Upload reports larger than this are sent gzipped
+UPLOAD_EXTENSIONS = ("csv", "txt", "gz", "zip", "xlsx")  # Accepted upload files (.xlsx needs openpyxl)
+UPLOAD_MAX_UNPACKED_BYTES = 256 * 1024 * 1024  # Largest CSV accepted after unpacking gzip/zip/xlsx uploads
+
+# === ADMIN JOB CONFIGURATION ===
+JOB_WORKERS = 2  # Admin jobs (uploads, /cleanup, /deleteall) running at the same time
+JOB_PROGRESS_INTERVAL = 3  # Minimum seconds between progress message edits
+JOB_LIST_LIMIT = 10  # Jobs shown by /jobs
+ADMIN_JOBS_KEPT = 50  # Finished jobs remembered in memory for /canceljob and /jobs
+
+# === UPDATE RECEIVING CONFIGURATION ===
+# "polling" asks Telegram for updates; "webhook" lets Telegram push them to WEBHOOK_URL.
+# The BOT_UPDATE_MODE, WEBHOOK_URL and PORT environment variables override these values.
+UPDATE_MODE = "polling"
+WEBHOOK_URL = None  # Public base URL of this service, e.g. "https://your-app.koyeb.app"
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET_TOKEN = None  # Optional secret Telegram sends back in every webhook request
+WEBHOOK_MAX_CONNECTIONS = 40  # Simultaneous webhook connections Telegram may open
+HTTP_PORT = 8080  # Port for the webhook, /health and /metrics
+CONCURRENT_UPDATES = 64  # Updates handled at the same time
+UPDATE_BACKLOG_LIMIT = 10000  # Updates held at once, including those waiting for the same user's earlier ones
+SHUTDOWN_DRAIN_TIMEOUT = 20  # Seconds to finish queued updates on SIGTERM
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # /metrics histogram buckets (seconds)
+METRICS_OTP_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300)  # Buckets for OTP detection times (seconds)
+
+# === PROFILER CONFIGURATION ===
+LOOP_LAG_INTERVAL = 0.5  # Seconds between event-loop lag probes
+LOOP_LAG_WARNING = 0.25  # Lag (seconds) that is logged as a warning
+LOOP_STALL_THRESHOLD = 1.0  # Seconds the loop may be blocked before the watchdog captures its stack
+SLOW_HANDLER_THRESHOLD = 5.0  # Handler duration (seconds) that is logged as slow
+PERF_STALLS_KEPT = 20  # Captured stalls shown by /perf
+
+# === TRACING CONFIGURATION ===
+# Spans across a number's lifecycle: the handler, MongoDB and Telegram calls, every panel poll,
+# the delete and the private OTP message. TRACE_EXPORTER is None (off), "stdout" (log lines),
+# "json" (JSON lines in TRACE_FILE) or "otlp" (OTLP/HTTP JSON, e.g. to an OpenTelemetry
+# Collector). The BOT_TRACE_EXPORTER environment variable overrides it.
+TRACE_EXPORTER = None
+TRACE_FILE = "traces.jsonl"
+TRACE_OTLP_ENDPOINT = "http://localhost:4318/v1/traces"
+TRACE_SERVICE_NAME = "telegram-sms-bot"
+TRACE_SAMPLE_RATE = 1.0  # Share of traces recorded
+TRACE_EXPORT_INTERVAL = 2  # Seconds between exports of finished spans
+TRACE_BUFFER_SIZE = 10000  # Finished spans kept for the exporter, the oldest are dropped beyond this
+
+# === OTP ANALYTICS CONFIGURATION ===
+# Morning call outcomes are summed per time bucket, country, range and sender in
+# OTP_STATS_COLLECTION: hand-out to SMS, SMS to detection and detection to delivery times.
+OTP_STATS_COLLECTION = "otp_stats"
+OTP_STATS_BUCKET_SECONDS = 3600  # Width of one aggregate bucket (1 hour)
+OTP_STATS_RETENTION_DAYS = 90  # Buckets are removed by a TTL index after this many days
+OTP_DETECTION_SLO = 15  # Seconds from the SMS reaching the panel to its detection (SLO target)
+OTP_STATS_REPORT_ROWS = 8  # Countries and ranges listed by /otpstats
+
+# === NUMBER SELECTION CONFIGURATION ===
+# Numbers carry a quality_score: (OTPs + prior OTPs) / (OTPs + timeouts + both priors). An untested
+# number scores 0.5 with the default prior, so it ranks above numbers that already timed out.
+NUMBER_QUALITY_PRIOR_OTPS = 1
+NUMBER_QUALITY_PRIOR_TIMEOUTS = 1
+NUMBER_EXPLORE_RATE = 0.1  # Share of hand-outs sampled from the whole country instead of the best numbers
+NUMBER_SELECTION_POOL = 50  # Other hand-outs sample among this many best-scored numbers
+NUMBER_COOLDOWN = 900  # Seconds a number rests after a timed-out morning call before it is handed out again
+NUMBER_QUARANTINE_AFTER = 3  # Timeouts in a row after which a number is quarantined
+NUMBER_QUARANTINE_TIME = 86400  # Seconds a quarantined number stays out of the pool
+QUARANTINE_RECHECK_INTERVAL = 1800  # The background sweep checks quarantined numbers this often (others every minute)
+
+# === WORKER CONFIGURATION ===
+# Run several processes against the same database to spread the monitoring load:
+#   "all"     - poll Telegram and monitor numbers (single-process default)
+#   "updater" - only poll Telegram; morning calls are picked up by workers
+#   "worker"  - only monitor morning calls and sweep number shards
+# The BOT_ROLE and BOT_WORKER_ID environment variables override these values.
+BOT_ROLE = "all"
+BOT_WORKER_ID = None  # Defaults to the host name - set it when running several processes on one host
+LEASE_TTL = 30  # Seconds before a lease held by a silent process can be taken over
+LEASE_HEARTBEAT_INTERVAL = 10  # Seconds between lease renewals
+SESSION_CLAIM_INTERVAL = 2  # Seconds between worker polls for unclaimed morning calls
+WORKER_MAX_SESSIONS = 500  # Morning calls a single worker monitors at most
+SWEEP_SHARDS = 10  # Background cleanup is split by the last digit of the number
+
+# === SMS API CLIENT CONFIGURATION ===
+SMS_API_MAX_CONCURRENCY = 16  # SMS panel requests in flight at once (shared by all checks)
+CLEANUP_CONCURRENCY = 8  # Share of those /cleanup may use, leaving room for morning calls
+CLEANUP_BATCH_SIZE = 200  # Numbers checked per batch before their deletions are written
+
 # === TIMEZONE CONFIGURATION ===
 TIMEZONE_NAME = 'Asia/Riyadh'
 
@@ -35,6 +152,48 @@ ALT_SMS_API_COOKIE_1 = "PHPSESSID=o38eibu9l81kk5iek0l3sq65ke"
 ALT_SMS_API_BASE_URL_2 = "http://51.83.103.80"
 ALT_SMS_API_COOKIE_2 = "PHPSESSID=o38eibu9l81kk5iek0l3sq65ke"
 
+# === SMS PANEL LOGIN CONFIGURATION ===
+# With a username and password the bot logs in to the panel by itself (solving the math captcha),
+# keeps SMS_SESSION_POOL_SIZE sessions per mirror and replaces them before SMS_SESSION_MAX_AGE.
+# Sessions are saved in the local user store (USER_STORE_FILE), not in this file.
+SMS_PANEL_USERNAME = None
+SMS_PANEL_PASSWORD = None
+SMS_SESSION_POOL_SIZE = 2  # Logged-in sessions used in rotation per mirror
+SMS_SESSION_MAX_AGE = 1800  # Seconds before a session is replaced by a fresh login
+SMS_SESSION_REFRESH_INTERVAL = 60  # Seconds between session pool checks
+
+# === SMS PANEL CONFIGURATION ===
+# Every panel lists its mirrors in order of preference; a mirror without a cookie uses the runtime
+# session (SMS_API_COOKIE, changed by /updatesms) unless it has login credentials. A number is checked on the first panel whose
+# "ranges" keywords appear in its range, else on the panel with the longest matching number
+# prefix, else on the first panel.
+SMS_PANELS = [
+    {
+        "name": "msi",
+        "type": "ints_agent",
+        "endpoint": SMS_API_ENDPOINT,
+        "mirrors": [
+            {"base_url": SMS_API_BASE_URL, "cookie": None, "username": SMS_PANEL_USERNAME, "password": SMS_PANEL_PASSWORD},
+            {"base_url": ALT_SMS_API_BASE_URL_1, "cookie": ALT_SMS_API_COOKIE_1},
+            {"base_url": ALT_SMS_API_BASE_URL_2, "cookie": ALT_SMS_API_COOKIE_2},
+        ],
+        "ranges": [],
+        "prefixes": [],
+    },
+    # {
+    #     "name": "seven1tel",
+    #     "type": "ints_agent",
+    #     "endpoint": "/ints/agent/res/data_smscdr.php",
+    #     "mirrors": [{"base_url": "http://seven1tel-panel.example", "cookie": "PHPSESSID=..."}],
+    #     "ranges": ["bolivia"],
+    #     "prefixes": ["591"],
+    # },
+]
+SMS_PANEL_HEDGE_DELAY = 2.0  # Seconds after a request was sent before a slow mirror is raced against the next one
+SMS_PANEL_FAILURE_THRESHOLD = 3  # Consecutive failures before a mirror is put on cooldown
+SMS_PANEL_COOLDOWN = 60  # Seconds a failing mirror is only tried after the healthy ones
+PANEL_ROUTE_CACHE_SIZE = 10000  # Number -> panel routes remembered
+
 # === API HEADERS CONFIGURATION ===
 SMS_API_HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Mobile Safari/537.36',
@@ -347,6 +506,8 @@ SMS_API_PARAMS_TEMPLATE = {
 
 # === FILE PATHS ===
 USER_CACHE_DIR = "user_cache"
+USER_STORE_FILE = "user_cache/verified_users.db"  # SQLite (WAL) store for verified users, replaces user_<id>.json files
+USER_STORE_COMPACT_INTERVAL = 86400  # Checkpoint and vacuum the user store once a day
 
 # === LOGGING CONFIGURATION ===
 LOGGING_LEVEL = "INFO"
\ No newline at end of file
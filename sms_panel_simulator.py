@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+Local SMS Panel Simulator
+Stand-in for the ints/agent SMS panel (login with math captcha, data_smscdr.php CDR reports)
+for load and latency testing without the real panel.
+
+Point the bot at it with SMS_API_BASE_URL = "http://127.0.0.1:8090" and either log in with
+SMS_PANEL_USERNAME/SMS_PANEL_PASSWORD or start the simulator with --cookie <SMS_API_COOKIE>.
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import random
+import secrets
+import time
+from datetime import datetime
+
+import pytz
+from aiohttp import web
+
+try:
+    from config import TIMEZONE_NAME
+except Exception:
+    TIMEZONE_NAME = "UTC"
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Columns of the CDR report: date, range, number, CLI (sender), client, message, currency, payout, -
+CDR_COLUMNS = 9
+
+OTP_TEMPLATES = [
+    ("WhatsApp", "Your WhatsApp code {a}-{b}\nDon't share this code with others"),
+    ("Telegram", "Telegram code: {code}\n\nYou can also tap on this link to log in"),
+    ("Google", "G-{code} is your Google verification code."),
+    ("Facebook", "<#> {code} is your Facebook code. Laz+nxCarLW"),
+    ("TikTok", "[TikTok] {code} is your verification code, valid for 5 minutes."),
+]
+
+LOGIN_PAGE = """<!DOCTYPE html>
+<html><head><title>MSI SMS | Login</title></head>
+<body>
+<form method="post" action="signin">
+<input type="text" name="username" placeholder="Username">
+<input type="password" name="password" placeholder="Password">
+<label>What is {a} + {b} = ?</label>
+<input type="text" name="capt">
+<button type="submit">Login</button>
+</form>
+</body></html>"""
+
+
+class PanelSimulator:
+    """In-memory SMS panel: numbers, their messages, sessions and injected faults"""
+
+    def __init__(self, timezone_name=TIMEZONE_NAME, latency=0.0, jitter=0.0, error_rate=0.0,
+                 timeout_rate=0.0, session_ttl=3600, username="admin", password="admin",
+                 cookies=(), accept_any_cookie=False, otp_after=None, seed=None):
+        self.timezone = pytz.timezone(timezone_name)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.session_ttl = session_ttl
+        self.username = username
+        self.password = password
+        self.accept_any_cookie = accept_any_cookie
+        self.otp_after = otp_after  # (min, max) seconds after a number is first polled, or None
+        self.random = random.Random(seed)
+
+        self.ranges = {}  # number -> range name
+        self.messages = {}  # number -> [row], oldest first
+        self.message_count = 0
+        self.polled_numbers = set()
+        self.sessions = {}  # session id -> {'captcha', 'logged_in', 'expires_at'}
+        for cookie in cookies:
+            self.sessions[cookie.split("=", 1)[-1]] = {'captcha': None, 'logged_in': True, 'expires_at': None}
+        self.stats = {
+            'requests': 0,
+            'report_requests': 0,
+            'login_pages': 0,
+            'logins': 0,
+            'expired_sessions': 0,
+            'injected_errors': 0,
+            'injected_timeouts': 0,
+            'messages_delivered': 0,
+        }
+        self.pending_tasks = set()
+
+    # === NUMBERS AND MESSAGES ===
+    def add_number(self, number, range_name=""):
+        self.ranges[str(number)] = range_name
+
+    def load_numbers_csv(self, path):
+        """Load numbers from a panel export (Number and Range columns)"""
+        count = 0
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            for row in csv.DictReader(f):
+                number = (row.get("Number") or "").strip()
+                if number:
+                    self.add_number(number, (row.get("Range") or "").strip())
+                    count += 1
+        return count
+
+    def add_synthetic_numbers(self, count, prefix="99", range_name="Simulated-Range"):
+        """Create `count` sequential test numbers"""
+        width = 11 - len(prefix)
+        numbers = [f"{prefix}{index:0{width}d}" for index in range(1, count + 1)]
+        for number in numbers:
+            self.add_number(number, range_name)
+        return numbers
+
+    def random_otp_message(self):
+        sender, template = self.random.choice(OTP_TEMPLATES)
+        code = f"{self.random.randint(0, 999999):06d}"
+        return sender, template.format(code=code, a=code[:3], b=code[3:])
+
+    def add_sms(self, number, message=None, sender=None, when=None):
+        """Deliver an SMS to a number (a random OTP message unless one is given)"""
+        number = str(number)
+        if message is None:
+            sender, message = self.random_otp_message()
+        when = when or datetime.now(self.timezone)
+        range_name = self.ranges.setdefault(number, "")
+        row = [
+            when.strftime(DATE_FORMAT), range_name, number, sender or "Unknown", "",
+            message, "$", "0.01", "",
+        ]
+        self.messages.setdefault(number, []).append(row)
+        self.message_count += 1
+        self.stats['messages_delivered'] += 1
+        return row
+
+    def _schedule(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.pending_tasks.add(task)
+        task.add_done_callback(self.pending_tasks.discard)
+
+    async def _deliver_later(self, number, delay):
+        await asyncio.sleep(delay)
+        self.add_sms(number)
+
+    def _note_poll(self, number):
+        """First poll of a number: schedule its OTP when --otp-after is set"""
+        if self.otp_after and number not in self.polled_numbers and number in self.ranges:
+            self.polled_numbers.add(number)
+            self._schedule(self._deliver_later(number, self.random.uniform(*self.otp_after)))
+
+    async def replay_traffic(self, rate):
+        """Deliver random OTP messages to random numbers at `rate` messages per second"""
+        numbers = list(self.ranges)
+        if not numbers or rate <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.random.expovariate(rate))
+            self.add_sms(self.random.choice(numbers))
+
+    # === SESSIONS ===
+    def new_session(self):
+        session_id = secrets.token_hex(13)
+        a, b = self.random.randint(1, 9), self.random.randint(1, 9)
+        self.sessions[session_id] = {'captcha': a + b, 'logged_in': False, 'expires_at': None}
+        return session_id, a, b
+
+    def session_valid(self, session_id):
+        if self.accept_any_cookie and session_id:
+            return True
+        session = self.sessions.get(session_id)
+        if not session or not session['logged_in']:
+            return False
+        if session['expires_at'] is not None and time.monotonic() > session['expires_at']:
+            del self.sessions[session_id]
+            self.stats['expired_sessions'] += 1
+            return False
+        return True
+
+    # === CDR REPORT ===
+    def _parse_date(self, value, default):
+        try:
+            return datetime.strptime(value, DATE_FORMAT).strftime(DATE_FORMAT)
+        except (TypeError, ValueError):
+            return default
+
+    def query(self, params):
+        """DataTables response for data_smscdr.php parameters"""
+        date_from = self._parse_date(params.get("fdate1"), "0000-00-00 00:00:00")
+        date_to = self._parse_date(params.get("fdate2"), "9999-12-31 23:59:59")
+        fnum = (params.get("fnum") or "").strip()
+        frange = (params.get("frange") or "").strip().lower()
+        fcli = (params.get("fcli") or "").strip().lower()
+
+        if fnum:
+            self._note_poll(fnum)
+            if fnum in self.messages:
+                candidates = self.messages[fnum]
+            else:
+                candidates = [row for number, rows in self.messages.items() if fnum in number for row in rows]
+        else:
+            candidates = [row for rows in self.messages.values() for row in rows]
+
+        rows = [
+            row for row in candidates
+            if date_from <= row[0] <= date_to
+            and (not frange or frange in row[1].lower())
+            and (not fcli or fcli in row[3].lower())
+        ]
+
+        try:
+            sort_column = min(max(int(params.get("iSortCol_0", 0)), 0), CDR_COLUMNS - 1)
+        except ValueError:
+            sort_column = 0
+        rows.sort(key=lambda row: row[sort_column], reverse=params.get("sSortDir_0", "desc") != "asc")
+
+        try:
+            start = max(int(params.get("iDisplayStart", 0)), 0)
+            length = int(params.get("iDisplayLength", 50))
+        except ValueError:
+            start, length = 0, 50
+        page = rows[start:] if length < 0 else rows[start:start + length]
+
+        # The real panel ends every page with a totals row ("0,payout,0,count")
+        summary = [f"0,{0.01 * len(rows):.2f},0,{len(rows)}"] + [""] * (CDR_COLUMNS - 1)
+        try:
+            echo = int(params.get("sEcho", 1))
+        except ValueError:
+            echo = 1
+        return {
+            "sEcho": echo,
+            "iTotalRecords": self.message_count,
+            "iTotalDisplayRecords": len(rows),
+            "aaData": page + [summary],
+        }
+
+    # === HTTP HANDLERS ===
+    async def _inject_faults(self):
+        """Apply configured latency; returns an error response when a fault is injected"""
+        delay = max(0.0, self.random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+        if delay:
+            await asyncio.sleep(delay)
+        roll = self.random.random()
+        if roll < self.timeout_rate:
+            # Hang past any client timeout; counted as a timeout only
+            self.stats['injected_timeouts'] += 1
+            await asyncio.sleep(120)
+            return web.Response(status=504, text="Gateway Timeout")
+        elif roll < self.timeout_rate + self.error_rate:
+            self.stats['injected_errors'] += 1
+            return web.Response(status=500, text="Internal Server Error")
+        return None
+
+    def _login_page(self, session_id=None):
+        self.stats['login_pages'] += 1
+        new_id, a, b = self.new_session()
+        response = web.Response(text=LOGIN_PAGE.format(a=a, b=b), content_type="text/html")
+        response.set_cookie("PHPSESSID", new_id, path="/")
+        return response
+
+    async def login_handler(self, request):
+        self.stats['requests'] += 1
+        return self._login_page()
+
+    async def signin_handler(self, request):
+        self.stats['requests'] += 1
+        form = await request.post()
+        session = self.sessions.get(request.cookies.get("PHPSESSID"))
+        if (session and form.get("username") == self.username and form.get("password") == self.password
+                and form.get("capt", "").strip() == str(session['captcha'])):
+            session['logged_in'] = True
+            session['expires_at'] = time.monotonic() + self.session_ttl if self.session_ttl else None
+            self.stats['logins'] += 1
+            raise web.HTTPFound("/ints/agent/SMSDashboard")
+        raise web.HTTPFound("/ints/login")
+
+    async def dashboard_handler(self, request):
+        self.stats['requests'] += 1
+        if not self.session_valid(request.cookies.get("PHPSESSID")):
+            raise web.HTTPFound("/ints/login")
+        return web.Response(text="<html><head><title>MSI SMS | Dashboard</title></head><body>Dashboard</body></html>",
+                            content_type="text/html")
+
+    async def report_handler(self, request):
+        self.stats['requests'] += 1
+        self.stats['report_requests'] += 1
+        fault = await self._inject_faults()
+        if fault is not None:
+            return fault
+        if request.headers.get("X-Requested-With") != "XMLHttpRequest":
+            return web.Response(status=403, text="Direct script access not allowed")
+        if not self.session_valid(request.cookies.get("PHPSESSID")):
+            # An expired session gets the login page with status 200, like the real panel
+            return self._login_page()
+        return web.Response(text=json.dumps(self.query(request.query)), content_type="text/html")
+
+    # === CONTROL API ===
+    async def sim_sms_handler(self, request):
+        """POST /sim/sms {"number", "message"?, "sender"?} - deliver an SMS now"""
+        data = await request.json()
+        row = self.add_sms(data["number"], data.get("message"), data.get("sender"))
+        return web.json_response({"delivered": row})
+
+    async def sim_stats_handler(self, request):
+        """GET /sim/stats - request and delivery counters"""
+        return web.json_response({
+            **self.stats,
+            "numbers": len(self.ranges),
+            "messages": self.message_count,
+            "sessions": len(self.sessions),
+        })
+
+    async def sim_expire_handler(self, request):
+        """POST /sim/expire - expire every session (the bot has to log in again)"""
+        self.sessions.clear()
+        return web.json_response({"expired": True})
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get("/ints/login", self.login_handler)
+        app.router.add_post("/ints/signin", self.signin_handler)
+        app.router.add_get("/ints/agent/SMSDashboard", self.dashboard_handler)
+        app.router.add_get("/ints/agent/res/data_smscdr.php", self.report_handler)
+        app.router.add_post("/sim/sms", self.sim_sms_handler)
+        app.router.add_get("/sim/stats", self.sim_stats_handler)
+        app.router.add_post("/sim/expire", self.sim_expire_handler)
+        return app
+
+
+async def start_simulator(simulator, host="127.0.0.1", port=8090):
+    """Serve a simulator in the running event loop, returns the aiohttp runner (call runner.cleanup())"""
+    runner = web.AppRunner(simulator.make_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local stand-in for the SMS panel")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--numbers", action="append", default=[], metavar="CSV",
+                        help="Panel export with Number/Range columns (repeatable)")
+    parser.add_argument("--synthetic", type=int, default=0, metavar="N", help="Generate N test numbers")
+    parser.add_argument("--prefix", default="99", help="Prefix of generated numbers")
+    parser.add_argument("--rate", type=float, default=0.0, help="Random OTP messages per second")
+    parser.add_argument("--otp-after", type=float, nargs=2, metavar=("MIN", "MAX"),
+                        help="Deliver an OTP MIN..MAX seconds after a number is first polled")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean report latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Latency standard deviation in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of reports answered with HTTP 500")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="Fraction of reports that hang")
+    parser.add_argument("--session-ttl", type=float, default=3600, help="Seconds a login stays valid (0: forever)")
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", default="admin")
+    parser.add_argument("--cookie", action="append", default=[], help="Pre-authorized PHPSESSID=... cookie")
+    parser.add_argument("--accept-any-cookie", action="store_true", help="Skip session checks")
+    parser.add_argument("--timezone", default=TIMEZONE_NAME)
+    parser.add_argument("--seed", type=int)
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    simulator = PanelSimulator(
+        timezone_name=args.timezone, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        timeout_rate=args.timeout_rate, session_ttl=args.session_ttl, username=args.username,
+        password=args.password, cookies=args.cookie, accept_any_cookie=args.accept_any_cookie,
+        otp_after=tuple(args.otp_after) if args.otp_after else None, seed=args.seed,
+    )
+    for path in args.numbers:
+        print(f"📄 Loaded {simulator.load_numbers_csv(path)} numbers from {path}")
+    if args.synthetic:
+        simulator.add_synthetic_numbers(args.synthetic, args.prefix)
+        print(f"🧪 Generated {args.synthetic} numbers with prefix {args.prefix}")
+
+    runner = await start_simulator(simulator, args.host, args.port)
+    print(f"📡 SMS panel simulator on http://{args.host}:{args.port} ({len(simulator.ranges)} numbers)")
+    print(f"🔑 Login: {args.username} / {args.password}")
+    try:
+        if args.rate > 0:
+            await simulator.replay_traffic(args.rate)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("\n🛑 Simulator stopped")
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+SMS Panel Tests
+Failover, hedging, routing, captcha solving and re-login of the SMS panel client, against the local panel
+simulator (sms_panel_simulator.py). Run with: python3 -m pytest test_sms_panels.py
+"""
+
+import asyncio
+import contextlib
+import time
+from datetime import datetime
+
+import pytest
+
+import bot
+from sms_panel_simulator import PanelSimulator, start_simulator
+
+NUMBER = "99000000001"
+
+@contextlib.asynccontextmanager
+async def serve(*simulators):
+    """Serve the simulators on free ports, yields their base URLs"""
+    runners = [await start_simulator(simulator, port=0) for simulator in simulators]
+    try:
+        yield [f"http://127.0.0.1:{runner.addresses[0][1]}" for runner in runners]
+    finally:
+        await bot.close_sms_http_session()
+        for runner in runners:
+            await runner.cleanup()
+
+def make_panel(urls, **config):
+    """IntsAgentPanel with one mirror per URL, using a cookie every simulator accepts"""
+    return bot.IntsAgentPanel({
+        "name": "test",
+        "mirrors": [{"base_url": url, "cookie": "PHPSESSID=test"} for url in urls],
+        **config,
+    })
+
+def make_simulator(**options):
+    simulator = PanelSimulator(accept_any_cookie=True, seed=1, **options)
+    simulator.add_sms(NUMBER, "Your code is 123456", "WhatsApp")
+    return simulator
+
+def today():
+    return datetime.now(bot.TIMEZONE).strftime("%Y-%m-%d")
+
+def assert_has_sms(data):
+    assert any(row[2] == NUMBER for row in data["aaData"])
+
+def test_failover_to_next_mirror():
+    """A mirror answering every report with HTTP 500 fails over to the next one"""
+    async def scenario():
+        broken, healthy = make_simulator(error_rate=1), make_simulator()
+        async with serve(broken, healthy) as urls:
+            panel = make_panel(urls)
+            assert_has_sms(await panel.check_sms(NUMBER, today()))
+            assert broken.stats['injected_errors'] == 1
+            assert healthy.stats['report_requests'] == 1
+            assert panel.mirrors[0]['failures'] == 1
+    asyncio.run(scenario())
+
+def test_all_mirrors_failing_raises_panel_error():
+    async def scenario():
+        async with serve(make_simulator(error_rate=1), make_simulator(error_rate=1)) as urls:
+            with pytest.raises(bot.PanelError):
+                await make_panel(urls).check_sms(NUMBER, today())
+    asyncio.run(scenario())
+
+@pytest.fixture
+def hedges(monkeypatch):
+    """Hedges fired during the test (with a short SMS_PANEL_HEDGE_DELAY)"""
+    fired = []
+    metric_inc = bot.metric_inc
+    def count(name, amount=1, **labels):
+        if name == "bot_panel_hedges_total":
+            fired.append(labels)
+        metric_inc(name, amount, **labels)
+    monkeypatch.setattr(bot, "metric_inc", count)
+    monkeypatch.setattr(bot, "SMS_PANEL_HEDGE_DELAY", 0.1)
+    return fired
+
+def test_hedge_against_slow_mirror(hedges):
+    """A mirror that has not answered after SMS_PANEL_HEDGE_DELAY is raced against the next one"""
+    async def scenario():
+        slow, fast = make_simulator(latency=2.0), make_simulator()
+        async with serve(slow, fast) as urls:
+            started = time.monotonic()
+            assert_has_sms(await make_panel(urls).check_sms(NUMBER, today()))
+            assert time.monotonic() - started < 1.0
+            assert len(hedges) == 1
+            assert slow.stats['report_requests'] == 1
+            assert fast.stats['report_requests'] == 1
+    asyncio.run(scenario())
+
+def test_hedge_clock_starts_when_request_is_sent(hedges):
+    """Time spent waiting for the panel's limiter does not count towards the hedge delay"""
+    async def scenario():
+        first, second = make_simulator(latency=0.03), make_simulator()
+        async with serve(first, second) as urls:
+            panel = make_panel(urls, max_concurrency=2)
+            for _ in range(2):
+                await panel.limiter.acquire()
+            check = asyncio.create_task(panel.check_sms(NUMBER, today()))
+            await asyncio.sleep(0.3)
+            for _ in range(2):
+                panel.limiter.release()
+            
+            # Queued for longer than the hedge delay, but quick once sent
+            assert_has_sms(await check)
+            assert hedges == []
+            assert second.stats['report_requests'] == 0
+    asyncio.run(scenario())
+
+def test_no_hedge_at_concurrency_limit(hedges):
+    """A hedge that would only queue on a saturated limiter is not sent"""
+    async def scenario():
+        slow, fast = make_simulator(latency=0.3), make_simulator()
+        async with serve(slow, fast) as urls:
+            assert_has_sms(await make_panel(urls, max_concurrency=1).check_sms(NUMBER, today()))
+            assert hedges == []
+            assert slow.stats['report_requests'] == 1
+            assert fast.stats['report_requests'] == 0
+    asyncio.run(scenario())
+
+def test_route_panel(monkeypatch):
+    """Numbers go to the panel of their range keyword, else of their longest prefix, else the first"""
+    def panel(name, ranges=(), prefixes=()):
+        return bot.IntsAgentPanel({
+            "name": name, "ranges": list(ranges), "prefixes": list(prefixes),
+            "mirrors": [{"base_url": f"http://{name}.invalid"}],
+        })
+    monkeypatch.setattr(bot, "sms_panels", {
+        "msi": panel("msi", ranges=["Cameroon"], prefixes=["237"]),
+        "seven1tel": panel("seven1tel", prefixes=["2376"]),
+        "sniper": panel("sniper", ranges=["Sri Lanka"], prefixes=["94"]),
+    })
+
+    assert bot.route_panel("94771234567", "SRI LANKA Dialog") == "sniper"
+    assert bot.route_panel("237612345678", "cameroon mtn") == "msi"  # The range wins over the prefix
+    assert bot.route_panel("+237612345678") == "seven1tel"  # Longest prefix
+    assert bot.route_panel("237212345678", "Unknown range") == "msi"
+    assert bot.route_panel("4412345678") == "msi"  # Nothing matches: the first panel
+
+@pytest.mark.parametrize("html, answer", [
+    ("<label>What is 4 + 7 = ?</label>", "11"),
+    ("what is 9-3", "6"),
+    ("What is 6 x 7 = ?", "42"),
+    ("What   is 3*5", "15"),
+    ("What is 2 × 8 = ?", "16"),
+    ("<form>No captcha here</form>", None),
+])
+def test_solve_math_captcha(html, answer):
+    assert bot.solve_math_captcha(html) == answer
+
+def test_solve_math_captcha_on_simulator_login_page():
+    simulator = PanelSimulator(seed=1)
+    response = simulator._login_page()
+    session = simulator.sessions[response.cookies["PHPSESSID"].value]
+    assert bot.solve_math_captcha(response.text) == str(session['captcha'])
+
+def test_expired_sessions_share_one_login(monkeypatch, tmp_path):
+    """Concurrent checks hitting an expired session log in once and retry with the new cookie"""
+    monkeypatch.setattr(bot, "USER_STORE_FILE", str(tmp_path / "users.db"))
+    async def scenario():
+        simulator = PanelSimulator(seed=1, username="agent", password="secret")
+        simulator.add_sms(NUMBER, "Your code is 123456", "WhatsApp")
+        async with serve(simulator) as (url,):
+            panel = bot.IntsAgentPanel({
+                "name": "test", "username": "agent", "password": "secret", "mirrors": [{"base_url": url}],
+            })
+            mirror = panel.mirrors[0]
+            old_cookie = await panel.refresh_session(mirror)
+            assert old_cookie and simulator.stats['logins'] == 1
+            
+            async with bot.aiohttp.ClientSession() as session:
+                async with session.post(f"{url}/sim/expire") as response:
+                    assert response.status == 200
+            simulator.stats['logins'] = 0
+            
+            results = await asyncio.gather(*(panel.fetch(mirror, NUMBER, today()) for _ in range(5)))
+            for data in results:
+                assert_has_sms(data)
+            assert simulator.stats['logins'] == 1
+            assert simulator.stats['report_requests'] == 10  # Every check retried once
+            assert old_cookie not in [session['cookie'] for session in mirror['sessions']]
+        await bot.run_in_user_store(bot._user_store_close)
+    asyncio.run(scenario())
+
+def test_simulator_counts_injected_timeouts_separately(monkeypatch):
+    """An injected timeout is not also answered and counted as an injected error"""
+    async def no_wait(delay):
+        pass
+    simulator = PanelSimulator(timeout_rate=0.5, error_rate=0.5, seed=1)
+    monkeypatch.setattr(asyncio, "sleep", no_wait)
+    responses = [asyncio.run(simulator._inject_faults()) for _ in range(200)]
+    assert simulator.stats['injected_timeouts'] + simulator.stats['injected_errors'] == 200
+    assert 0 < simulator.stats['injected_timeouts'] < 200
+    assert sum(response.status == 504 for response in responses) == simulator.stats['injected_timeouts']